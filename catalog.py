@@ -0,0 +1,169 @@
+import bisect
+import fnmatch
+import heapq
+import re
+from array import array
+
+from protocol import SEARCH_GLOB, SEARCH_PREFIX, SEARCH_SUBSTRING, ProtocolError
+
+DEFAULT_PAGE = 100  # nomes por página de uma busca, se o pedido não disser
+MAX_PAGE = 1000  # máximo de nomes numa página
+MAX_PAGE_BYTES = 64 * 1024  # máximo de bytes de nomes numa página
+
+_WILDCARD = re.compile(r"[*?[]")
+# maior caractere possível: prefixo + _LAST fica depois de todo nome com o prefixo
+_LAST = "\U0010ffff"
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def take_page(names, limit, max_bytes=MAX_PAGE_BYTES):
+    """
+    Primeiros nomes de um iterável já ordenado, até limit nomes ou max_bytes
+    (sempre ao menos um). Devolve (página, há mais?).
+    """
+    page = []
+    size = 0
+    for name in names:
+        size += len(name.encode()) + 4  # o front coding gasta no máximo 4 bytes a mais por nome
+        if len(page) >= limit or (page and size > max_bytes):
+            return page, True
+        page.append(name)
+    return page, False
+
+
+class CatalogIndex:
+    """
+    Nomes de arquivo conhecidos pelo tracker, indexados para busca.
+
+    Os nomes ficam numa lista ordenada: uma busca por prefixo é um bisect
+    seguido da leitura da faixa, e a paginação recomeça depois do último nome
+    devolvido (after). Um índice de trigramas (3 caracteres seguidos -> ids
+    dos nomes que os contêm) responde buscas por substring: só os nomes do
+    trigrama mais raro do texto são conferidos. Um glob usa o prefixo literal
+    antes do primeiro curinga ou os trigramas do maior trecho literal, o que
+    conferir menos nomes; padrões sem nenhum dos dois varrem a lista.
+
+    Montar os trigramas custa ~15 µs por nome, então eles não são montados
+    no construtor: index_pending() os monta aos poucos e, até terminar, as
+    buscas por substring e glob varrem a lista. Um nome removido deixa o id
+    morto nos trigramas; com mais ids mortos que vivos os trigramas são
+    montados de novo do zero.
+
+    Não é thread-safe: o tracker o usa com o seu lock.
+    """
+    def __init__(self, names=()):
+        self._names = sorted(set(names))
+        self._reset_trigrams()
+
+    def _reset_trigrams(self):
+        self._by_id = list(self._names)  # id -> nome (None: removido)
+        self._ids = {name: i for i, name in enumerate(self._by_id)}
+        self._trigrams = {}  # trigrama -> array de ids
+        self._next = 0  # ids abaixo deste já estão nos trigramas
+        self._dead = 0
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return name in self._ids
+
+    @property
+    def ready(self) -> bool:
+        """Os trigramas cobrem todos os nomes."""
+        return self._next >= len(self._by_id)
+
+    def _index(self, name_id, name):
+        trigrams = self._trigrams
+        for gram in _trigrams(name):
+            ids = trigrams.get(gram)
+            if ids is None:
+                ids = trigrams[gram] = array("I")
+            ids.append(name_id)
+
+    def index_pending(self, limit=None) -> bool:
+        """Indexa até limit nomes ainda sem trigramas (todos, sem limit). Devolve self.ready."""
+        stop = len(self._by_id) if limit is None else min(len(self._by_id), self._next + limit)
+        for name_id in range(self._next, stop):
+            name = self._by_id[name_id]
+            if name is not None:
+                self._index(name_id, name)
+        self._next = stop
+        return self.ready
+
+    def add(self, name):
+        if name in self._ids:
+            return
+        bisect.insort(self._names, name)
+        ready = self.ready
+        name_id = self._ids[name] = len(self._by_id)
+        self._by_id.append(name)
+        if ready:
+            self._index(name_id, name)
+            self._next = len(self._by_id)
+        # senão index_pending() chega nele
+
+    def discard(self, name):
+        name_id = self._ids.pop(name, None)
+        if name_id is None:
+            return
+        del self._names[bisect.bisect_left(self._names, name)]
+        self._by_id[name_id] = None
+        self._dead += 1
+        if self._dead > max(len(self._names), 1024):
+            self._reset_trigrams()
+
+    def _range(self, prefix, after):
+        """Faixa [lo, hi) de self._names com os nomes que têm o prefixo e vêm depois de after."""
+        lo = max(bisect.bisect_left(self._names, prefix), bisect.bisect_right(self._names, after))
+        hi = bisect.bisect_left(self._names, prefix + _LAST)
+        return lo, hi
+
+    def _rarest(self, literal):
+        """Ids do trigrama de literal (len(literal) >= 3) com menos nomes."""
+        return min((self._trigrams.get(gram, ()) for gram in _trigrams(literal)), key=len)
+
+    def _matches(self, ids, after, match, limit, max_bytes):
+        by_id = self._by_id
+        names = (by_id[i] for i in ids)
+        found = (name for name in names if name is not None and name > after and match(name))
+        return take_page(heapq.nsmallest(limit + 1, found), limit, max_bytes)
+
+    def _scan(self, prefix, after, match, limit, max_bytes):
+        lo, hi = self._range(prefix, after)
+        names = self._names
+        return take_page((names[i] for i in range(lo, hi) if match(names[i])), limit, max_bytes)
+
+    def search(self, mode, pattern, after="", limit=DEFAULT_PAGE, max_bytes=MAX_PAGE_BYTES):
+        """
+        Uma página de nomes que casam com o padrão, em ordem, depois de after
+        (o último nome da página anterior; vazio na primeira). Devolve
+        (nomes, há mais?).
+        """
+        limit = max(1, min(limit, MAX_PAGE))
+        if mode == SEARCH_PREFIX:
+            lo, hi = self._range(pattern, after)
+            return take_page(self._names[lo:min(hi, lo + limit + 1)], limit, max_bytes)
+
+        if mode == SEARCH_SUBSTRING:
+            match = lambda name: pattern in name
+            if len(pattern) >= 3 and self.ready:
+                return self._matches(self._rarest(pattern), after, match, limit, max_bytes)
+            return self._scan("", after, match, limit, max_bytes)
+
+        if mode == SEARCH_GLOB:
+            match = re.compile(fnmatch.translate(pattern)).match  # mesma semântica do fnmatchcase
+            prefix = _WILDCARD.split(pattern, 1)[0]
+            # trechos literais antes do primeiro "[": dentro de um [...] nada é literal
+            literal = max(re.split(r"[*?]", pattern.split("[", 1)[0]), key=len)
+            if len(literal) >= 3 and self.ready:
+                ids = self._rarest(literal)
+                lo, hi = self._range(prefix, after)
+                if not prefix or len(ids) < hi - lo:
+                    return self._matches(ids, after, match, limit, max_bytes)
+            return self._scan(prefix, after, match, limit, max_bytes)
+
+        raise ProtocolError(f"modo de busca {mode} desconhecido")
@@ -0,0 +1,507 @@
+import random
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+# número de blocos pedidos em cada GET parcial
+CHUNK_BLOCKS = 64
+
+DEFAULT_MAX_DOWNLOADS = 4  # arquivos baixando ao mesmo tempo
+DEFAULT_MAX_CONNECTIONS = 16  # conexões de saída somadas de todos os downloads
+DEFAULT_HOLDER_TTL = 30.0  # segundos em que uma resposta do WHO_HAS dispensa o tracker
+MAX_CACHED_FILES = 1024  # arquivos com holders guardados no HolderCache
+
+
+def index_runs(indices) -> list:
+    """Agrupa índices em faixas contíguas: [0,1,2,5] -> [(0, 3), (5, 6)]."""
+    runs = []
+    for idx in sorted(indices):
+        if runs and runs[-1][1] == idx:
+            runs[-1][1] = idx + 1
+        else:
+            runs.append([idx, idx + 1])
+    return [(start, stop) for start, stop in runs]
+
+
+def clip_ranges(runs, total_blocks: int) -> list:
+    """Recorta faixas [(início, fim_exclusivo)] para [0, total_blocks)."""
+    clipped = []
+    for start, stop in runs:
+        start, stop = max(start, 0), min(stop, total_blocks)
+        if start < stop:
+            clipped.append((start, stop))
+    return clipped
+
+
+def format_ranges(indices) -> str:
+    """
+    Compacta uma lista de índices em faixas: [0,1,2,5,7,8] -> "0-2,5,7-8".
+    """
+    return ",".join(str(start) if stop - start == 1 else f"{start}-{stop - 1}"
+                    for start, stop in index_runs(indices))
+
+
+def parse_ranges(text: str, total_blocks: int) -> list:
+    """
+    Inverso de format_ranges, devolvendo faixas [(início, fim_exclusivo)].
+    Faixas fora de [0, total_blocks) são recortadas ou descartadas.
+    """
+    runs = []
+    for part in text.split(","):
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-", 1)
+            start, end = int(start), int(end)
+        else:
+            start = end = int(part)
+        runs.append((start, end + 1))
+    return clip_ranges(runs, total_blocks)
+
+
+class DownloadScheduler:
+    """
+    Divide os blocos de um arquivo entre os holders.
+
+    Cada holder começa com uma faixa contígua dos blocos, quebrada em pedaços
+    de CHUNK_BLOCKS. Quando a fila de um holder esvazia ele rouba pedaços do
+    final da fila que levaria mais tempo para esvaziar, dada a vazão medida
+    de cada holder (work stealing): os peers rápidos acabam assumindo o
+    trabalho dos lentos.
+
+    Quando não sobra nada para roubar (endgame), um holder ocioso pede de novo
+    o pedaço em andamento do holder mais lento. A primeira cópia que termina
+    vence e as outras são canceladas com on_cancel(holder).
+
+    Blocos corrompidos vão para uma fila de repetição e são pedidos
+    preferencialmente a outro holder.
+
+    Fontes parciais (peers que ainda estão baixando o arquivo, incluídos com
+    add_holder(holder, have)) não têm fila própria: a cada pedido levam até
+    chunk_blocks dos blocos pendentes que têm, os mais raros primeiro (os que
+    menos fontes vivas têm). Os holders completos também tiram da fila
+    primeiro o pedaço mais raro, deixando para as fontes parciais o que elas
+    podem servir. A ordem dos pedaços é embaralhada, para que downloaders
+    simultâneos peçam blocos diferentes aos seeders e depois troquem entre si.
+    """
+    EWMA_ALPHA = 0.3  # peso da medição mais recente na vazão de um holder
+    ENDGAME_COPIES = 2  # cópias simultâneas de um mesmo pedaço no endgame
+    PARTIAL_WAIT = 0.5  # espera de uma fonte parcial sem blocos úteis antes de pedir o bitmap de novo
+
+    def __init__(self, holders, blocks, chunk_blocks=CHUNK_BLOCKS, on_cancel=None):
+        blocks = sorted(blocks)
+        chunks = [blocks[i:i + chunk_blocks] for i in range(0, len(blocks), chunk_blocks)]
+        random.shuffle(chunks)
+        self._chunk_blocks = chunk_blocks
+
+        self._queues = {holder: deque() for holder in holders}
+        per_holder = -(-len(chunks) // len(holders)) if holders else 0
+        for i, holder in enumerate(holders):
+            self._queues[holder].extend(chunks[i * per_holder:(i + 1) * per_holder])
+        # sem holders completos no início, os pedaços ficam sem dono
+        self._pool = deque() if holders else deque(chunks)
+        self._have = {}  # fontes parciais: holder -> blocos que ele tem
+        self._sources = Counter()  # bloco -> fontes parciais vivas que o têm
+
+        self._retry = deque()  # (blocos, holders a evitar)
+        self._alive = set(holders)
+        self._running = {}  # holder -> pedaço em andamento (o mesmo objeto em todas as cópias)
+        self._cancelled = set()
+        self._on_cancel = on_cancel
+        self._rate = {}  # holder -> bytes/s (média móvel exponencial)
+        self._progress = {}  # holder -> (início do pedaço, bytes recebidos nele)
+        self._cond = threading.Condition()
+
+    def _speed(self, holder) -> float:
+        """Vazão atual do holder; conta também o pedaço em andamento, para um peer travado cair logo."""
+        rate = self._rate.get(holder)
+        if holder in self._progress:
+            started, received = self._progress[holder]
+            elapsed = time.monotonic() - started
+            if elapsed > 0.2:
+                rate = min(rate, received / elapsed) if rate is not None else received / elapsed
+        if rate is None:
+            # ainda sem medição: otimista, igual ao mais rápido conhecido
+            return max(self._rate.values(), default=1.0) or 1.0
+        return max(rate, 1e-9)
+
+    def _take_retry(self, holder):
+        for i, (chunk, avoid) in enumerate(self._retry):
+            # só aceita um bloco ruim de volta se nenhum outro holder puder pegá-lo
+            if holder not in avoid or not (self._alive - avoid):
+                del self._retry[i]
+                return chunk
+        return None
+
+    def _pending(self) -> bool:
+        return bool(self._retry or self._pool or any(self._queues.values()))
+
+    def _rarity(self):
+        """Função bloco -> quantas fontes vivas o têm."""
+        complete = sum(1 for holder in self._alive if holder not in self._have)
+        sources = self._sources
+        return lambda idx: complete + sources[idx]
+
+    def _count_have(self, holder, delta):
+        # mantém self._sources em dia com as fontes parciais vivas
+        if holder in self._alive and holder in self._have:
+            self._sources.update(dict.fromkeys(self._have[holder], delta))
+
+    def _pop_rarest(self, queue):
+        """Tira da fila o pedaço com os blocos mais raros (sem fontes parciais, o primeiro)."""
+        if not queue:
+            return None
+        if not any(holder in self._alive for holder in self._have):
+            return queue.popleft()
+        rarity = self._rarity()
+        best = min(range(len(queue)), key=lambda i: sum(map(rarity, queue[i])) / len(queue[i]))
+        chunk = queue[best]
+        del queue[best]
+        return chunk
+
+    def _take_available(self, holder):
+        """
+        Até chunk_blocks dos blocos pendentes que a fonte parcial tem, os mais
+        raros primeiro, tirados dos pedaços onde estavam; None se ela não tem
+        nenhum bloco pendente.
+        """
+        have = self._have[holder]
+        chunks = [chunk for chunk, avoid in self._retry if holder not in avoid]
+        chunks += self._pool
+        chunks += [chunk for queue in self._queues.values() for chunk in queue]
+        candidates = [idx for chunk in chunks for idx in chunk if idx in have]
+        if not candidates:
+            return None
+
+        rarity = self._rarity()
+        rarest = min(map(rarity, candidates))
+        candidates = sorted(idx for idx in candidates if rarity(idx) == rarest)
+        # uma janela contígua a partir de um ponto aleatório: fontes diferentes
+        # não disputam os mesmos blocos e o GET continua com poucas faixas
+        start = random.randrange(len(candidates))
+        taken = set((candidates[start:] + candidates[:start])[:self._chunk_blocks])
+
+        for chunk in chunks:
+            chunk[:] = [idx for idx in chunk if idx not in taken]
+        self._retry = deque((chunk, avoid) for chunk, avoid in self._retry if chunk)
+        self._pool = deque(chunk for chunk in self._pool if chunk)
+        for owner in list(self._queues):
+            self._queues[owner] = deque(chunk for chunk in self._queues[owner] if chunk)
+        return sorted(taken)
+
+    def _steal(self):
+        queued = [(len(queue) / self._speed(holder), queue) for holder, queue in self._queues.items() if queue]
+        if queued:
+            return max(queued, key=lambda item: item[0])[1].pop()
+        return None
+
+    def _endgame(self, holder):
+        copies = {}
+        for chunk in self._running.values():
+            copies[id(chunk)] = copies.get(id(chunk), 0) + 1
+        have = self._have.get(holder)
+        # a cópia de um holder cancelado já perdeu: o pedaço chegou por outro
+        candidates = [(self._speed(owner), chunk) for owner, chunk in self._running.items()
+                      if owner != holder and owner not in self._cancelled
+                      and copies[id(chunk)] < self.ENDGAME_COPIES
+                      and (have is None or have.issuperset(chunk))]
+        if candidates:
+            return min(candidates, key=lambda item: item[0])[1]
+        return None
+
+    def next_chunk(self, holder):
+        """
+        Próximo pedaço para o holder, ou None quando não resta trabalho.
+        Bloqueia enquanto outros holders ainda têm pedaços em andamento, pois
+        eles podem falhar e devolver blocos.
+
+        Uma fonte parcial sem nenhum bloco pendente espera até PARTIAL_WAIT
+        e então recebe []: atualize os blocos dela com set_have e peça de novo.
+        """
+        deadline = None
+        with self._cond:
+            while holder in self._alive:
+                if holder in self._have:
+                    chunk = self._take_available(holder) or self._endgame(holder)
+                    if chunk is None:
+                        if not self._pending() and not self._running:
+                            return None
+                        now = time.monotonic()
+                        if deadline is None:
+                            deadline = now + self.PARTIAL_WAIT
+                        elif now >= deadline:
+                            return []
+                        self._cond.wait(deadline - now)
+                        continue
+                else:
+                    chunk = self._take_retry(holder)
+                    if chunk is None:
+                        chunk = self._pop_rarest(self._queues[holder]) or self._pop_rarest(self._pool) \
+                            or self._steal()
+                    if chunk is None:
+                        chunk = self._endgame(holder)
+                if chunk is not None:
+                    self._running[holder] = chunk
+                    self._progress[holder] = (time.monotonic(), 0)
+                    return chunk
+                if not self._running:
+                    return None
+                self._cond.wait()
+            return None
+
+    def progress(self, holder, nbytes: int):
+        """Registra nbytes recebidos do holder no pedaço atual."""
+        with self._cond:
+            if holder in self._progress:
+                started, received = self._progress[holder]
+                self._progress[holder] = (started, received + nbytes)
+
+    def is_cancelled(self, holder) -> bool:
+        return holder in self._cancelled
+
+    def rate(self, holder) -> float:
+        """Vazão medida do holder em bytes/s (0 se ele não completou nenhum pedaço)."""
+        return self._rate.get(holder, 0.0)
+
+    def chunk_done(self, holder, missing=(), corrupt=(), failed=False) -> bool:
+        """
+        Encerra um pedaço. Blocos não recebidos voltam para a fila do holder
+        para serem roubados pelos demais; blocos corrompidos vão para a fila
+        de repetição, evitando o holder que os enviou.
+
+        Se o pedaço tinha outras cópias (endgame) e este holder terminou sem
+        falhar, as outras são canceladas; os blocos que elas ainda seguravam
+        voltam pela fila de repetição. Devolve True se esta cópia tinha sido
+        cancelada: a falha dela não é culpa do holder.
+        """
+        with self._cond:
+            chunk = self._running.pop(holder, None)
+            started, received = self._progress.pop(holder, (None, 0))
+            if received and not failed:
+                sample = received / max(time.monotonic() - started, 1e-6)
+                old = self._rate.get(holder)
+                self._rate[holder] = sample if old is None else \
+                    self.EWMA_ALPHA * sample + (1 - self.EWMA_ALPHA) * old
+
+            cancelled = holder in self._cancelled
+            self._cancelled.discard(holder)
+            others = [h for h, c in self._running.items() if c is chunk and h not in self._cancelled]
+            losers = others if not failed and not cancelled else []
+            self._cancelled.update(losers)
+
+            if missing and not cancelled:
+                if losers:
+                    # blocos reservados pelas cópias perdedoras
+                    self._retry.append((list(missing), set()))
+                elif not others:
+                    self._queues[holder].appendleft(list(missing))
+                # senão as outras cópias ainda cobrem o pedaço
+            if corrupt:
+                self._retry.append((list(corrupt), {holder}))
+            self._cond.notify_all()
+
+        for loser in losers:
+            if self._on_cancel:
+                self._on_cancel(loser)
+        return cancelled
+
+    def add_holder(self, holder, have=None) -> bool:
+        """
+        Inclui um holder descoberto no meio do download (PEX) ou uma fonte
+        parcial, com have = blocos que ela tem. Ele começa com a fila vazia e
+        pega trabalho roubando dos outros. Devolve False se o holder já era
+        conhecido.
+        """
+        with self._cond:
+            if holder in self._queues:
+                return False
+            self._queues[holder] = deque()
+            self._alive.add(holder)
+            if have is not None:
+                self._have[holder] = set(have)
+                self._count_have(holder, 1)
+            self._cond.notify_all()
+            return True
+
+    def set_have(self, holder, have):
+        """Atualiza os blocos de uma fonte parcial (None: ela completou o arquivo)."""
+        with self._cond:
+            self._count_have(holder, -1)
+            if have is None:
+                self._have.pop(holder, None)
+            else:
+                self._have[holder] = set(have)
+                self._count_have(holder, 1)
+            self._cond.notify_all()
+
+    def retire(self, holder):
+        """Remove um holder que falhou; a fila dele fica disponível para roubo."""
+        with self._cond:
+            self._count_have(holder, -1)
+            self._alive.discard(holder)
+            self._cond.notify_all()
+
+
+class HolderCache:
+    """
+    Holders conhecidos de cada arquivo ("ip:porta"), vindos do tracker
+    (WHO_HAS) ou de outros peers (PEX).
+
+    Uma resposta do tracker vale por ttl segundos: nesse prazo fresh()
+    devolve os holders sem consultar o tracker de novo. Vencida, a entrada
+    continua em known() como reserva para quando o tracker não responde.
+    Holders recebidos por PEX somam-se à entrada sem renovar o prazo, e um
+    holder que falhou sai com discard(). Guarda até max_files arquivos; os
+    usados há mais tempo saem primeiro.
+
+    complete() diz quais holders o tracker listou com o arquivo inteiro; os
+    demais (downloads em andamento, holders de PEX) podem ter só parte dele.
+    """
+    def __init__(self, ttl=DEFAULT_HOLDER_TTL, max_files=MAX_CACHED_FILES):
+        self.ttl = ttl
+        self.max_files = max_files
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # arquivo -> [vence em, {holder: tem o arquivo inteiro?}]
+
+    def _touch(self, filename):
+        # chamar com self._lock; cria a entrada (já vencida) se preciso
+        entry = self._entries.get(filename)
+        if entry is None:
+            entry = self._entries[filename] = [0.0, {}]
+            while len(self._entries) > self.max_files:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(filename)
+        return entry
+
+    def fresh(self, filename):
+        """Holders do arquivo se a última resposta do tracker ainda vale; senão None."""
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is None or entry[0] < time.monotonic() or not entry[1]:
+                return None
+            self._entries.move_to_end(filename)
+            return list(entry[1])
+
+    def known(self, filename) -> list:
+        """Todos os holders conhecidos do arquivo, vencidos ou não."""
+        with self._lock:
+            entry = self._entries.get(filename)
+            return list(entry[1]) if entry is not None else []
+
+    def complete(self, filename) -> set:
+        """Holders que o tracker listou com o arquivo inteiro."""
+        with self._lock:
+            entry = self._entries.get(filename)
+            return {h for h, full in entry[1].items() if full} if entry is not None else set()
+
+    def peers(self) -> list:
+        """Todos os peers conhecidos, de qualquer arquivo."""
+        with self._lock:
+            return list(dict.fromkeys(h for _, holders in self._entries.values() for h in holders))
+
+    def put(self, filename, holders, partial=()):
+        """
+        Resposta do tracker: substitui os holders do arquivo (e os que ainda o
+        estão baixando) e renova o prazo.
+        """
+        with self._lock:
+            if not holders and not partial:
+                self._entries.pop(filename, None)
+                return
+            entry = self._touch(filename)
+            entry[0] = time.monotonic() + self.ttl
+            entry[1] = dict.fromkeys(holders, True)
+            for holder in partial:
+                entry[1].setdefault(holder, False)
+
+    def merge(self, filename, holders) -> list:
+        """Holders vindos de outro peer (PEX); devolve os que eram novos."""
+        with self._lock:
+            entry = self._touch(filename)
+            new = [h for h in holders if h not in entry[1]]
+            entry[1].update(dict.fromkeys(new, False))
+            return new
+
+    def discard(self, filename, holder):
+        """Esquece um holder que não respondeu ou não tinha o arquivo."""
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is not None:
+                entry[1].pop(holder, None)
+                if not entry[1]:
+                    del self._entries[filename]
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "arquivos": len(self._entries),
+                "válidos": sum(1 for expires, _ in self._entries.values() if expires >= now),
+                "holders": sum(len(holders) for _, holders in self._entries.values()),
+            }
+
+
+class DownloadManager:
+    """
+    Coordena os downloads de um peer.
+
+    Pedidos simultâneos do mesmo arquivo viram uma única transferência
+    (single flight): todos recebem o mesmo Future. No máximo max_downloads
+    arquivos baixam ao mesmo tempo, e connection() limita as conexões de saída
+    de todos os downloads somados a max_connections.
+
+    download(filename, progress) faz o trabalho; progress(recebidos, total)
+    repassa o andamento para quem pediu o arquivo.
+    """
+    def __init__(self, download, max_downloads=DEFAULT_MAX_DOWNLOADS,
+                 max_connections=DEFAULT_MAX_CONNECTIONS):
+        self._download = download
+        self._pool = ThreadPoolExecutor(max_workers=max_downloads, thread_name_prefix="download")
+        self._connections = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()
+        self._active = {}  # arquivo -> Future
+        self._progress = {}  # arquivo -> (blocos recebidos, total ou None)
+        self._listeners = {}  # arquivo -> [callbacks de progresso]
+
+    def submit(self, filename, on_progress=None):
+        """Começa (ou reaproveita) o download do arquivo e devolve o Future dele."""
+        with self._lock:
+            future = self._active.get(filename)
+            if future is None:
+                self._progress[filename] = (0, None)
+                self._listeners[filename] = []
+                future = self._pool.submit(self._run, filename)
+                self._active[filename] = future
+            if on_progress is not None:
+                self._listeners[filename].append(on_progress)
+        return future
+
+    def _run(self, filename):
+        try:
+            return self._download(filename, lambda done, total: self._report(filename, done, total))
+        finally:
+            with self._lock:
+                self._active.pop(filename, None)
+                self._progress.pop(filename, None)
+                self._listeners.pop(filename, None)
+
+    def _report(self, filename, done, total):
+        with self._lock:
+            self._progress[filename] = (done, total)
+            listeners = list(self._listeners.get(filename, ()))
+        for listener in listeners:
+            listener(done, total)
+
+    def connection(self):
+        """Slot de conexão de saída: use com `with` em volta de cada conexão a um holder."""
+        return self._connections
+
+    def status(self) -> dict:
+        """Downloads em andamento: {arquivo: (blocos recebidos, total ou None)}."""
+        with self._lock:
+            return dict(self._progress)
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
@@ -1,35 +1,268 @@
+import hashlib
+import mmap
 import os
+import shutil
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from collections.abc import Mapping
+
 BLOCK_SIZE = 4096
 
+# tamanho de bloco escolhido por arquivo: potência de 2 entre BLOCK_SIZE e
+# MAX_BLOCK_SIZE, a menor que deixa o arquivo com até TARGET_BLOCKS blocos
+MAX_BLOCK_SIZE = 1024 * 1024
+TARGET_BLOCKS = 2048
+
+# downloads em andamento: <arquivo>.part com os dados e <arquivo>.part.map com o
+# bitmap, num subdiretório oculto que o catálogo não lista (é um diretório)
+PARTIAL_DIR = ".partial"
+PARTIAL_SUFFIX = ".part"
+BITMAP_SUFFIX = ".part.map"
+
+
+# compressão no GET: mídia e arquivos já comprimidos nem são testados; os demais
+# são amostrados uma vez (COMPRESSION_SAMPLES trechos espalhados pelo arquivo)
+INCOMPRESSIBLE_EXTENSIONS = {
+    ".mp4", ".mkv", ".avi", ".mov", ".webm", ".mp3", ".aac", ".ogg", ".opus", ".flac",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic",
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".7z", ".rar",
+}
+COMPRESSION_SAMPLES = 4
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+COMPRESSIBLE_RATIO = 0.9  # comprime se a amostra encolher para menos que isso
+
+# manifest: um SHA-1 por bloco, na ordem dos blocos
+DIGEST_SIZE = 20
+MANIFEST_SUFFIX = ".manifest"
+
+
+def block_size_for(size: int) -> int:
+    """Tamanho de bloco de um arquivo com size bytes: 4 KiB até 8 MiB, 1 MiB acima de 2 GiB."""
+    block_size = BLOCK_SIZE
+    while block_size < MAX_BLOCK_SIZE and size > block_size * TARGET_BLOCKS:
+        block_size *= 2
+    return block_size
+
+
+def bitmap_blocks(bitmap: bytes, total_blocks: int) -> set:
+    """Índices dos blocos marcados num bitmap (bit idx & 7 do byte idx >> 3)."""
+    return {idx for idx in range(total_blocks) if bitmap[idx >> 3] & (1 << (idx & 7))}
+
+
+def block_digest(block) -> bytes:
+    return hashlib.sha1(block).digest()
+
+
+def manifest_root(manifest: bytes) -> bytes:
+    """Identifica a versão do conteúdo: o hash da lista de hashes dos blocos."""
+    return hashlib.sha1(manifest).digest()
+
+
+class CorruptBlockError(ValueError):
+    """Blocos recebidos que não batem com o manifest."""
+    def __init__(self, blocks, written=0):
+        super().__init__(f"Blocks {blocks} do not match the manifest")
+        self.blocks = blocks
+        self.written = written
+
+
+def _open_for_read(file_path: str) -> int:
+    return os.open(file_path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+
+
+def _open_for_write(file_path: str) -> int:
+    return os.open(file_path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0))
+
+
+def _pread(fd: int, length: int, offset: int) -> bytes:
+    # os.pread não existe no Windows; lá usamos seek + read no mesmo descritor
+    if hasattr(os, "pread"):
+        return os.pread(fd, length, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, length)
+
+
+def _pwrite(fd: int, data: bytes, offset: int):
+    if hasattr(os, "pwrite"):
+        while data:
+            written = os.pwrite(fd, data, offset)
+            data = data[written:]
+            offset += written
+        return
+    os.lseek(fd, offset, os.SEEK_SET)
+    while data:
+        data = data[os.write(fd, data):]
+
+
+class BlockList(Mapping):
+    """
+    Visão preguiçosa {idx: bytes} dos blocos de um FILES.
+    Os blocos só são lidos do disco quando acessados.
+    """
+    def __init__(self, files):
+        self._files = files
+
+    def __len__(self):
+        return self._files.get_n_of_blocks()
+
+    def __iter__(self):
+        return iter(range(len(self)))
+
+    def __getitem__(self, idx):
+        try:
+            return self._files.get_block(idx)
+        except IndexError:
+            raise KeyError(idx)
+
+    def items(self):
+        # um único descritor para a varredura inteira, um bloco por vez em memória
+        return self._files.iter_blocks()
+
+
 class FILES:
     def __init__(self, file_path: str = None):
         self.file_path = file_path
         self.file_name = os.path.basename(file_path) if file_path else ""
         self.n_of_blocks = 0
         self.size = 0
+        self.mtime = 0
+        self.block_size = BLOCK_SIZE
+        self._manifests = {}  # block_size -> (chave, manifest)
+        self._manifest_lock = threading.Lock()  # um cálculo de manifest por vez
+        self._compressible = None
+        self._compressible_key = None
+        # só é usado por arquivos montados em memória (read_from_blocklist);
+        # arquivos em disco guardam apenas metadados e leem os blocos sob demanda
         self._blocks = {}
         if file_path:
-            self._read_from_file(file_path)
-        
-    def _read_from_file(self, file_path: str):
-        idx = 0
-        with open(file_path, 'rb') as f:
-            while True:
-                block = f.read(BLOCK_SIZE)
-                if not block:
-                    break
-                self._blocks[idx] = {'idx': idx, 'data': block}
-                idx += 1
+            self._read_metadata(file_path)
+
+    def _read_metadata(self, file_path: str):
+        st = os.stat(file_path)
+        self.size = st.st_size
+        self.mtime = st.st_mtime_ns
+        self.block_size = block_size_for(self.size)
+        self.n_of_blocks = (self.size + self.block_size - 1) // self.block_size
+
+    def refresh(self) -> bool:
+        """Relê os metadados do disco. Devolve True se o arquivo mudou."""
+        old = (self.size, self.mtime)
+        self._read_metadata(self.file_path)
+        return (self.size, self.mtime) != old
+
+    def _manifest_cache_path(self, cache_dir: str, block_size: int) -> str:
+        path = os.path.abspath(self.file_path)
+        if block_size != self.block_size:
+            path += f":{block_size}"
+        key = hashlib.sha1(path.encode()).hexdigest()
+        return os.path.join(cache_dir, key + MANIFEST_SUFFIX)
+
+    def cached_manifest(self, cache_dir: str = None, block_size: int = None):
+        """
+        O manifest, se já foi calculado para a versão atual do arquivo (em
+        memória ou no cache de cache_dir); None se ainda não foi. Não lê o
+        arquivo, então é barato de chamar a cada pedido.
+        """
+        if not self._on_disk():
+            return b"".join(block_digest(info['data']) for info in self._blocks.values())
+
+        self.refresh()
+        block_size = block_size or self.block_size
+        key = struct.pack("!QqI", self.size, self.mtime, block_size)
+        cached = self._manifests.get(block_size)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        if cache_dir:
+            try:
+                with open(self._manifest_cache_path(cache_dir, block_size), 'rb') as f:
+                    raw = f.read()
+            except OSError:
+                return None
+            if raw[:len(key)] == key and len(raw) == len(key) + self.count_blocks(block_size) * DIGEST_SIZE:
+                manifest = raw[len(key):]
+                self._manifests[block_size] = (key, manifest)
+                return manifest
+        return None
+
+    def get_manifest(self, cache_dir: str = None, block_size: int = None) -> bytes:
+        """
+        Hashes de todos os blocos, concatenados. O resultado fica em memória e,
+        se cache_dir for dado, em disco, indexado por caminho + tamanho + mtime:
+        só é recalculado quando o arquivo muda. block_size fatia o arquivo num
+        tamanho de bloco diferente do seu (o protocolo de texto usa BLOCK_SIZE).
+        Chamadas simultâneas esperam um único cálculo.
+        """
+        manifest = self.cached_manifest(cache_dir, block_size)
+        if manifest is not None:
+            return manifest
+
+        with self._manifest_lock:
+            # quem esperou o lock encontra o manifest que a outra chamada calculou
+            manifest = self.cached_manifest(cache_dir, block_size)
+            if manifest is not None:
+                return manifest
+            block_size = block_size or self.block_size
+            key = struct.pack("!QqI", self.size, self.mtime, block_size)
+            manifest = b"".join(block_digest(block) for _, block in self.iter_blocks(block_size=block_size))
+            self._store_manifest(key, manifest, cache_dir, block_size)
+            return manifest
+
+    def set_manifest(self, manifest: bytes, cache_dir: str = None):
+        """Guarda um manifest já conferido (o do download que gerou o arquivo), sem recalculá-lo."""
+        if not self._on_disk() or len(manifest) != self.n_of_blocks * DIGEST_SIZE:
+            return
+        key = struct.pack("!QqI", self.size, self.mtime, self.block_size)
+        self._store_manifest(key, manifest, cache_dir, self.block_size)
+
+    def _store_manifest(self, key: bytes, manifest: bytes, cache_dir: str, block_size: int):
+        if cache_dir:
+            cache_path = self._manifest_cache_path(cache_dir, block_size)
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(key + manifest)
+            os.replace(tmp_path, cache_path)
+        self._manifests[block_size] = (key, manifest)
+
+    def is_compressible(self) -> bool:
+        """
+        Diz se vale comprimir o arquivo no GET. A decisão sai de uma amostra
+        pequena e fica guardada até o arquivo mudar.
+        """
+        if not self._on_disk():
+            return False
+        key = (self.size, self.mtime)
+        if self._compressible_key == key:
+            return self._compressible
+
+        compressible = False
+        if os.path.splitext(self.file_name)[1].lower() not in INCOMPRESSIBLE_EXTENSIONS and self.size:
+            step = max(self.size // COMPRESSION_SAMPLES, COMPRESSION_SAMPLE_SIZE)
+            fd = _open_for_read(self.file_path)
+            try:
+                sample = b"".join(_pread(fd, COMPRESSION_SAMPLE_SIZE, offset)
+                                  for offset in range(0, self.size, step))
+            finally:
+                os.close(fd)
+            compressible = len(zlib.compress(sample, 1)) < len(sample) * COMPRESSIBLE_RATIO
+
+        self._compressible, self._compressible_key = compressible, key
+        return compressible
+
+    def _on_disk(self) -> bool:
+        return self.file_path is not None and not self._blocks
 
-            self.size = os.path.getsize(file_path)
-        self.n_of_blocks = idx
-    
     def _read_inblock(self, idx: int, block: bytes):
         if len(block) > BLOCK_SIZE:
             raise ValueError(f"Block size must be less than or equal to {BLOCK_SIZE} bytes")
         self._blocks[idx] = {'idx': idx, 'data': block}
 
     def read_from_blocklist(self, blocklist: dict, file_name: str):
+        self.file_path = None
         self.file_name = file_name
         self._blocks = {}
         self.size = 0  # reset size
@@ -41,32 +274,531 @@ class FILES:
         self.order_blocks()
         self.n_of_blocks = len(self._blocks)
 
-    def generate_blocklist(self) -> dict:
+    def generate_blocklist(self) -> Mapping:
+        if self._on_disk():
+            return BlockList(self)
         return {idx: info['data'] for idx, info in self._blocks.items()}
 
+    def iter_blocks(self, start: int = 0, end: int = None, block_size: int = None):
+        """
+        Gera (idx, bloco) em ordem, lendo do disco um bloco por vez. Arquivos
+        em disco podem ser fatiados num block_size diferente do seu.
+        """
+        if not self._on_disk():
+            end = self.n_of_blocks if end is None else min(end, self.n_of_blocks)
+            for idx in range(start, end):
+                yield idx, self._blocks[idx]['data']
+            return
+
+        block_size = block_size or self.block_size
+        n_blocks = self.count_blocks(block_size)
+        end = n_blocks if end is None else min(end, n_blocks)
+        with open(self.file_path, 'rb') as f:
+            f.seek(start * block_size)
+            for idx in range(start, end):
+                block = f.read(block_size)
+                if not block:
+                    break
+                yield idx, block
+
+    def read_run(self, start: int, stop: int, block_size: int = None) -> bytes:
+        """Blocos [start, stop) de um arquivo em disco, numa única leitura."""
+        block_size = block_size or self.block_size
+        offset = start * block_size
+        length = min(stop * block_size, self.size) - offset
+        fd = _open_for_read(self.file_path)
+        try:
+            return _pread(fd, length, offset)
+        finally:
+            os.close(fd)
+
     def set_n_of_blocks(self, n: int):
-        if n> 0 and n <= len(self._blocks):
+        if n > 0 and n <= self.get_n_of_blocks():
             self.n_of_blocks = n
 
     def get_block(self, idx: int) -> bytes:
-        if idx in self._blocks:
-            return self._blocks[idx]['data']
-        else:
+        if not self._on_disk():
+            if idx in self._blocks:
+                return self._blocks[idx]['data']
             raise IndexError("Block index out of range")
 
-    def order_blocks(self): 
+        if idx < 0 or idx >= self.n_of_blocks:
+            raise IndexError("Block index out of range")
+        fd = _open_for_read(self.file_path)
+        try:
+            return _pread(fd, self.block_size, idx * self.block_size)
+        finally:
+            os.close(fd)
+
+    def order_blocks(self):
         #ordena pelos indices
         self._blocks = dict(sorted(self._blocks.items()))
 
     def get_n_of_blocks(self) -> int:
+        if self._on_disk():
+            return self.count_blocks()
         return len(self._blocks)
 
+    def count_blocks(self, block_size: int = None) -> int:
+        block_size = block_size or self.block_size
+        return (self.size + block_size - 1) // block_size
+
     def save_to_disk(self, directory: str):
         if not os.path.exists(directory):
             os.makedirs(directory)
 
         file_path = os.path.join(directory, self.file_name)
 
+        if self._on_disk():
+            if os.path.abspath(file_path) != os.path.abspath(self.file_path):
+                shutil.copyfile(self.file_path, file_path)
+            return
+
         with open(file_path, 'wb') as f:
             for idx in range(self.n_of_blocks):
-                f.write(self._blocks[idx]['data'])
\ No newline at end of file
+                f.write(self._blocks[idx]['data'])
+
+
+class BlockCache:
+    """
+    Cache LRU de blocos em memória para quem serve arquivos, limitado a
+    budget bytes.
+
+    A chave inclui caminho, tamanho e mtime do arquivo, então um arquivo
+    alterado nunca devolve blocos velhos; invalidate() ainda libera o espaço
+    deles na hora. Um bloco só entra no cache no segundo pedido dentro da
+    janela do porteiro (DOORKEEPER blocos lembrados): leituras únicas de
+    arquivos frios seguem direto do disco e não expulsam os blocos quentes.
+    """
+    DOORKEEPER = 65536
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._blocks = OrderedDict()  # chave -> bytes, do menos para o mais recente
+        self._seen = OrderedDict()  # chaves pedidas uma vez, ainda fora do cache
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _keys(f: "FILES", block_size: int, start: int, stop: int):
+        return [(f.file_path, f.size, f.mtime, block_size, idx) for idx in range(start, stop)]
+
+    def lookup(self, f: "FILES", block_size: int, start: int, stop: int):
+        """
+        Procura os blocos [start, stop). Devolve (dados, admitir): dados é None
+        se algum bloco falta no cache, e admitir diz se vale lê-los e guardá-los
+        com put() por já terem sido pedidos antes.
+        """
+        if self.budget <= 0:
+            return None, False
+        keys = self._keys(f, block_size, start, stop)
+        with self._lock:
+            blocks = []
+            for key in keys:
+                block = self._blocks.get(key)
+                if block is None:
+                    break
+                blocks.append(block)
+            if len(blocks) == len(keys):
+                for key in keys:
+                    self._blocks.move_to_end(key)
+                self.hits += len(keys)
+                return b"".join(blocks), False
+
+            self.misses += len(keys)
+            admit = keys[0] in self._seen
+            for key in keys:
+                self._seen[key] = None
+                self._seen.move_to_end(key)
+            while len(self._seen) > self.DOORKEEPER:
+                self._seen.popitem(last=False)
+            return None, admit
+
+    def put(self, f: "FILES", block_size: int, start: int, data: bytes):
+        """Guarda os blocos contíguos de data a partir de start, expulsando os menos usados."""
+        if len(data) > self.budget:
+            return
+        view = memoryview(data)
+        stop = start + (len(data) + block_size - 1) // block_size
+        with self._lock:
+            for i, key in enumerate(self._keys(f, block_size, start, stop)):
+                block = bytes(view[i * block_size:(i + 1) * block_size])
+                old = self._blocks.pop(key, None)
+                if old is not None:
+                    self.size -= len(old)
+                self._blocks[key] = block
+                self.size += len(block)
+                self._seen.pop(key, None)
+            while self.size > self.budget:
+                _, old = self._blocks.popitem(last=False)
+                self.size -= len(old)
+                self.evictions += 1
+
+    def invalidate(self, file_path: str):
+        """Descarta todos os blocos de um arquivo (ele mudou ou sumiu)."""
+        with self._lock:
+            for key in [key for key in self._blocks if key[0] == file_path]:
+                self.size -= len(self._blocks.pop(key))
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "bytes": self.size,
+                "budget": self.budget,
+                "blocks": len(self._blocks),
+                "evictions": self.evictions,
+            }
+
+
+class FileCatalog:
+    """
+    Catálogo incremental dos arquivos compartilhados de um diretório.
+
+    refresh() só varre o diretório (os.scandir, apenas metadados) quando o
+    mtime do diretório muda, o que acontece sempre que um arquivo é criado,
+    removido ou renomeado. Um arquivo reescrito no lugar não muda o mtime do
+    diretório, então sem varredura refresh() ainda faz um stat por arquivo.
+    Arquivos com mesmo tamanho e mtime reaproveitam o FILES anterior. A
+    versão, que é o que o tracker compara, avança quando muda um nome, um
+    tamanho ou um mtime.
+    """
+    # mtimes muito recentes podem esconder uma segunda mudança no mesmo tick
+    RACY_WINDOW = 2.0
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.version = 0
+        self._files = {}
+        self._dir_mtime = None
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def _dir_unchanged(self, dir_mtime: int) -> bool:
+        if dir_mtime != self._dir_mtime:
+            return False
+        return time.time() - dir_mtime / 1e9 > self.RACY_WINDOW
+
+    def _scan(self):
+        # chamar com self._lock: (nome, caminho, stat) de cada arquivo do diretório
+        with os.scandir(self.directory) as entries:
+            return [(entry.name, entry.path, entry.stat()) for entry in entries if entry.is_file()]
+
+    def _restat(self):
+        # chamar com self._lock: os mesmos nomes de antes, com o stat de agora
+        found = []
+        for name, f in self._files.items():
+            try:
+                found.append((name, f.file_path, os.stat(f.file_path)))
+            except FileNotFoundError:
+                continue  # removido entre o stat do diretório e este
+        return found
+
+    def refresh(self) -> bool:
+        """Atualiza o catálogo. Devolve True se um nome, tamanho ou mtime mudou."""
+        with self._lock:
+            dir_mtime = os.stat(self.directory).st_mtime_ns
+            found = self._restat() if self._dir_unchanged(dir_mtime) else self._scan()
+
+            files = {}
+            changed = self._dir_mtime is None or len(found) != len(self._files)
+            for name, path, st in found:
+                known = self._files.get(name)
+                if known is not None and (known.size, known.mtime) == (st.st_size, st.st_mtime_ns):
+                    files[name] = known
+                else:
+                    files[name] = FILES(path)
+                    changed = True
+
+            self._files = files
+            self._dir_mtime = dir_mtime
+            if changed:
+                self.version += 1
+            return changed
+
+    def add(self, f: "FILES"):
+        """Registra um arquivo recém-baixado (substitui um de mesmo nome, e a versão avança)."""
+        with self._lock:
+            self._files[f.file_name] = f
+            self.version += 1
+
+    def get(self, file_name: str):
+        return self._files.get(file_name)
+
+    def names(self) -> list:
+        return list(self._files)
+
+    def __iter__(self):
+        return iter(list(self._files.values()))
+
+    def __len__(self):
+        return len(self._files)
+
+
+class DownloadSink:
+    """
+    Destino de um download em andamento.
+
+    Pré-aloca <arquivo>.part com o tamanho final e grava cada bloco direto no
+    seu offset assim que ele chega. Os blocos concluídos ficam num bitmap em
+    <arquivo>.part.map, então um download interrompido pode ser retomado
+    pedindo só os blocos que faltam. Os dois ficam em <diretório>/.partial,
+    fora do catálogo; um arquivo compartilhado que termina em .part não se
+    confunde com eles.
+
+    Com um manifest, cada bloco é conferido antes de ser gravado e o bitmap
+    só é reaproveitado se o conteúdo remoto for a mesma versão.
+
+    O .part também fica mapeado em memória: claim_run entrega a região de um
+    trecho para o socket escrever nela com recv_into, e commit_run confere os
+    blocos ali mesmo, sem nenhuma cópia dos dados em Python.
+    """
+    _HEADER = struct.Struct("!QII20s")  # tamanho total, número e tamanho dos blocos, raiz do manifest
+    FLUSH_EVERY = 64  # blocos gravados entre duas atualizações do bitmap
+
+    def __init__(self, directory: str, file_name: str, total_size: int, total_blocks: int,
+                 manifest: bytes = None, block_size: int = BLOCK_SIZE):
+        partial_dir = os.path.join(directory, PARTIAL_DIR)
+        os.makedirs(partial_dir, exist_ok=True)
+        self.file_name = file_name
+        self.path = os.path.join(directory, file_name)
+        self.part_path = os.path.join(partial_dir, file_name + PARTIAL_SUFFIX)
+        self.map_path = os.path.join(partial_dir, file_name + BITMAP_SUFFIX)
+        self.total_size = total_size
+        self.total_blocks = total_blocks
+        self.block_size = block_size
+        self.manifest = manifest
+        self._root = manifest_root(manifest) if manifest is not None else bytes(DIGEST_SIZE)
+        self._lock = threading.Lock()
+        self._bitmap = bytearray((total_blocks + 7) // 8)
+        self._done = 0
+        self._unflushed = 0
+        self._claimed = set()  # blocos sendo recebidos direto no mapa
+
+        if not os.path.exists(self.map_path):
+            self._adopt_legacy()
+        resumed = self._load_bitmap() and os.path.exists(self.part_path)
+        if not resumed:
+            self._bitmap = bytearray(len(self._bitmap))
+            self._done = 0
+
+        self._fd = _open_for_write(self.part_path)
+        if os.fstat(self._fd).st_size != total_size:
+            os.ftruncate(self._fd, total_size)
+            if hasattr(os, "posix_fallocate") and total_size:
+                try:
+                    os.posix_fallocate(self._fd, 0, total_size)
+                except OSError:
+                    pass  # sistema de arquivos sem suporte: fica esparso
+        self._map = mmap.mmap(self._fd, total_size) if total_size else None
+        self._flush_bitmap()
+
+    def _read_bitmap(self, map_path: str):
+        """Bitmap gravado em map_path, se ele for deste mesmo download; senão None."""
+        try:
+            with open(map_path, 'rb') as f:
+                raw = f.read()
+        except OSError:
+            return None
+
+        header = self._HEADER.size
+        if len(raw) != header + len(self._bitmap):
+            return None
+        if self._HEADER.unpack(raw[:header]) != (self.total_size, self.total_blocks, self.block_size, self._root):
+            return None
+        return raw[header:]
+
+    def _load_bitmap(self) -> bool:
+        bitmap = self._read_bitmap(self.map_path)
+        if bitmap is None:
+            return False
+        self._bitmap = bytearray(bitmap)
+        self._done = sum(bin(byte).count("1") for byte in self._bitmap)
+        return True
+
+    def _adopt_legacy(self):
+        # downloads interrompidos antes do .partial deixaram <arquivo>.part e
+        # .part.map ao lado dos arquivos; só são movidos se o bitmap for deste
+        # download, para não tocar num arquivo compartilhado de mesmo nome
+        legacy_part = self.path + PARTIAL_SUFFIX
+        legacy_map = self.path + BITMAP_SUFFIX
+        if self._read_bitmap(legacy_map) is None or not os.path.isfile(legacy_part):
+            return
+        os.replace(legacy_part, self.part_path)
+        os.replace(legacy_map, self.map_path)
+
+    def _flush_bitmap(self):
+        tmp_path = f"{self.map_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(self._HEADER.pack(self.total_size, self.total_blocks, self.block_size, self._root))
+            f.write(self._bitmap)
+        os.replace(tmp_path, self.map_path)
+        self._unflushed = 0
+
+    def _block_length(self, idx: int) -> int:
+        if idx == self.total_blocks - 1:
+            return self.total_size - idx * self.block_size
+        return self.block_size
+
+    def _verify(self, idx: int, block) -> bool:
+        if self.manifest is None:
+            return True
+        return block_digest(block) == self.manifest[idx * DIGEST_SIZE:(idx + 1) * DIGEST_SIZE]
+
+    def has_block(self, idx: int) -> bool:
+        return bool(self._bitmap[idx >> 3] & (1 << (idx & 7)))
+
+    def write_block(self, idx: int, data: bytes) -> bool:
+        """Grava o bloco no seu offset. Devolve False se ele já estava no disco."""
+        return self.write_run(idx, data) == 1
+
+    def _run_end(self, first_idx: int, nbytes: int) -> int:
+        """Último bloco de um trecho de nbytes a partir de first_idx, validando o tamanho."""
+        block_size = self.block_size
+        n_blocks = max(1, (nbytes + block_size - 1) // block_size)
+        last_idx = first_idx + n_blocks - 1
+        if first_idx < 0 or last_idx >= self.total_blocks:
+            raise IndexError("Block index out of range")
+        expected = (n_blocks - 1) * block_size + self._block_length(last_idx)
+        if nbytes != expected:
+            raise ValueError(f"Blocks {first_idx}-{last_idx} have {nbytes} bytes, expected {expected}")
+        return last_idx
+
+    def _bad_blocks(self, first_idx: int, last_idx: int, view: memoryview) -> set:
+        block_size = self.block_size
+        return {idx for idx in range(first_idx, last_idx + 1)
+                if not self._verify(idx, view[(idx - first_idx) * block_size:(idx - first_idx + 1) * block_size])}
+
+    def _mark_done(self, blocks):
+        # chamado com self._lock
+        for idx in blocks:
+            self._bitmap[idx >> 3] |= 1 << (idx & 7)
+        self._done += len(blocks)
+        self._unflushed += len(blocks)
+        if self._unflushed >= self.FLUSH_EVERY:
+            self._flush_bitmap()
+
+    def write_run(self, first_idx: int, data: bytes) -> int:
+        """
+        Grava uma sequência de blocos contíguos começando em first_idx, com uma
+        única escrita. Devolve quantos desses blocos ainda não estavam no disco.
+        Blocos que não batem com o manifest não são gravados: os demais são, e
+        em seguida é levantado CorruptBlockError com os índices ruins.
+        """
+        block_size = self.block_size
+        last_idx = self._run_end(first_idx, len(data))
+        view = memoryview(data)
+        bad = self._bad_blocks(first_idx, last_idx, view)
+
+        with self._lock:
+            # blocos reservados por claim_run são de quem os reservou
+            new = [idx for idx in range(first_idx, last_idx + 1)
+                   if not self.has_block(idx) and idx not in bad and idx not in self._claimed]
+            if len(new) == last_idx - first_idx + 1:
+                _pwrite(self._fd, data, first_idx * block_size)
+            else:
+                for idx in new:
+                    offset = (idx - first_idx) * block_size
+                    _pwrite(self._fd, view[offset:offset + block_size], idx * block_size)
+            self._mark_done(new)
+
+        if bad:
+            raise CorruptBlockError(sorted(bad), written=len(new))
+        return len(new)
+
+    def claim_run(self, first_idx: int, nbytes: int):
+        """
+        Reserva a região de um trecho no .part para ser preenchida direto do
+        socket. Devolve um memoryview gravável sobre o arquivo mapeado, ou None
+        se algum dos blocos já está no disco ou reservado (use write_run).
+        Todo claim termina em commit_run ou release_run.
+        """
+        last_idx = self._run_end(first_idx, nbytes)
+        if self._map is None:
+            return None
+        run = range(first_idx, last_idx + 1)
+        with self._lock:
+            if any(self.has_block(idx) or idx in self._claimed for idx in run):
+                return None
+            self._claimed.update(run)
+        offset = first_idx * self.block_size
+        return memoryview(self._map)[offset:offset + nbytes]
+
+    def commit_run(self, first_idx: int, view: memoryview) -> int:
+        """
+        Conclui um claim_run já preenchido: confere os blocos no próprio mapa e
+        marca os bons no bitmap. Como write_run, levanta CorruptBlockError.
+        """
+        last_idx = first_idx + max(len(view) - 1, 0) // self.block_size
+        try:
+            bad = self._bad_blocks(first_idx, last_idx, view)
+        finally:
+            view.release()
+
+        with self._lock:
+            self._claimed.difference_update(range(first_idx, last_idx + 1))
+            new = [idx for idx in range(first_idx, last_idx + 1) if idx not in bad]
+            self._mark_done(new)
+
+        if bad:
+            raise CorruptBlockError(sorted(bad), written=len(new))
+        return len(new)
+
+    def release_run(self, first_idx: int, view: memoryview):
+        """Desiste de um claim_run (a conexão caiu no meio do trecho)."""
+        last_idx = first_idx + max(len(view) - 1, 0) // self.block_size
+        view.release()
+        with self._lock:
+            self._claimed.difference_update(range(first_idx, last_idx + 1))
+
+    def received_count(self) -> int:
+        return self._done
+
+    def bitmap(self) -> bytes:
+        """Cópia do bitmap dos blocos já gravados (para anunciar a outros peers)."""
+        with self._lock:
+            return bytes(self._bitmap)
+
+    def missing_blocks(self) -> list:
+        return [idx for idx in range(self.total_blocks) if not self.has_block(idx)]
+
+    def is_complete(self) -> bool:
+        return self._done == self.total_blocks
+
+    def close(self):
+        """Fecha o download deixando .part e bitmap prontos para retomar."""
+        with self._lock:
+            if self._fd is None:
+                return
+            self._flush_bitmap()
+            self._close_fd()
+
+    def _close_fd(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        os.close(self._fd)
+        self._fd = None
+
+    def finalize(self) -> str:
+        """Move o .part para o nome final e apaga o bitmap."""
+        with self._lock:
+            if self._fd is not None:
+                self._close_fd()
+            try:
+                os.replace(self.part_path, self.path)
+            except FileNotFoundError:
+                # outro download do mesmo arquivo já finalizou
+                if not os.path.exists(self.path):
+                    raise
+            try:
+                os.remove(self.map_path)
+            except FileNotFoundError:
+                pass
+        return self.path
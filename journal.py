@@ -0,0 +1,189 @@
+import os
+import re
+
+from protocol import (
+    HEADER, Payload, ProtocolError, pack_blob, pack_frame, pack_str, pack_u16, pack_u32, parse_header,
+)
+
+# registros do journal, gravados como quadros do protocol.py (o id do pedido fica 0)
+REC_PEER = 1  # peer_id, ip, porta (u16), versão do catálogo (u32), nomes: estado completo de um peer
+REC_NEW_FILE = 2  # peer_id, nome
+REC_REMOVE = 3  # peer_id
+REC_SNAPSHOT = 4  # geração (u32), número de peers (u32): abre o arquivo de snapshot
+
+DEFAULT_SNAPSHOT_EVERY = 10000  # registros no journal antes de compactar num snapshot novo
+
+SNAPSHOT_FILE = "snapshot"
+_JOURNAL_FILE = re.compile(r"journal\.(\d+)$")
+
+
+def _pack_names(names) -> bytes:
+    # nomes separados por NUL, que não aparece em nome de arquivo: bem mais
+    # rápido de ler e gravar em Python que o front coding do protocolo
+    return pack_blob("\0".join(names).encode())
+
+
+def _unpack_names(p) -> set:
+    raw = p.blob().decode()
+    return set(raw.split("\0")) if raw else set()
+
+
+def _records(data: bytes):
+    """
+    Quadros (tipo, payload) de um arquivo. Para no primeiro quadro incompleto
+    ou inválido: o final de uma escrita interrompida por uma queda.
+    """
+    pos = 0
+    records = []
+    while pos + HEADER.size <= len(data):
+        try:
+            rec_type, _, length = parse_header(data[pos:pos + HEADER.size])
+        except ProtocolError:
+            break
+        end = pos + HEADER.size + length
+        if end > len(data):
+            break
+        records.append((rec_type, data[pos + HEADER.size:end]))
+        pos = end
+    return records
+
+
+class TrackerJournal:
+    """
+    Estado do tracker em disco: um snapshot compacto mais um journal
+    append-only com os eventos posteriores (REGISTER, NEW_FILE, saída de um
+    peer, catálogo atualizado pelo VERIFY_FILES).
+
+    Cada snapshot tem uma geração g e cobre tudo até a abertura de
+    journal.g; os eventos seguintes vão para journal.g. Na carga o snapshot
+    é lido e os journals de geração >= g são reaplicados em ordem, então uma
+    queda no meio de uma compactação não perde nada.
+
+    As escritas vão para o sistema operacional a cada evento (sobrevivem a
+    uma queda do processo); só o snapshot é sincronizado com fsync.
+    """
+    def __init__(self, directory, snapshot_every=DEFAULT_SNAPSHOT_EVERY):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        os.makedirs(directory, exist_ok=True)
+        self.generation = 0
+        self.records = 0  # registros em journals ainda não compactados
+        self._file = None
+
+    def _journal_path(self, generation):
+        return os.path.join(self.directory, f"journal.{generation:08d}")
+
+    def _journals(self):
+        """[(geração, caminho)] dos journals no diretório, em ordem."""
+        found = []
+        for name in os.listdir(self.directory):
+            match = _JOURNAL_FILE.match(name)
+            if match:
+                found.append((int(match.group(1)), os.path.join(self.directory, name)))
+        return sorted(found)
+
+    def load(self) -> dict:
+        """
+        Reconstrói o estado salvo: {peer_id: {"ip", "port", "version", "files"}}.
+        Não abre o journal para escrita; chame open() em seguida.
+        """
+        peers = {}
+        generation = 0
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                records = _records(f.read())
+            if records and records[0][0] == REC_SNAPSHOT:
+                generation = Payload(records[0][1]).u32()
+                for rec_type, payload in records[1:]:
+                    self._apply(peers, rec_type, payload)
+
+        for gen, journal in self._journals():
+            if gen < generation:
+                continue
+            with open(journal, "rb") as f:
+                records = _records(f.read())
+            for rec_type, payload in records:
+                self._apply(peers, rec_type, payload)
+            self.records += len(records)
+            generation = gen
+        self.generation = generation
+        return peers
+
+    def open(self):
+        """
+        Começa um journal novo para os próximos eventos, sem snapshot: um final
+        corrompido do journal anterior fica para trás e é ignorado na carga.
+        """
+        self.generation += 1
+        self._file = open(self._journal_path(self.generation), "ab")
+
+    @staticmethod
+    def _apply(peers, rec_type, payload):
+        p = Payload(payload)
+        if rec_type == REC_PEER:
+            peer_id, ip, port, version, files = p.str(), p.str(), p.u16(), p.u32(), _unpack_names(p)
+            peers[peer_id] = {"ip": ip, "port": str(port), "version": version or None, "files": files}
+        elif rec_type == REC_NEW_FILE:
+            peer_id, filename = p.str(), p.str()
+            if peer_id in peers:
+                peers[peer_id]["files"].add(filename)
+        elif rec_type == REC_REMOVE:
+            peers.pop(p.str(), None)
+
+    @staticmethod
+    def _pack_peer(peer_id, info) -> bytes:
+        return pack_frame(REC_PEER, 0, pack_str(peer_id) + pack_str(info["ip"]) + pack_u16(int(info["port"]))
+                          + pack_u32(info["version"] or 0) + _pack_names(info["files"]))
+
+    def _append(self, record: bytes):
+        self._file.write(record)
+        self._file.flush()
+        self.records += 1
+
+    # eventos: chamar com o lock do tracker, na mesma ordem em que o estado muda
+
+    def peer(self, peer_id, info):
+        self._append(self._pack_peer(peer_id, info))
+
+    def new_file(self, peer_id, filename):
+        self._append(pack_frame(REC_NEW_FILE, 0, pack_str(peer_id) + pack_str(filename)))
+
+    def remove(self, peer_id):
+        self._append(pack_frame(REC_REMOVE, 0, pack_str(peer_id)))
+
+    def needs_compaction(self) -> bool:
+        return self.records >= self.snapshot_every
+
+    def rotate(self, peers) -> tuple:
+        """
+        Começa uma geração nova: os próximos eventos vão para um journal vazio
+        e devolve (geração, snapshot serializado) do estado atual. Chamar com o
+        lock do tracker; depois, fora dele, write_snapshot(geração, dados).
+        """
+        data = b"".join(self._pack_peer(peer_id, info) for peer_id, info in peers.items())
+        self.generation += 1
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self._journal_path(self.generation), "ab")
+        self.records = 0
+        header = pack_frame(REC_SNAPSHOT, 0, pack_u32(self.generation) + pack_u32(len(peers)))
+        return self.generation, header + data
+
+    def write_snapshot(self, generation, data):
+        """Grava o snapshot de forma atômica e apaga os journals que ele já cobre."""
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        for gen, journal in self._journals():
+            if gen < generation:
+                os.remove(journal)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
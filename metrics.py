@@ -0,0 +1,225 @@
+import bisect
+import math
+import threading
+import time
+
+# limites dos baldes dos histogramas: progressão geométrica de razão 2^(1/4)
+# (~19% de erro num percentil) de 1e-6 a 1e6, boa para segundos e MB/s
+_GROWTH = 2 ** 0.25
+BOUNDS = [1e-6 * _GROWTH ** i for i in range(int(math.log(1e12, _GROWTH)) + 1)]
+RATE_WINDOW = 10.0  # segundos mínimos cobertos pela taxa recente dos contadores
+
+
+class Counter:
+    """Contador monotônico."""
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+
+class Gauge:
+    """Valor que sobe e desce (conexões ativas, por exemplo)."""
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+    def dec(self, n=1):
+        with self._lock:
+            self.value -= n
+
+    # `with gauge:` conta algo em andamento (uma conexão aberta, por exemplo)
+    def __enter__(self):
+        self.inc()
+        return self
+
+    def __exit__(self, *exc):
+        self.dec()
+
+
+class Histogram:
+    """
+    Distribuição em baldes de largura logarítmica: registrar custa um bisect,
+    e os percentis saem dos baldes, sem guardar as amostras.
+    """
+    __slots__ = ("count", "total", "min", "max", "_buckets", "_lock")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self._buckets = [0] * (len(BOUNDS) + 1)
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        idx = bisect.bisect_left(BOUNDS, value)
+        with self._lock:
+            self.count += 1
+            self.total += value
+            self._buckets[idx] += 1
+            if value < self.min:
+                self.min = value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, p):
+        """Estimativa do percentil p (0-100): o meio geométrico do balde, limitado a [min, max]."""
+        with self._lock:
+            if not self.count:
+                return None
+            rank = max(1, math.ceil(self.count * p / 100))
+            seen = 0
+            for idx, n in enumerate(self._buckets):
+                seen += n
+                if seen >= rank:
+                    break
+            low = BOUNDS[idx - 1] if idx else 0.0
+            high = BOUNDS[idx] if idx < len(BOUNDS) else self.max
+            estimate = math.sqrt(low * high) if low else high
+            return min(max(estimate, self.min), self.max)
+
+    def summary(self) -> dict:
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean": self.total / self.count,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+        }
+
+
+class Metrics:
+    """
+    Registro de contadores, gauges e histogramas de um processo, cada um
+    identificado por nome e, opcionalmente, um rótulo (o holder, o comando...).
+
+    Pensado para caminhos quentes: buscar uma métrica que já existe não pega
+    lock, e registrar um valor custa um lock sem disputa. Ainda assim, registre
+    por trecho/pedido, não por bloco.
+    """
+    def __init__(self):
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._metrics = {}  # (tipo, nome, rótulo) -> métrica
+        # marcas (instante, {(nome, rótulo): valor}) dos contadores, uma a cada
+        # RATE_WINDOW no máximo: a taxa recente é medida contra a mais nova que
+        # tenha pelo menos RATE_WINDOW, e as mais velhas que ela são descartadas
+        self._marks = [(self.started, {})]
+
+    def _get(self, cls, name, label):
+        key = (cls, name, label)
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(key, cls())
+        return metric
+
+    def counter(self, name, label="") -> Counter:
+        return self._get(Counter, name, label)
+
+    def gauge(self, name, label="") -> Gauge:
+        return self._get(Gauge, name, label)
+
+    def histogram(self, name, label="") -> Histogram:
+        return self._get(Histogram, name, label)
+
+    def snapshot(self) -> dict:
+        """
+        Foto de todas as métricas, serializável em JSON:
+        {"uptime": s, "counters": {nome: {rótulo: valor}}, "rates": {nome: {rótulo: valor/s}},
+         "rate_interval": s, "lifetime_rates": {nome: {rótulo: valor/s}},
+         "gauges": {...}, "histograms": {nome: {rótulo: resumo}}}.
+        "rates" é a taxa nos últimos rate_interval segundos (entre RATE_WINDOW e
+        2*RATE_WINDOW, se as fotos são frequentes) e "lifetime_rates", a média
+        desde o início do processo.
+        """
+        now = time.monotonic()
+        uptime = now - self.started
+        with self._lock:
+            items = list(self._metrics.items())
+        counters = {(name, label): metric.value for (cls, name, label), metric in items if cls is Counter}
+        with self._lock:
+            marks = self._marks
+            idx = len(marks) - 1
+            while idx and now - marks[idx][0] < RATE_WINDOW:
+                idx -= 1
+            since, before = marks[idx]
+            del marks[:idx]
+            if now - marks[-1][0] >= RATE_WINDOW:
+                marks.append((now, counters))
+        interval = now - since
+
+        snap = {"uptime": uptime, "counters": {}, "rates": {}, "rate_interval": interval, "lifetime_rates": {},
+                "gauges": {}, "histograms": {}}
+        for (cls, name, label), metric in sorted(items, key=lambda item: item[0][1:]):
+            if cls is Counter:
+                value = counters[name, label]
+                snap["counters"].setdefault(name, {})[label] = value
+                recent = value - before.get((name, label), 0)
+                snap["rates"].setdefault(name, {})[label] = recent / interval if interval else 0.0
+                snap["lifetime_rates"].setdefault(name, {})[label] = value / uptime if uptime else 0.0
+            elif cls is Gauge:
+                snap["gauges"].setdefault(name, {})[label] = metric.value
+            else:
+                snap["histograms"].setdefault(name, {})[label] = metric.summary()
+        return snap
+
+
+def _value(v):
+    if isinstance(v, float):
+        return f"{v:.6g}"
+    return str(v)
+
+
+def format_snapshot(snap) -> str:
+    """Texto legível de um snapshot (o de Metrics.snapshot, com seções extras opcionais)."""
+    lines = [f"uptime: {snap.get('uptime', 0):.1f}s"]
+    rates, lifetime = snap.get("rates", {}), snap.get("lifetime_rates", {})
+    interval = snap.get("rate_interval")
+    for name, series in snap.get("counters", {}).items():
+        for label, value in series.items():
+            rate = rates.get(name, {}).get(label)
+            average = lifetime.get(name, {}).get(label)
+            tag = f"{name}[{label}]" if label else name
+            if rate is not None and average is not None:
+                lines.append(f"  {tag}: {value} ({rate:.6g}/s nos últimos {interval:.0f}s, {average:.6g}/s no total)")
+            else:
+                lines.append(f"  {tag}: {value}" + (f" ({rate:.6g}/s)" if rate is not None else ""))
+    for name, series in snap.get("gauges", {}).items():
+        for label, value in series.items():
+            lines.append(f"  {name}[{label}]: {value}" if label else f"  {name}: {value}")
+    for name, series in snap.get("histograms", {}).items():
+        for label, summary in series.items():
+            tag = f"{name}[{label}]" if label else name
+            if not summary.get("count"):
+                lines.append(f"  {tag}: vazio")
+                continue
+            lines.append(f"  {tag}: n={summary['count']} média={_value(summary['mean'])} "
+                         f"p50={_value(summary['p50'])} p95={_value(summary['p95'])} "
+                         f"p99={_value(summary['p99'])} máx={_value(summary['max'])}")
+    for section, values in snap.items():
+        if section in ("uptime", "counters", "rates", "rate_interval", "lifetime_rates", "gauges", "histograms"):
+            continue
+        # seções extras (cache do peer, downloads...) são dicionários simples
+        if not values:
+            continue
+        lines.append(f"{section}:")
+        for key, value in values.items():
+            lines.append(f"  {key}: {_value(value)}")
+    return "\n".join(lines)
@@ -1,43 +1,191 @@
+import json
 import socket
 import threading
 import os
 import time
 import sys
 import struct
-from file import FILES
+import argparse
+from collections import deque
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+from file import (
+    FILES, FileCatalog, BlockCache, DownloadSink, CorruptBlockError, DIGEST_SIZE, BLOCK_SIZE, bitmap_blocks,
+)
+from download import (
+    DEFAULT_HOLDER_TTL, DEFAULT_MAX_CONNECTIONS, DEFAULT_MAX_DOWNLOADS, DownloadManager, DownloadScheduler,
+    HolderCache, clip_ranges, index_runs, parse_ranges,
+)
+from protocol import (
+    MSG_GET, MSG_META, MSG_MANIFEST, MSG_VERIFY_FILES, MSG_REGISTER, MSG_WHO_HAS, MSG_NEW_FILE,
+    MSG_DISCONNECT, MSG_STATS, MSG_PEX, MSG_HAVE, MSG_BITFIELD, MSG_BITMAP, MSG_SNAPSHOT, MSG_OK, MSG_ERROR,
+    MSG_HOLDERS, MSG_FILES_OK, MSG_WHO_HAS_MANY, MSG_HOLDERS_MANY, MSG_SEARCH, MSG_SEARCH_RESULT,
+    SEARCH_GLOB, SEARCH_PREFIX, SEARCH_SUBSTRING,
+    MSG_CATALOG, MSG_FILE_META, MSG_BUSY, MSG_NOT_READY, Payload, ProtocolError, PeerBusy, NotReady, pack_blob, pack_frame, pack_names,
+    pack_ranges, pack_str, pack_u8, pack_u16, pack_u32, pack_u64, pack_codecs, peek_magic, recv_frame,
+    RUN_HEADER, COMPRESSED_RUN_HEADER, CODECS, CODEC_NONE, compress, decompress,
+)
+from metrics import Metrics, format_snapshot
+from tracker import MAX_WHO_HAS_BATCH, TRACKER_PORT
+from tracker_client import TrackerSession
 from tests import benchmark, stress_test
 
-if len(sys.argv) != 4:
-    print("Missing arguments. Usage: python peer.py <PEER_ID> <PORT> <TRACKER_IP>")
-    sys.exit(1)
+RUN_BYTES = 1024 * 1024  # máximo de bytes (blocos contíguos) enviados sob um único header
+MAX_STRIKES = 3  # blocos corrompidos tolerados de um mesmo peer por download
+MAX_BUSY = 5  # respostas BUSY seguidas antes de desistir de um peer
+DEFAULT_WORKERS = 16  # threads que atendem conexões
+DEFAULT_UPLOAD_SLOTS = 4  # GETs servidos ao mesmo tempo
+DEFAULT_QUEUE = 32  # conexões esperando uma thread livre antes de recusar
+SLOT_WAIT = 0.5  # espera máxima por um slot de upload antes de responder BUSY
+SEND_BUFFER = 256 * 1024  # buffer de envio de cada conexão
+REQUEST_TIMEOUT = 5  # segundos para o pedido chegar numa conexão aceita, antes de fechá-la
+SEND_TIMEOUT = 30  # segundos com o envio parado (downloader que não lê) antes de fechar a conexão
+DEFAULT_CACHE_MB = 64  # memória para os blocos mais pedidos
+DEFAULT_CODECS = "zlib"  # codecs oferecidos nos GETs, em ordem de preferência
+COMPRESS_AHEAD = 4  # trechos sendo comprimidos à frente do envio
+PEX_MAX = 32  # holders trocados em cada mensagem de PEX
+PEX_FANOUT = 4  # peers consultados por PEX quando o tracker não responde
+PEX_TIMEOUT = 2  # prazo de cada um deles
+HAVE_INTERVAL = 10  # segundos entre dois anúncios (HAVE) de um download em andamento ao tracker
+HAVE_POLL = 0.5  # intervalo entre as checagens do primeiro bloco recebido, antes do primeiro HAVE
+MAX_STALLS = 20  # bitmaps seguidos sem blocos úteis antes de desistir de uma fonte parcial
+MANIFEST_RETRY = 0.25  # primeira espera por um manifest que o holder ainda calcula (dobra a cada NOT_READY)
+MANIFEST_RETRY_MAX = 4.0  # espera máxima entre duas tentativas
+MANIFEST_WAIT = 300  # segundos esperando os holders calcularem o manifest antes de desistir
 
-TRACKER = (sys.argv[3], 8000)
-PEER_ID = sys.argv[1]
-PORT = int(sys.argv[2])
+def parse_codecs(text):
+    try:
+        return [CODECS[name] for name in text.split(",") if name]
+    except KeyError as e:
+        raise argparse.ArgumentTypeError(f"codec desconhecido: {e.args[0]} (use {', '.join(CODECS)})")
+
+
+parser = argparse.ArgumentParser(description="Peer da rede P2P",
+                                 usage="python peer.py <PEER_ID> <PORT> <TRACKER_IP> [opções]")
+parser.add_argument("peer_id")
+parser.add_argument("port", type=int)
+parser.add_argument("tracker_ip")
+parser.add_argument("--tracker-port", type=int, default=TRACKER_PORT,
+                    help="porta do tracker")
+parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                    help="threads que atendem conexões de outros peers")
+parser.add_argument("--upload-slots", type=int, default=DEFAULT_UPLOAD_SLOTS,
+                    help="uploads (GET) atendidos ao mesmo tempo; o excedente recebe BUSY")
+parser.add_argument("--queue", type=int, default=DEFAULT_QUEUE,
+                    help="conexões aguardando uma thread livre antes de serem recusadas")
+parser.add_argument("--max-downloads", type=int, default=DEFAULT_MAX_DOWNLOADS,
+                    help="arquivos baixados ao mesmo tempo; os demais esperam na fila")
+parser.add_argument("--max-connections", type=int, default=DEFAULT_MAX_CONNECTIONS,
+                    help="conexões de saída somadas de todos os downloads")
+parser.add_argument("--cache-mb", type=int, default=DEFAULT_CACHE_MB,
+                    help="MiB de blocos quentes mantidos em memória para upload (0 desliga)")
+parser.add_argument("--codecs", type=parse_codecs, default=DEFAULT_CODECS,
+                    help="compressões aceitas nos downloads, por preferência: zlib, lzma ou none")
+parser.add_argument("--holder-ttl", type=float, default=DEFAULT_HOLDER_TTL,
+                    help="segundos em que a resposta do tracker a um WHO_HAS é reaproveitada (0 desliga)")
+parser.add_argument("-v", "--verbose", action="store_true",
+                    help="loga cada trecho de blocos recebido (deixa downloads grandes mais lentos)")
+args = parser.parse_args()
+
+TRACKER = (args.tracker_ip, args.tracker_port)
+PEER_ID = args.peer_id
+PORT = args.port
 PEER_FILES = f"{PEER_ID}/files"
-SIZE_BLOCK = 4096
+
+class ReceiveBuffer:
+    """Buffers pré-alocados de uma thread de download, reaproveitados a cada trecho."""
+    def __init__(self, size):
+        self.header = bytearray(max(RUN_HEADER.size, COMPRESSED_RUN_HEADER.size))
+        self.view = memoryview(bytearray(size))
+
 
 class Peer:
-    def __init__(self, peer_id, port, files_dir):
+    def __init__(self, peer_id, port, files_dir, workers=DEFAULT_WORKERS,
+                 upload_slots=DEFAULT_UPLOAD_SLOTS, queue=DEFAULT_QUEUE,
+                 max_downloads=DEFAULT_MAX_DOWNLOADS, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 cache_bytes=DEFAULT_CACHE_MB * 1024 * 1024, codecs=(CODECS[DEFAULT_CODECS],),
+                 verbose=False, holder_ttl=DEFAULT_HOLDER_TTL):
         self.peer_id = peer_id
         self.port = port
+        self.address = None  # "ip:porta" como o tracker o anuncia, definido no registro
+        # verbose: loga cada trecho recebido; o resto vai para as métricas (comando stats)
+        self.verbose = verbose
+        self.metrics = Metrics()
+        self._connections_in = self.metrics.gauge("connections_in")
+        self._connections_out = self.metrics.gauge("connections_out")
+        self._blocks_sent = self.metrics.counter("blocks_sent")
+        self._blocks_received = self.metrics.counter("blocks_received")
 
-        self.files = self.__get_files_from_dir(files_dir)
+        self.catalog = FileCatalog(files_dir)
 
         self.registered = False
+        # uma única conexão com o tracker, reaproveitada por todos os comandos
+        self.tracker = TrackerSession(TRACKER)
+        # holders de cada arquivo, do tracker ou trocados com outros peers (PEX)
+        self.holders = HolderCache(holder_ttl)
+        # downloads deste peer: um por arquivo, com orçamento global de conexões
+        self.downloads = DownloadManager(self.request_file, max_downloads, max_connections)
+        # envia os blocos com sendfile direto do descritor do arquivo;
+        # os mais pedidos saem da memória
+        self.zero_copy = True
+        self.block_cache = BlockCache(cache_bytes)
+        # compressão negociada por GET; o upload comprime num pool à parte
+        self.codecs = [codec for codec in codecs if codec != CODEC_NONE]
+        self._compressors = ThreadPoolExecutor(max_workers=os.cpu_count() or 2, thread_name_prefix="compress")
         self._dir = files_dir
+        # downloads em andamento: arquivo -> DownloadSink. Os blocos que já
+        # chegaram são servidos a outros peers antes de o arquivo completar
+        self._sinks = {}
+        self._sinks_lock = threading.Lock()
+        # manifests (hashes por bloco) ficam em <peer_id>/cache. São calculados
+        # em segundo plano, um arquivo por vez, a partir da varredura do
+        # catálogo; um MANIFEST que chega antes recebe NOT_READY
+        self._cache_dir = os.path.join(os.path.dirname(files_dir), "cache")
+        self._hash_queue = Queue()
+        self._hashing = set()  # caminhos com manifest na fila
+        self._hashing_lock = threading.Lock()
+        threading.Thread(target=self._hash_manifests, daemon=True, name="manifest").start()
+        self._prepare_manifests()
         self.peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.peer_socket.bind(("0.0.0.0", self.port))
-        self.peer_socket.listen(5)
+
+        # conexões são atendidas por um pool fixo; no máximo upload_slots GETs
+        # ao mesmo tempo, e além de workers + queue conexões pendentes o peer
+        # responde BUSY na hora para o downloader procurar outro holder
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._max_pending = workers + queue
+        self.peer_socket.listen(self._max_pending)
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._upload_slots = threading.BoundedSemaphore(upload_slots)
     
-    def __get_files_from_dir(self, files_dir):
-        files = []
-        for file in os.listdir(files_dir):
-            file_path = os.path.join(files_dir, file)
-            if os.path.isfile(file_path):
-                f = FILES(file_path)
-                files.append(f)
-        return files
+    @property
+    def files(self):
+        return list(self.catalog)
+
+    def _prepare_manifest(self, f):
+        """Põe o cálculo do manifest de f na fila, se ele ainda não está lá."""
+        with self._hashing_lock:
+            if f.file_path in self._hashing:
+                return
+            self._hashing.add(f.file_path)
+        self._hash_queue.put(f)
+
+    def _hash_manifests(self):
+        while True:
+            f = self._hash_queue.get()
+            try:
+                f.get_manifest(self._cache_dir)  # só lê o cache, se ele já estiver no disco
+            except Exception as e:
+                print(f"[ERROR] Falha ao calcular o manifest de {f.file_name}: {e}")
+            finally:
+                with self._hashing_lock:
+                    self._hashing.discard(f.file_path)
+
+    def _prepare_manifests(self):
+        for f in self.catalog:
+            if f.file_path:
+                self._prepare_manifest(f)
     
     def _get_my_ip(self):
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -50,182 +198,836 @@ class Peer:
         while True:
             try:
                 connection, address = self.peer_socket.accept()
-                threading.Thread(target=self.handle_request, args=(connection, address)).start()
+                connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER)
+                # uma conexão ociosa ou com o pedido pela metade não prende um worker para sempre
+                accepted = time.monotonic()
+                connection.settimeout(REQUEST_TIMEOUT)
+
+                with self._pending_lock:
+                    full = self._pending >= self._max_pending
+                    if not full:
+                        self._pending += 1
+                if full:
+                    self._reject(connection)
+                    continue
+                self._pool.submit(self._serve, connection, address, accepted)
             except KeyboardInterrupt:
                 print("Disconnecting peer...")
                 self.peer_socket.close()
                 sys.exit(0)
+
+    def _serve(self, connection, address, accepted):
+        started = time.perf_counter()
+        # o prazo do pedido conta desde o accept: quem esperou na fila por um
+        # worker não ganha outro REQUEST_TIMEOUT inteiro
+        connection.settimeout(max(accepted + REQUEST_TIMEOUT - time.monotonic(), 0.01))
+        try:
+            with self._connections_in:
+                command = self.handle_request(connection, address)
+            if command:
+                self.metrics.counter("requests", command).inc()
+                self.metrics.histogram("serve_time", command).observe(time.perf_counter() - started)
+        finally:
+            with self._pending_lock:
+                self._pending -= 1
+
+    def _reject(self, connection, request_id=0):
+        self.metrics.counter("busy_sent").inc()
+        try:
+            connection.sendall(pack_frame(MSG_BUSY, request_id, pack_str("peer ocupado")))
+        except OSError:
+            pass
+        connection.close()
     
     def handle_request(self, connection, address):
+        # pedidos chegam em quadros binários (protocol.py) ou, por
+        # compatibilidade, como texto "COMANDO arquivo [argumento]".
+        # Devolve o comando atendido (para as métricas), ou None se ele não chegou inteiro
+        request_id = 0
         try:
-            data = connection.recv(4096).decode()
+            framed = peek_magic(connection)
+            if framed:
+                frame = recv_frame(connection)
+                if frame is None:
+                    connection.close()
+                    return
+                msg_type, request_id, payload = frame
+            else:
+                data = connection.recv(4096).decode()
+        except socket.timeout:
+            self.metrics.counter("idle_closed").inc()
+            connection.close()
+            return
         except Exception as e:
             print(f"[ERROR] Falha ao receber dados de {address}: {e}")
             connection.close()
             return
+        connection.settimeout(SEND_TIMEOUT)
+
+        def reply(msg_type, payload, legacy):
+            connection.sendall(pack_frame(msg_type, request_id, payload) if framed else legacy)
+
+        def reply_meta(f, extra=b"", codec=CODEC_NONE):
+            # extra: o manifest (MANIFEST) ou os holders da troca de PEX (GET).
+            # O protocolo de texto antigo só conhece blocos de BLOCK_SIZE, sem compressão
+            reply(MSG_FILE_META, pack_u32(f.get_n_of_blocks()) + pack_u64(f.size) + pack_u32(f.block_size)
+                  + pack_u8(codec) + extra,
+                  struct.pack("!II", f.count_blocks(BLOCK_SIZE), f.size) + extra)
 
         try:
-            command, filename = data.split()
-        except ValueError:
-            print(f"[ERROR] Comando inválido recebido: {data}")
+            if framed:
+                command, filename, arg, offered, known = self._decode_request(msg_type, payload)
+            else:
+                command, filename, *args = data.split()
+                arg = args[0] if args else None
+                offered, known = [], None
+        except (ValueError, ProtocolError) as e:
+            print(f"[ERROR] Comando inválido recebido de {address}: {e}")
+            if framed:
+                connection.sendall(pack_frame(MSG_ERROR, request_id, pack_str(str(e))))
             connection.close()
             return
 
-        
+        f = self.catalog.get(filename) if filename is not None else None
+        sink = None
+        if f is None and filename is not None and framed:
+            with self._sinks_lock:
+                sink = self._sinks.get(filename)
+        if command in ("GET", "META", "MANIFEST") and f is None:
+            if sink is not None:
+                self._serve_partial(connection, address, request_id, command, sink, arg, known)
+            elif framed:
+                connection.sendall(pack_frame(MSG_ERROR, request_id, pack_str(f"arquivo {filename} não encontrado")))
+            connection.close()
+            return command
+
         if command == "GET":
-            for f in self.files:
-                if f.file_name == filename:
-                    try:
+            # GET <arquivo> [faixas]: sem faixas o arquivo inteiro é enviado
+            if not self._upload_slots.acquire(timeout=SLOT_WAIT):
+                if framed:
+                    self._reject(connection, request_id)
+                else:
+                    connection.close()
+                return command
+            sent = self.metrics.counter("bytes_sent", address[0])
+            try:
+                if f.refresh():
+                    self.block_cache.invalidate(f.file_path)
 
-                        blocks = f.generate_blocklist()
-                        total_blocks = len(blocks)
-                        total_size = f.size
-                        connection.sendall(struct.pack("!II", total_blocks, total_size))
+                block_size = f.block_size if framed else BLOCK_SIZE
+                total_blocks = f.count_blocks(block_size)
+                codec = self._choose_codec(f, offered)
+                # PEX: quem mandou os holders que conhece recebe os nossos de volta
+                exchange = b"" if known is None else pack_names(self._pex_holders(filename, known))
+                reply_meta(f, exchange, codec=codec)
 
-                        for idx, block in blocks.items():
-                            header = struct.pack("!II", idx, len(block))
+                if not arg:
+                    runs = [(0, total_blocks)]
+                elif framed:
+                    runs = clip_ranges(arg, total_blocks)
+                else:
+                    runs = parse_ranges(arg, total_blocks)
+
+                if codec != CODEC_NONE:
+                    self._send_compressed_runs(connection, f, runs, block_size, codec, sent)
+                elif self.zero_copy and f.file_path and framed:
+                    self._send_runs(connection, f, runs, block_size, sent)
+                else:
+                    # o cliente de texto espera um header por bloco de BLOCK_SIZE
+                    for start, stop in runs:
+                        for idx, block in f.iter_blocks(start, stop, block_size):
+                            header = RUN_HEADER.pack(idx, len(block))
                             connection.sendall(header + block)
-                    except Exception as e:
-                        print(f"[ERROR] Falha ao enviar arquivo {filename}: {e}")
+                            sent.inc(len(block))
+                        self._blocks_sent.inc(stop - start)
+            except Exception as e:
+                print(f"[ERROR] Falha ao enviar arquivo {filename}: {e}")
+            finally:
+                self._upload_slots.release()
+
+        elif command == "MANIFEST":
+            try:
+                if framed:
+                    manifest = f.cached_manifest(self._cache_dir)
+                    if manifest is None:
+                        self._prepare_manifest(f)
+                        self.metrics.counter("manifest_not_ready").inc()
+                        reply(MSG_NOT_READY, pack_str(f"manifest de {filename} em cálculo"), b"")
+                    else:
+                        reply_meta(f, manifest)
+                else:
+                    # o cliente de texto não sabe tentar de novo: espera o cálculo
+                    # (um só por arquivo, mesmo com vários pedidos ao mesmo tempo)
+                    reply_meta(f, f.get_manifest(self._cache_dir, BLOCK_SIZE))
+            except Exception as e:
+                print(f"[ERROR] Falha ao enviar manifest de {filename}: {e}")
+
+        elif command == "META":
+            try:
+                f.refresh()
+                reply_meta(f)
+            except Exception as e:
+                print(f"[ERROR] Falha ao enviar meta-info de {filename}: {e}")
 
         elif command == "VERIFY_FILES":
-            requested_files = filename.split(",")
-            self.files = self.__get_files_from_dir(self._dir)
-            current_file_names = [f.file_name for f in self.files]
+            if self.catalog.refresh():
+                self._prepare_manifests()
+            version = self.catalog.version
+            names = self.catalog.names()
 
-            if set(requested_files) == set(current_file_names):
-                connection.sendall(b"FILES_OK")
-            else:
-                new_files_list = ",".join(current_file_names)
-                response = f"New files list: {new_files_list}"
-                connection.sendall(response.encode())
+            try:
+                if framed:
+                    # VERIFY_FILES <versão do catálogo conhecida pelo tracker>
+                    if arg == version:
+                        connection.sendall(pack_frame(MSG_FILES_OK, request_id))
+                    else:
+                        connection.sendall(pack_frame(MSG_CATALOG, request_id,
+                                                      pack_u32(version) + pack_names(names)))
+                elif set(filename.split(",")) == set(names):
+                    # tracker antigo: VERIFY_FILES <nomes que ele conhece, separados por vírgula>
+                    connection.sendall(b"FILES_OK")
+                else:
+                    connection.sendall(f"New files list: {','.join(names)}".encode())
+            except Exception as e:
+                print(f"[ERROR] Falha ao responder VERIFY_FILES: {e}")
+
+        elif command == "STATS":
+            try:
+                reply(MSG_SNAPSHOT, json.dumps(self.stats()).encode(), b"")
+            except Exception as e:
+                print(f"[ERROR] Falha ao enviar métricas: {e}")
+
+        elif command == "BITFIELD":
+            # bitmap vazio: este peer tem o arquivo inteiro
+            try:
+                if f is not None:
+                    reply(MSG_BITMAP, pack_u32(f.get_n_of_blocks()) + pack_blob(b""), b"")
+                elif sink is not None:
+                    reply(MSG_BITMAP, pack_u32(sink.total_blocks) + pack_blob(sink.bitmap()), b"")
+                else:
+                    reply(MSG_ERROR, pack_str(f"arquivo {filename} não encontrado"), b"")
+            except Exception as e:
+                print(f"[ERROR] Falha ao enviar o bitmap de {filename}: {e}")
+
+        elif command == "PEX":
+            try:
+                holders = self._pex_holders(filename, known, include_self=True)
+                reply(MSG_HOLDERS, pack_names(holders), b"")
+            except Exception as e:
+                print(f"[ERROR] Falha ao responder PEX de {filename}: {e}")
         connection.close()
+        return command
+
+    def _decode_request(self, msg_type, payload):
+        """
+        (comando, arquivo, argumento, codecs aceitos, holders conhecidos) de um
+        pedido binário; os holders são None se o pedido não trouxe PEX.
+        """
+        p = Payload(payload)
+        if msg_type == MSG_GET:
+            filename, ranges = p.str(), p.ranges()
+            offered = p.codecs() if p.more() else []
+            return "GET", filename, ranges, offered, p.names() if p.more() else None
+        if msg_type == MSG_META:
+            return "META", p.str(), None, [], None
+        if msg_type == MSG_MANIFEST:
+            return "MANIFEST", p.str(), None, [], None
+        if msg_type == MSG_VERIFY_FILES:
+            return "VERIFY_FILES", None, p.u32(), [], None
+        if msg_type == MSG_STATS:
+            return "STATS", None, None, [], None
+        if msg_type == MSG_PEX:
+            return "PEX", p.str(), None, [], p.names()
+        if msg_type == MSG_BITFIELD:
+            return "BITFIELD", p.str(), None, [], None
+        raise ProtocolError(f"tipo de mensagem {msg_type} inesperado")
+
+    def _learn(self, filename, holders) -> list:
+        """Guarda holders recebidos de outro peer; devolve os que eram novos."""
+        valid = []
+        for holder in holders[:PEX_MAX]:
+            ip, _, port = holder.rpartition(":")
+            if ip and port.isdigit() and holder != self.address:
+                valid.append(holder)
+        new = self.holders.merge(filename, valid)
+        if new:
+            self.metrics.counter("pex_learned").inc(len(new))
+        return new
+
+    def _pex_holders(self, filename, known, include_self=False) -> list:
+        """
+        Troca de PEX: guarda os holders que o outro peer conhece e devolve
+        até PEX_MAX dos nossos que ele não citou (e este peer, se pedido e se
+        ele tem o arquivo).
+        """
+        self._learn(filename, known)
+        known = set(known)
+        holders = [h for h in self.holders.known(filename) if h not in known]
+        if include_self and self.address and (self.catalog.get(filename) is not None or filename in self._sinks):
+            holders.insert(0, self.address)
+        return holders[:PEX_MAX]
     
-    def _recvn(self, sock, n):
-        data = b''
-        while len(data) < n:
-            packet = sock.recv(n - len(data))
-            if not packet:
-                return None
-            data += packet
+    def _serve_partial(self, connection, address, request_id, command, sink, ranges, known):
+        """
+        GET/META/MANIFEST de um arquivo que este peer ainda está baixando:
+        servido do .part via sendfile, só com os blocos que já chegaram (o
+        downloader pede os que o bitmap do BITFIELD anunciou) e sem compressão.
+        """
+        def meta(extra=b""):
+            return pack_frame(MSG_FILE_META, request_id, pack_u32(sink.total_blocks) + pack_u64(sink.total_size)
+                              + pack_u32(sink.block_size) + pack_u8(CODEC_NONE) + extra)
+
+        if command != "GET":
+            manifest = sink.manifest if command == "MANIFEST" and sink.manifest is not None else b""
+            try:
+                connection.sendall(meta(manifest))
+            except OSError as e:
+                print(f"[ERROR] Falha ao enviar meta-info de {sink.file_name}: {e}")
+            return
+
+        if not self._upload_slots.acquire(timeout=SLOT_WAIT):
+            self._reject(connection, request_id)
+            return
+        sent = self.metrics.counter("bytes_sent", address[0])
+        more = getattr(socket, "MSG_MORE", 0)
+        try:
+            exchange = b"" if known is None else pack_names(self._pex_holders(sink.file_name, known))
+            runs = clip_ranges(ranges, sink.total_blocks) if ranges else [(0, sink.total_blocks)]
+            # aberto antes de responder: se o download terminar agora, o .part
+            # renomeado continua legível por este descritor
+            with open(sink.part_path, 'rb') as fp:
+                connection.sendall(meta(exchange))
+                for run_start, run_stop in self._split_runs(runs, sink.block_size):
+                    # um bloco marcado no bitmap já está inteiro no .part
+                    present = index_runs(idx for idx in range(run_start, run_stop) if sink.has_block(idx))
+                    for start, stop in present:
+                        offset = start * sink.block_size
+                        count = min(stop * sink.block_size, sink.total_size) - offset
+                        connection.sendall(RUN_HEADER.pack(start, count), more)
+                        connection.sendfile(fp, offset, count)
+                        sent.inc(count)
+                        self._blocks_sent.inc(stop - start)
+            self.metrics.counter("partial_uploads").inc()
+        except Exception as e:
+            print(f"[ERROR] Falha ao enviar blocos de {sink.file_name} (download em andamento): {e}")
+        finally:
+            self._upload_slots.release()
+
+    def _choose_codec(self, f, offered):
+        """Primeiro codec aceito pelo cliente, se o arquivo vale a compressão."""
+        if not offered or not f.file_path or not f.is_compressible():
+            return CODEC_NONE
+        return next((codec for codec in offered if codec in CODECS.values() and codec != CODEC_NONE), CODEC_NONE)
+
+    def _split_runs(self, runs, block_size):
+        """Quebra as faixas pedidas em trechos de até RUN_BYTES."""
+        run_blocks = max(1, RUN_BYTES // block_size)
+        for start, stop in runs:
+            for run_start in range(start, stop, run_blocks):
+                yield run_start, min(run_start + run_blocks, stop)
+
+    def _cached_run(self, f, block_size, run_start, run_stop):
+        """Dados do trecho se ele está (ou deve entrar) no block_cache; senão None."""
+        data, admit = self.block_cache.lookup(f, block_size, run_start, run_stop)
+        if data is None and admit:
+            data = f.read_run(run_start, run_stop, block_size)
+            self.block_cache.put(f, block_size, run_start, data)
         return data
+
+    def _send_runs(self, connection, f, runs, block_size, sent):
+        """
+        Envia as faixas em trechos de até RUN_BYTES de blocos contíguos: um
+        header (primeiro bloco, bytes) seguido dos dados. Trechos quentes saem
+        do block_cache; os demais vão via sendfile, sem passar pelo Python.
+        sent conta os bytes enviados.
+        """
+        more = getattr(socket, "MSG_MORE", 0)  # junta header e dados no mesmo segmento
+        with open(f.file_path, 'rb') as fp:
+            for run_start, run_stop in self._split_runs(runs, block_size):
+                offset = run_start * block_size
+                count = min(run_stop * block_size, f.size) - offset
+                data = self._cached_run(f, block_size, run_start, run_stop)
+                if data is not None:
+                    count = len(data)
+                connection.sendall(RUN_HEADER.pack(run_start, count), more)
+                if data is not None:
+                    connection.sendall(data)
+                else:
+                    connection.sendfile(fp, offset, count)
+                sent.inc(count)
+                self._blocks_sent.inc(run_stop - run_start)
+
+    def _send_compressed_runs(self, connection, f, runs, block_size, codec, sent):
+        """
+        Como _send_runs, mas cada trecho leva um COMPRESSED_RUN_HEADER e vai
+        comprimido. A compressão roda no pool _compressors, até COMPRESS_AHEAD
+        trechos à frente do envio; um trecho que não encolhe vai cru.
+        """
+        def pack_run(run_start, run_stop):
+            data = self._cached_run(f, block_size, run_start, run_stop)
+            if data is None:
+                data = f.read_run(run_start, run_stop, block_size)
+            packed = compress(codec, data)
+            blocks = run_stop - run_start
+            if len(packed) < len(data):
+                return COMPRESSED_RUN_HEADER.pack(run_start, len(data), len(packed), codec), packed, blocks
+            return COMPRESSED_RUN_HEADER.pack(run_start, len(data), len(data), CODEC_NONE), data, blocks
+
+        more = getattr(socket, "MSG_MORE", 0)
+        pending = deque()
+
+        def send_next():
+            header, body, blocks = pending.popleft().result()
+            connection.sendall(header, more)
+            connection.sendall(body)
+            sent.inc(len(body))
+            self._blocks_sent.inc(blocks)
+
+        try:
+            for run_start, run_stop in self._split_runs(runs, block_size):
+                pending.append(self._compressors.submit(pack_run, run_start, run_stop))
+                if len(pending) >= COMPRESS_AHEAD:
+                    send_next()
+            while pending:
+                send_next()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def _recv_into(self, sock, view):
+        """Preenche view direto do socket; devolve quantos bytes chegaram antes de um EOF."""
+        got = 0
+        n = len(view)
+        while got < n:
+            read = sock.recv_into(view[got:], n - got)
+            if not read:
+                break
+            got += read
+        return got
     
-    def request_file(self, filename):
+    def _read_file_meta(self, sock):
+        """Lê a resposta MSG_FILE_META de GET/META/MANIFEST: (blocos, tamanho, tamanho do bloco, codec, resto)."""
+        frame = recv_frame(sock)
+        if frame is None:
+            raise ProtocolError("conexão fechada sem resposta")
+        msg_type, _, payload = frame
+        p = Payload(payload)
+        if msg_type == MSG_ERROR:
+            raise ProtocolError(p.str())
+        if msg_type == MSG_BUSY:
+            raise PeerBusy(p.str())
+        if msg_type == MSG_NOT_READY:
+            raise NotReady(p.str())
+        if msg_type != MSG_FILE_META:
+            raise ProtocolError(f"resposta inesperada {msg_type}")
+        return p.u32(), p.u64(), p.u32(), p.u8(), p.rest()
+
+    def _request_manifest(self, holder, filename):
+        ip, port = holder.split(":")
+        with self.downloads.connection(), self._connections_out, \
+                socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.settimeout(5)
+            s.connect((ip, int(port)))
+            s.sendall(pack_frame(MSG_MANIFEST, 1, pack_str(filename)))
+            total_blocks, total_size, block_size, _, manifest = self._read_file_meta(s)
+        if not block_size or total_blocks != (total_size + block_size - 1) // block_size:
+            raise ProtocolError(f"{total_blocks} blocos de {block_size} bytes para {total_size} bytes")
+        if len(manifest) != total_blocks * DIGEST_SIZE:
+            raise ProtocolError(f"manifest com {len(manifest)} bytes para {total_blocks} blocos")
+        return total_blocks, total_size, block_size, manifest
+
+    def request_file(self, filename, progress=None):
+        """
+        Baixa o arquivo dos peers que o têm. Devolve True se ele foi salvo.
+        progress(blocos recebidos, total), se dado, acompanha o andamento.
+        Use self.downloads.submit para não baixar o mesmo arquivo duas vezes
+        ao mesmo tempo.
+        """
         holders = self.who_has(filename)
         if not holders:
             print(f"No peer has the file {filename}")
-            return
+            return False
+        # os demais ainda estão baixando (ou vieram por PEX): o BITFIELD diz o que eles têm
+        complete = self.holders.complete(filename)
 
-        blocks = {}
-        blocks_lock = threading.Lock()
-        meta_info = {"total_blocks": None, "total_size": None}
-        meta_lock = threading.Lock()
+        # meta-informação + hashes dos blocos, pedidos uma vez só. Um holder
+        # que ainda calcula o manifest responde NOT_READY: se nenhum o tem
+        # pronto, os que responderam assim são consultados de novo, com esperas
+        # crescentes, por até MANIFEST_WAIT segundos
+        meta_info = {"total_blocks": None, "total_size": None, "block_size": None, "manifest": None}
+        pending = sorted(holders, key=lambda h: h not in complete)
+        delay = MANIFEST_RETRY
+        deadline = time.monotonic() + MANIFEST_WAIT
+        while pending:
+            not_ready = []
+            for holder in pending:
+                try:
+                    meta = self._request_manifest(holder, filename)
+                except NotReady:
+                    not_ready.append(holder)
+                    continue
+                except Exception as e:
+                    print(f"[ERROR] Falha ao receber manifest de {holder}: {e}")
+                    self.holders.discard(filename, holder)
+                    continue
+                if meta:
+                    (meta_info["total_blocks"], meta_info["total_size"],
+                     meta_info["block_size"], meta_info["manifest"]) = meta
+                    break
+            if meta_info["total_blocks"] is not None or time.monotonic() + delay > deadline:
+                break
+            if not_ready:
+                print(f"[META] {filename}: manifest em cálculo em {len(not_ready)} peer(s), "
+                      f"nova tentativa em {delay:.2f}s")
+                time.sleep(delay)
+                delay = min(delay * 2, MANIFEST_RETRY_MAX)
+            pending = not_ready
+
+        if meta_info["total_blocks"] is None:
+            print(f"[ERROR] Nenhum peer respondeu com a meta-informação de {filename}")
+            return False
+
+        total_blocks = meta_info["total_blocks"]
+        block_size = meta_info["block_size"]
+        print(f"[META] {filename}: {total_blocks} blocos de {block_size} bytes "
+              f"(tamanho total {meta_info['total_size']} bytes)")
+
+        # grava direto em <arquivo>.part; se já existir um download
+        # interrompido do mesmo arquivo, só os blocos faltantes são pedidos
+        sink = DownloadSink(self._dir, filename, meta_info["total_size"], total_blocks,
+                            meta_info["manifest"], block_size)
+        missing = sink.missing_blocks()
+        if len(missing) < total_blocks:
+            print(f"[RESUME] {filename}: {total_blocks - len(missing)} de {total_blocks} blocos já estavam no disco")
+
+        # seeding parcial: os blocos recebidos já podem ser servidos, e o
+        # tracker fica sabendo do download ao chegar o primeiro bloco (HAVE)
+        with self._sinks_lock:
+            self._sinks[filename] = sink
+        finished = threading.Event()
+
+        def announce():
+            announced = False
+            while not finished.wait(HAVE_INTERVAL if announced else HAVE_POLL):
+                received = sink.received_count()
+                if received:
+                    announced = self.send_have(filename, received, total_blocks) or announced
+
+        def unpublish(abandoned):
+            finished.set()
+            with self._sinks_lock:
+                self._sinks.pop(filename, None)
+            if abandoned:
+                self.send_have(filename, 0, total_blocks)
+
+        threading.Thread(target=announce, daemon=True).start()
+
+        stats_lock = threading.Lock()
+        received_from = {holder: 0 for holder in holders}
+        wire_bytes = {holder: 0 for holder in holders}  # bytes de dados que chegaram pela rede
+        strikes = {holder: 0 for holder in holders}
+        active = {}  # holder -> socket do GET em andamento
+        active_lock = threading.Lock()
+
+        def cancel_fetch(holder):
+            # endgame: outra cópia do pedaço chegou antes; derruba a conexão
+            with active_lock:
+                s = active.get(holder)
+            if s is not None:
+                print(f"[ENDGAME] Cancelando pedido repetido em {holder}")
+                try:
+                    s.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
 
+        # fontes parciais entram no scheduler depois do primeiro BITFIELD
+        scheduler = DownloadScheduler([h for h in holders if h in complete], missing, on_cancel=cancel_fetch)
+        threads = []
+
+        def add_source(holder):
+            # holder descoberto por PEX no meio do download: entra roubando trabalho
+            with stats_lock:
+                if holder in received_from:
+                    return
+                received_from[holder] = wire_bytes[holder] = strikes[holder] = 0
+            print(f"[PEX] {holder} também tem {filename}; usando como fonte")
+            t = threading.Thread(target=download_from_peer, args=(holder, True))
+            t.start()
+            threads.append(t)
+
+        def probe(holder, first):
+            # blocos de uma fonte parcial; None se ela já tem o arquivo inteiro
+            try:
+                have = self._request_bitmap(holder, filename, total_blocks)
+            except Exception as e:
+                print(f"[ERROR] Falha ao receber o bitmap de {holder}: {e}")
+                self.holders.discard(filename, holder)
+                scheduler.retire(holder)
+                return False
+            if first:
+                scheduler.add_holder(holder, have)
+            else:
+                scheduler.set_have(holder, have)
+            return True
 
-        def download_from_peer(holder):
+        def fetch_chunk(holder, chunk, corrupt, delivered, scratch):
+            # no endgame o pedaço pode já ter chegado em parte por outro holder
+            wanted = [idx for idx in chunk if not sink.has_block(idx)]
+            if not wanted:
+                return True
             ip, port = holder.split(":")
             port = int(port)
 
+            with self.downloads.connection(), self._connections_out, \
+                    socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                s.settimeout(5)
+
+                # Conectar
+                try:
+                    s.connect((ip, port))
+                except Exception as e:
+                    print(f"[ERROR] Falha ao conectar ao peer {holder}: {e}")
+                    return False
+
+                with active_lock:
+                    if scheduler.is_cancelled(holder):
+                        return True
+                    active[holder] = s
+                try:
+                    return receive_chunk(s, holder, wanted, corrupt, delivered, scratch)
+                finally:
+                    with active_lock:
+                        active.pop(holder, None)
+
+        def receive_chunk(s, holder, wanted, corrupt, delivered, scratch):
+            def report(message):
+                # uma cópia cancelada no endgame falha de propósito
+                if not scheduler.is_cancelled(holder):
+                    print(message)
+
+            # Mandar GET só com as faixas deste pedaço, os codecs aceitos e
+            # os holders que conhecemos (PEX), incluindo este peer se ele já
+            # tem blocos para servir
             try:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                    s.settimeout(5)
+                known = self.holders.known(filename)
+                if self.address and sink.received_count():
+                    known.insert(0, self.address)
+                request = (pack_str(filename) + pack_ranges(index_runs(wanted)) + pack_codecs(self.codecs)
+                           + pack_names(known[:PEX_MAX]))
+                s.sendall(pack_frame(MSG_GET, 1, request))
+            except Exception as e:
+                report(f"[ERROR] Falha ao enviar GET para {holder}: {e}")
+                return False
 
-                    # Conectar
-                    try:
-                        s.connect((ip, port))
-                    except Exception as e:
-                        print(f"[ERROR] Falha ao conectar ao peer {holder}: {e}")
-                        return
+            # RECEBER META-INFORMAÇÃO
+            try:
+                *meta, codec, exchange = self._read_file_meta(s)
+                if tuple(meta) != (total_blocks, meta_info["total_size"], block_size):
+                    report(f"[ERROR] Peer {holder} tem outra versão de {filename}")
+                    return False
+                if codec != CODEC_NONE and codec not in self.codecs:
+                    report(f"[ERROR] Peer {holder} respondeu com o codec {codec}, que não foi oferecido")
+                    return False
+            except PeerBusy:
+                raise
+            except Exception as e:
+                report(f"[ERROR] Falha ao receber meta-info de {holder}: {e}")
+                return False
 
-                    # Mandar GET
-                    try:
-                        s.sendall(f"GET {filename}".encode())
-                    except Exception as e:
-                        print(f"[ERROR] Falha ao enviar GET para {holder}: {e}")
-                        return
+            if exchange:
+                try:
+                    for new in self._learn(filename, Payload(exchange).names()):
+                        add_source(new)
+                except ProtocolError as e:
+                    report(f"[ERROR] Lista de holders inválida de {holder}: {e}")
+
+            # RECEBER BLOCOS: cada header cobre um bloco ou uma sequência de
+            # blocos contíguos, recebidos direto na região deles no .part
+            # (ou em scratch, se ela já estiver ocupada ou vier comprimida)
+            received = self.metrics.counter("bytes_received", holder)
+            run_header = RUN_HEADER if codec == CODEC_NONE else COMPRESSED_RUN_HEADER
+            header = memoryview(scratch.header)[:run_header.size]
+            while True:
+                try:
+                    got = self._recv_into(s, header)
+                except Exception as e:
+                    report(f"[ERROR] Falha ao receber header de {holder}: {e}")
+                    return False
 
-                    # RECEBER META-INFORMAÇÃO
+                if got == 0:
+                    return True
+
+                try:
+                    if got < len(header):
+                        raise ValueError("header truncado")
+                    if codec == CODEC_NONE:
+                        block_idx, run_size = run_header.unpack_from(header)
+                        wire_size, run_codec = run_size, CODEC_NONE
+                    else:
+                        block_idx, run_size, wire_size, run_codec = run_header.unpack_from(header)
+                        if run_codec not in (CODEC_NONE, codec) or wire_size > run_size:
+                            raise ValueError(f"trecho com codec {run_codec} e {wire_size} bytes no fio")
+                        if run_codec == CODEC_NONE and wire_size != run_size:
+                            raise ValueError("trecho cru com tamanhos diferentes")
+                    if run_size > max(RUN_BYTES, block_size):
+                        raise ValueError(f"trecho de {run_size} bytes")
+                    target = sink.claim_run(block_idx, run_size) if run_codec == CODEC_NONE else None
+                except (IndexError, ValueError) as e:
+                    report(f"[ERROR] Header inválido/truncado em {holder}: {e}")
+                    return False
+
+                direct = target is not None
+                if not direct:
+                    target = scratch.view[:wire_size]
+                try:
+                    got = self._recv_into(s, target)
+                except Exception:
+                    got = -1
+                if got != wire_size:
+                    if direct:
+                        sink.release_run(block_idx, target)
+                    report(f"[ERROR] Bloco {block_idx} truncado em {holder}")
+                    return False
+
+                if run_codec != CODEC_NONE:
                     try:
-                        meta = self._recvn(s, 8)
-                        if not meta:
-                            print("[ERROR] meta-info vazia")
-                            return
+                        target = decompress(run_codec, target, run_size)
+                    except ProtocolError as e:
+                        report(f"[ERROR] Blocos {block_idx}+ de {holder}: {e}")
+                        return False
 
-                        total_blocks, total_size = struct.unpack("!II", meta)
-                        print(f"[META] Peer {holder} enviará {total_blocks} blocos (tamanho total {total_size} bytes)")
+                try:
+                    written = sink.commit_run(block_idx, target) if direct else sink.write_run(block_idx, target)
+                except CorruptBlockError as e:
+                    report(f"[ERROR] Blocos {e.blocks} de {holder} não batem com o manifest")
+                    corrupt.extend(e.blocks)
+                    written = e.written
 
-                        with meta_lock:
-                            if meta_info["total_blocks"] is None:
-                                meta_info["total_blocks"] = total_blocks
-                                meta_info["total_size"] = total_size
+                last_idx = block_idx + max(run_size - 1, 0) // block_size
+                delivered.update(range(block_idx, last_idx + 1))
+                scheduler.progress(holder, run_size)
+                received.inc(wire_size)
+                with stats_lock:
+                    wire_bytes[holder] += wire_size
+                if written:
+                    self._blocks_received.inc(written)
+                    with stats_lock:
+                        received_from[holder] += written
+                    if progress:
+                        progress(sink.received_count(), total_blocks)
+                    if self.verbose:
+                        print(f"[RECEIVED] Blocos {block_idx}-{last_idx} ({run_size} bytes) de {holder}")
+
+        def download_from_peer(holder, partial=False):
+            if partial and not probe(holder, first=True):
+                return
+            busy = stalls = 0
+            throughput = self.metrics.histogram("holder_throughput", holder)
+            scratch = ReceiveBuffer(max(RUN_BYTES, block_size))
+            while True:
+                chunk = scheduler.next_chunk(holder)
+                if chunk is None:
+                    return
+                if not chunk:
+                    # fonte parcial sem nenhum bloco que nos falta: vê se ela recebeu mais
+                    stalls += 1
+                    if stalls > MAX_STALLS:
+                        scheduler.retire(holder)
+                        return
+                    if not probe(holder, first=False):
+                        return
+                    continue
+                stalls = 0
 
-                    except Exception as e:
-                        print(f"[ERROR] Falha ao receber meta-info de {holder}: {e}")
+                corrupt = []
+                delivered = set()
+                started, before = time.perf_counter(), wire_bytes[holder]
+                try:
+                    ok = fetch_chunk(holder, chunk, corrupt, delivered, scratch)
+                    busy = 0
+                    if wire_bytes[holder] > before:
+                        # MB/s deste pedaço, de ponta a ponta (conexão + GET + dados)
+                        throughput.observe((wire_bytes[holder] - before) / (time.perf_counter() - started) / 1e6)
+                except PeerBusy:
+                    # sem slot livre: devolve o pedaço (os outros holders podem
+                    # roubá-lo) e tenta de novo mais tarde
+                    scheduler.chunk_done(holder, chunk, failed=True)
+                    busy += 1
+                    if busy >= MAX_BUSY:
+                        print(f"[BUSY] {holder} continua ocupado; desistindo dele")
+                        scheduler.retire(holder)
                         return
+                    time.sleep(0.1 * 2 ** busy)
+                    continue
+                except Exception as e:
+                    print(f"[ERROR] Falha inesperada no download com peer {holder}: {e}")
+                    ok = False
 
-                    # RECEBER BLOCOS
-                    while True:
-                        try:
-                            header = self._recvn(s, 8)
-                        except Exception as e:
-                            print(f"[ERROR] Falha ao receber header de {holder}: {e}")
-                            return
-
-                        if not header:
-                            break
-
-                        try:
-                            block_idx, block_size = struct.unpack("!II", header)
-                            block_data = self._recvn(s, block_size)
-                        except Exception as e:
-                            print(f"[ERROR] Header inválido/truncado em {holder}: {e}")
-                            return
-
-                        with blocks_lock:
-                            if block_idx not in blocks:
-                                blocks[block_idx] = block_data
-                                print(f"[RECEIVED] Bloco {block_idx} ({block_size} bytes) de {holder}")
-            except Exception as e:
-                print(f"[ERROR] Falha inesperada no download com peer {holder}: {e}")
+                missing = [idx for idx in chunk if not sink.has_block(idx) and idx not in corrupt]
+                # blocos entregues mas não gravados estão reservados por outra cópia do pedaço
+                failed = not ok or any(idx not in delivered for idx in missing)
+                cancelled = scheduler.chunk_done(holder, missing, corrupt, failed)
+
+                if corrupt:
+                    # bloco ruim: pede de novo a outro peer e penaliza quem enviou
+                    strikes[holder] += 1
+                    print(f"[PENALTY] {holder}: {strikes[holder]}/{MAX_STRIKES} envios corrompidos")
+                    if strikes[holder] >= MAX_STRIKES:
+                        scheduler.retire(holder)
+                        self.holders.discard(filename, holder)
+                        return
+
+                if failed and not cancelled:
+                    scheduler.retire(holder)
+                    self.holders.discard(filename, holder)
+                    return
 
-        threads = []
         start_time = time.time()
 
         for holder in holders:
-            t = threading.Thread(target=download_from_peer, args=(holder,))
+            t = threading.Thread(target=download_from_peer, args=(holder, holder not in complete))
             t.start()
             threads.append(t)
 
-        for t in threads:
-            t.join()
+        # add_source pode incluir threads enquanto esperamos; quem inclui
+        # ainda está na lista, então ela só esvazia quando todas terminaram
+        while threads:
+            threads.pop().join()
 
         end_time = time.time()
         download_time = end_time - start_time
         print(f"[DOWNLOAD COMPLETE] Time taken: {download_time:.2f} seconds")
+        for holder, n in received_from.items():
+            print(f"[SOURCE] {holder}: {n} blocos, {wire_bytes[holder]} bytes no fio "
+                  f"({scheduler.rate(holder) / 1e6:.1f} MB/s)")
 
-        if not blocks:
-            print(f"[ERROR] Nenhum bloco foi recebido de nenhum peer.")
-            return
-
-        file = FILES()
-
+        self.metrics.histogram("download_time").observe(download_time)
+        if not sink.is_complete():
+            self.metrics.counter("downloads", "incompleto").inc()
+            unpublish(abandoned=True)
+            missing = sink.missing_blocks()
+            sink.close()
+            print(f"[WARNING] Arquivo {filename} incompleto: faltam {len(missing)} de {total_blocks} blocos. "
+                  f"Rode 'get {filename}' de novo para retomar o download.")
+            return False
 
         try:
-            file.read_from_blocklist(blocks, filename)
+            file = FILES(sink.finalize())
         except Exception as e:
-            print(f"[ERROR] Falha ao reconstruir o arquivo {filename}: {e}")
-            return
+            self.metrics.counter("downloads", "falha").inc()
+            unpublish(abandoned=True)
+            print(f"[ERROR] Falha ao finalizar o arquivo {filename}: {e}")
+            return False
+        self.metrics.counter("downloads", "ok").inc()
 
-        expected = meta_info["total_blocks"]
+        print(f"[OK] Arquivo {filename} reconstruído com sucesso.")
 
-        if expected is not None and len(blocks) != expected:
-            missing = sorted(set(range(expected)) - set(blocks.keys()))
-            print(f"[WARNING] Arquivo {filename} incompleto: faltam os blocos {missing}")
-        else:
-            print(f"[OK] Arquivo {filename} reconstruído com sucesso.")
-
-        self.files.append(file)
-        file.save_to_disk(f"{self.peer_id}/files")
+        # o manifest conferido no download vale para o arquivo novo: quem
+        # pedir MANIFEST a este peer não espera um novo cálculo
+        if block_size == file.block_size:
+            file.set_manifest(meta_info["manifest"], self._cache_dir)
+        self.catalog.add(file)
+        unpublish(abandoned=False)  # o NEW_FILE encerra o anúncio no tracker
         self.send_new_file_notification(filename)
         print(f"[DONE] File {filename} saved.")
 
@@ -236,58 +1038,202 @@ class Peer:
             if not file_exists:
                 log_file.write("arquivo,tamanho,n_peers,tempo\n")
             
-            log_file.write(f"{filename},{file.size},{len(holders)},{download_time:.2f}\n")
+            log_file.write(f"{filename},{file.size},{len(received_from)},{download_time:.2f}\n")
+        return True
 
 
     def send_new_file_notification(self, filename):
-        message = f"NEW_FILE {self.peer_id} {filename}"
-
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect(TRACKER)
-            s.sendall(message.encode())
-            response = s.recv(4096).decode()
-            print(f"Tracker response: {response}")
-            s.close()
+        try:
+            _, payload = self.tracker.call(MSG_NEW_FILE, pack_str(self.peer_id) + pack_str(filename))
+        except OSError as e:
+            # o arquivo já está salvo; o tracker o vê na próxima checagem do catálogo (VERIFY_FILES)
+            print(f"[WARNING] Tracker não respondeu ao NEW_FILE {filename} ({e})")
+            return
+        print(f"Tracker response: {Payload(payload).str()}")
 
     def register_with_tracker(self):
         peer_id = self.peer_id
         files_names = [file.file_name for file in self.files]
 
-        files = ",".join(files_names)
         port = self.port
         peer_ip = self._get_my_ip()
 
-        message = f"REGISTER {peer_ip} {peer_id} {port} {files}"
+        message = pack_str(peer_ip) + pack_str(peer_id) + pack_u16(port) + pack_names(files_names)
 
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect(TRACKER)
-            s.sendall(message.encode())
-            response = s.recv(4096).decode()
-            print(f"Tracker response: {response}")
-            if response == "REGISTERED":
-                self.registered = True
-            s.close()
+        msg_type, payload = self.tracker.call(MSG_REGISTER, message)
+        response = Payload(payload).str()
+        print(f"Tracker response: {response}")
+        if msg_type == MSG_OK and response == "REGISTERED":
+            self.registered = True
+            self.address = f"{peer_ip}:{port}"
 
     def who_has(self, filename):
-        message = f"WHO_HAS {filename}"
+        """
+        Holders do arquivo, incluindo peers que ainda o estão baixando. Uma
+        resposta recente do tracker sai do HolderCache, sem ida ao tracker; se
+        o tracker não responde, vale o que os peers já conhecidos sabem (PEX).
+        """
+        holders = self.holders.fresh(filename)
+        if holders is not None:
+            self.metrics.counter("holder_lookups", "cache").inc()
+            return holders
+        try:
+            msg_type, payload = self.tracker.call(MSG_WHO_HAS, pack_str(filename))
+        except OSError as e:
+            print(f"[WARNING] Tracker não respondeu ao WHO_HAS {filename} ({e}); perguntando aos peers conhecidos")
+            self.metrics.counter("holder_lookups", "pex").inc()
+            return self._ask_peers(filename)
+        if msg_type != MSG_HOLDERS:
+            print(f"[ERROR] Tracker recusou WHO_HAS {filename}: {Payload(payload).str()}")
+            return []
+        self.metrics.counter("holder_lookups", "tracker").inc()
+        p = Payload(payload)
+        holders = p.names()
+        partial = [h for h in p.names() if h != self.address and h not in holders] if p.more() else []
+        self.holders.put(filename, holders, partial)
+        return holders + partial
 
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect(TRACKER)
-            s.sendall(message.encode())
-            response = s.recv(4096).decode()
-            s.close()
-            return response.split(",") if response else []
+    def who_has_many(self, filenames) -> dict:
+        """
+        who_has de vários arquivos: os que não estão no HolderCache vão ao
+        tracker em WHO_HAS_MANY de até MAX_WHO_HAS_BATCH arquivos cada.
+        Devolve {arquivo: holders}, na ordem pedida; sem resposta do tracker,
+        valem os holders já conhecidos.
+        """
+        filenames = list(dict.fromkeys(filenames))
+        result = {}
+        missing = []
+        for filename in filenames:
+            holders = self.holders.fresh(filename)
+            if holders is None:
+                missing.append(filename)
+            else:
+                result[filename] = holders
+        self.metrics.counter("holder_lookups", "cache").inc(len(result))
 
-    def disconnect_from_tracker(self):
-        message = f"DISCONNECT {self.peer_id}"
+        for i in range(0, len(missing), MAX_WHO_HAS_BATCH):
+            batch = missing[i:i + MAX_WHO_HAS_BATCH]
+            try:
+                msg_type, payload = self.tracker.call(MSG_WHO_HAS_MANY, pack_names(batch))
+            except OSError as e:
+                print(f"[WARNING] Tracker não respondeu ao WHO_HAS_MANY ({e}); usando os holders já conhecidos")
+                for filename in missing[i:]:
+                    result[filename] = self.holders.known(filename)
+                break
+            p = Payload(payload)
+            if msg_type != MSG_HOLDERS_MANY:
+                print(f"[ERROR] Tracker recusou WHO_HAS_MANY: {p.str()}")
+                break
+            self.metrics.counter("holder_lookups", "tracker").inc(len(batch))
+            for _ in range(p.u32()):
+                filename, holders = p.str(), p.names()
+                partial = [h for h in p.names() if h != self.address and h not in holders]
+                self.holders.put(filename, holders, partial)
+                result[filename] = holders + partial
+        return {filename: result[filename] for filename in filenames if filename in result}
+
+    def search(self, pattern, mode=SEARCH_SUBSTRING, page_size=None):
+        """Nomes do catálogo do tracker que casam com o padrão (SEARCH), página a página."""
+        after = ""
+        while True:
+            request = pack_u8(mode) + pack_str(pattern) + pack_str(after) + pack_u32(page_size or 0)
+            msg_type, payload = self.tracker.call(MSG_SEARCH, request)
+            p = Payload(payload)
+            if msg_type != MSG_SEARCH_RESULT:
+                raise ProtocolError(f"tracker recusou SEARCH: {p.str()}")
+            more, names = p.u8(), p.names()
+            yield from names
+            if not more or not names:
+                return
+            after = names[-1]
+
+    def send_have(self, filename, received, total):
+        """Anuncia ao tracker um download em andamento (HAVE); 0 ou total encerram o anúncio."""
+        try:
+            self.tracker.call(MSG_HAVE, pack_str(self.peer_id) + pack_str(filename)
+                              + pack_u32(received) + pack_u32(total))
+            return True
+        except OSError:
+            return False
 
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect(TRACKER)
-            s.sendall(message.encode())
-            s.close()
+    def _request_bitmap(self, holder, filename, total_blocks):
+        """Blocos que o holder tem do arquivo (BITFIELD), ou None se ele tem o arquivo inteiro."""
+        ip, port = holder.rsplit(":", 1)
+        with self.downloads.connection(), self._connections_out, \
+                socket.create_connection((ip, int(port)), timeout=5) as s:
+            s.sendall(pack_frame(MSG_BITFIELD, 1, pack_str(filename)))
+            frame = recv_frame(s)
+        if frame is None:
+            raise ProtocolError("conexão fechada sem resposta")
+        msg_type, _, payload = frame
+        p = Payload(payload)
+        if msg_type == MSG_ERROR:
+            raise ProtocolError(p.str())
+        if msg_type != MSG_BITMAP:
+            raise ProtocolError(f"resposta inesperada {msg_type}")
+        blocks, bitmap = p.u32(), p.blob()
+        if blocks != total_blocks:
+            raise ProtocolError(f"{holder} tem outra versão de {filename}")
+        if not bitmap:
+            return None
+        if len(bitmap) != (blocks + 7) // 8:
+            raise ProtocolError(f"bitmap de {len(bitmap)} bytes para {blocks} blocos")
+        return bitmap_blocks(bitmap, blocks)
+
+    def _ask_peers(self, filename):
+        """
+        PEX sem o tracker: pergunta a até PEX_FANOUT peers conhecidos,
+        começando pelos holders do arquivo, quem mais tem o arquivo.
+        """
+        known = self.holders.known(filename)
+        candidates = known + [p for p in self.holders.peers() if p not in known and p != self.address]
+        for candidate in candidates[:PEX_FANOUT]:
+            ip, _, port = candidate.rpartition(":")
+            try:
+                with self.downloads.connection(), self._connections_out, \
+                        socket.create_connection((ip, int(port)), timeout=PEX_TIMEOUT) as s:
+                    s.sendall(pack_frame(MSG_PEX, 1, pack_str(filename) + pack_names(known[:PEX_MAX])))
+                    frame = recv_frame(s)
+                if frame is None or frame[0] != MSG_HOLDERS:
+                    raise ProtocolError("resposta inesperada")
+                self._learn(filename, Payload(frame[2]).names())
+            except (OSError, ValueError, ProtocolError) as e:
+                print(f"[ERROR] PEX com {candidate} falhou: {e}")
+        return self.holders.known(filename)
+
+    def stats(self) -> dict:
+        """Snapshot das métricas, mais o cache de blocos, o de holders e os downloads em andamento."""
+        snap = self.metrics.snapshot()
+        snap["cache"] = self.block_cache.stats()
+        snap["holders"] = self.holders.stats()
+        snap["downloads"] = {name: f"{done}/{total} blocos" if total else "aguardando"
+                             for name, (done, total) in self.downloads.status().items()}
+        return snap
+
+    def remote_stats(self, target):
+        """Snapshot das métricas de outro processo: "tracker" ou o ip:porta de um peer."""
+        if target == "tracker":
+            msg_type, payload = self.tracker.call(MSG_STATS)
+        else:
+            ip, port = target.rsplit(":", 1)
+            with socket.create_connection((ip, int(port)), timeout=5) as s:
+                s.sendall(pack_frame(MSG_STATS, 1))
+                frame = recv_frame(s)
+            if frame is None:
+                raise ProtocolError("conexão fechada sem resposta")
+            msg_type, _, payload = frame
+        if msg_type != MSG_SNAPSHOT:
+            raise ProtocolError(f"resposta inesperada {msg_type}")
+        return json.loads(payload)
+
+    def disconnect_from_tracker(self):
+        self.tracker.call(MSG_DISCONNECT, pack_str(self.peer_id))
+        self.tracker.close()
 
 if __name__ == "__main__":
-    peer = Peer(PEER_ID, PORT, PEER_FILES)
+    peer = Peer(PEER_ID, PORT, PEER_FILES, args.workers, args.upload_slots, args.queue,
+                args.max_downloads, args.max_connections, args.cache_mb * 1024 * 1024,
+                args.codecs, args.verbose, args.holder_ttl)
     peer.register_with_tracker()
 
     if peer.registered:
@@ -299,7 +1245,38 @@ if __name__ == "__main__":
 
             if command.startswith("get "):
                 filename = command.split(" ", 1)[1]
-                peer.request_file(filename)
+                peer.downloads.submit(filename).result()
+
+            elif command.startswith("bg "):
+                # download em segundo plano; acompanhe com "downloads"
+                filename = command.split(" ", 1)[1]
+                future = peer.downloads.submit(filename)
+                future.add_done_callback(
+                    lambda f, name=filename: print(f"[BG] {name}: {'ok' if not f.exception() and f.result() else 'falhou'}"))
+                print(f"[BG] {filename} na fila")
+
+            elif command == "downloads":
+                status = peer.downloads.status()
+                if not status:
+                    print("Nenhum download em andamento")
+                for name, (done, total) in status.items():
+                    print(f"- {name}: " + (f"{done}/{total} blocos" if total else "aguardando"))
+
+            elif command == "cache":
+                stats = peer.block_cache.stats()
+                print(f"Cache de blocos: {stats['bytes'] / 2**20:.1f} de {stats['budget'] / 2**20:.0f} MiB, "
+                      f"{stats['blocks']} blocos, {stats['hits']} acertos, {stats['misses']} faltas "
+                      f"({stats['hit_rate']:.0%}), {stats['evictions']} expulsões")
+
+            elif command == "stats" or command.startswith("stats "):
+                # stats: este peer; stats tracker | stats <ip:porta>: outro processo
+                target = command[len("stats"):].strip()
+                try:
+                    snapshot = peer.remote_stats(target) if target else peer.stats()
+                except Exception as e:
+                    print(f"[ERROR] Falha ao obter métricas de {target}: {e}")
+                    continue
+                print(format_snapshot(snapshot))
 
             elif command == "myfiles":
                 for f in peer.files:
@@ -307,6 +1284,18 @@ if __name__ == "__main__":
 
             elif command.startswith("whohas "):
                 filename = command.split(" ", 1)[1]
+                if any(c in filename for c in "*?["):
+                    # glob: todos os arquivos do catálogo que casam, num só WHO_HAS_MANY
+                    try:
+                        found = peer.who_has_many(peer.search(filename, SEARCH_GLOB))
+                    except (OSError, ProtocolError) as e:
+                        print(f"[ERROR] Falha na busca: {e}")
+                        continue
+                    if not found:
+                        print(f"No file matches {filename}")
+                    for name, holders in found.items():
+                        print(f"- {name}: {', '.join(holders) if holders else 'nenhum peer'}")
+                    continue
                 holders = peer.who_has(filename)
                 if holders:
                     print(f"Peers with the file {filename}:")
@@ -315,6 +1304,23 @@ if __name__ == "__main__":
                 else:
                     print(f"No peer has the file {filename}")
 
+            elif command.startswith("search ") or command == "ls" or command.startswith("ls "):
+                # search <texto ou glob>: busca no catálogo do tracker; ls [prefixo]: lista por prefixo
+                word, _, pattern = command.partition(" ")
+                if word == "ls":
+                    mode = SEARCH_PREFIX
+                else:
+                    mode = SEARCH_GLOB if any(c in pattern for c in "*?[") else SEARCH_SUBSTRING
+                try:
+                    count = 0
+                    for name in peer.search(pattern, mode):
+                        print("-", name)
+                        count += 1
+                except (OSError, ProtocolError) as e:
+                    print(f"[ERROR] Falha na busca: {e}")
+                    continue
+                print(f"{count} arquivo(s)")
+
             elif command.startswith("bench "):
                 parts = command.split()
                 if len(parts) == 2:
@@ -357,4 +1363,4 @@ if __name__ == "__main__":
                 sys.exit(0)
 
             else:
-                print("Invalid command. Available commands: get <filename>, myfiles, whohas <filename>, bench <filename> [runs], stress <filename> [n_threads], exit")
+                print("Invalid command. Available commands: get <filename>, bg <filename>, downloads, cache, stats [tracker|ip:porta], myfiles, whohas <filename|glob>, search <texto|glob>, ls [prefixo], bench <filename> [runs], stress <filename> [n_threads], exit")
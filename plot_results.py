@@ -1,9 +1,12 @@
+import argparse
 import csv
+import json
+import sys
 from collections import defaultdict
 import statistics
-import matplotlib.pyplot as plt
 
 CSV_PATH = "download_times.csv"
+DEFAULT_TOLERANCE = 0.10  # piora relativa tolerada antes de acusar regressão
 
 def load_data(csv_path=CSV_PATH):
     """
@@ -55,6 +58,8 @@ def plot_performance(peers_list, means, stds):
     """
     Plota gráfico de barras: nº de peers vs tempo médio de download.
     """
+    import matplotlib.pyplot as plt
+
     plt.figure()
     x = range(len(peers_list))
 
@@ -70,7 +75,95 @@ def plot_performance(peers_list, means, stds):
     plt.savefig("resultado_desempenho.png", dpi=150)
     plt.show()
 
-def main():
+def load_swarm(path):
+    """Resultados do swarm_bench.py indexados por (cenário, tamanho)."""
+    with open(path, "r", encoding="utf-8") as f:
+        report = json.load(f)
+    return report, {(r["scenario"], r["size_bytes"]): r for r in report["results"]}
+
+def _label(key):
+    scenario, size = key
+    return f"{scenario} {size / 2**20:g} MiB"
+
+def _total(processes, field):
+    values = [usage[field] for usage in processes.values() if usage and usage.get(field) is not None]
+    return sum(values) if values else None
+
+def _peak(processes, field):
+    values = [usage[field] for usage in processes.values() if usage and usage.get(field) is not None]
+    return max(values) if values else None
+
+# métrica -> (como extrair do resultado, True se maior é melhor)
+SWARM_METRICS = {
+    "vazão MB/s": (lambda r: r["throughput_mbps"], True),
+    "p50 s": (lambda r: r["p50_s"], False),
+    "p95 s": (lambda r: r["p95_s"], False),
+    "p99 s": (lambda r: r["p99_s"], False),
+    "CPU total s": (lambda r: _total(r["processes"], "cpu_s"), False),
+    "pico RSS KiB": (lambda r: _peak(r["processes"], "peak_rss_kb"), False),
+}
+
+def compare_runs(base_path, new_path, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compara duas rodadas do swarm_bench.py cenário a cenário e devolve as
+    regressões: métricas que pioraram mais que tolerance (relativo) ou
+    downloads que passaram a falhar.
+    """
+    base_report, base = load_swarm(base_path)
+    new_report, new = load_swarm(new_path)
+    print(f"Base: {base_path} (commit {base_report.get('commit')}, {base_report.get('timestamp')})")
+    print(f"Nova: {new_path} (commit {new_report.get('commit')}, {new_report.get('timestamp')})")
+
+    regressions = []
+    for key in sorted(base.keys() & new.keys()):
+        old_r, new_r = base[key], new[key]
+        print(f"\n{_label(key)}")
+        for name, (extract, higher_is_better) in SWARM_METRICS.items():
+            before, after = extract(old_r), extract(new_r)
+            if before is None or after is None:
+                continue
+            change = (after - before) / before if before else 0.0
+            worse = -change if higher_is_better else change
+            flag = ""
+            if worse > tolerance:
+                flag = "  <-- REGRESSÃO"
+                regressions.append((key, name, before, after))
+            print(f"  {name:<14} {before:>10.2f} -> {after:>10.2f} ({change:+.0%}){flag}")
+        if new_r["failures"] > old_r["failures"]:
+            print(f"  falhas         {old_r['failures']:>10} -> {new_r['failures']:>10}  <-- REGRESSÃO")
+            regressions.append((key, "falhas", old_r["failures"], new_r["failures"]))
+
+    for key in sorted(base.keys() - new.keys()):
+        print(f"\n{_label(key)}: ausente na rodada nova")
+
+    print(f"\n{len(regressions)} regressão(ões) acima de {tolerance:.0%}")
+    return regressions
+
+def plot_swarm(paths, output="comparacao_enxame.png"):
+    """Barras de vazão por cenário, uma série por rodada do swarm_bench.py."""
+    import matplotlib.pyplot as plt
+
+    runs = [(path, load_swarm(path)[1]) for path in paths]
+    keys = sorted(set().union(*(results.keys() for _, results in runs)))
+    width = 0.8 / len(runs)
+
+    plt.figure(figsize=(max(6, len(keys) * 1.5), 4))
+    for i, (path, results) in enumerate(runs):
+        values = [results[k]["throughput_mbps"] if k in results else 0 for k in keys]
+        plt.bar([x + i * width for x in range(len(keys))], values, width, label=path)
+    plt.xticks([x + width * (len(runs) - 1) / 2 for x in range(len(keys))],
+               [_label(k) for k in keys], rotation=30, ha="right")
+
+    plt.ylabel("Vazão (MB/s)")
+    plt.title("Vazão por cenário do enxame")
+    plt.grid(axis="y", linestyle="--", alpha=0.5)
+    plt.legend()
+
+    plt.tight_layout()
+    plt.savefig(output, dpi=150)
+    plt.show()
+
+def plot_csv():
     rows = load_data()
     if not rows:
         print("Nenhum dado válido encontrado no CSV.")
@@ -84,5 +177,25 @@ def main():
 
     plot_performance(peers_list, means, stds)
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gráficos e comparação de resultados de download")
+    sub = parser.add_subparsers(dest="mode")
+    compare = sub.add_parser("compare", help="compara duas rodadas do swarm_bench.py")
+    compare.add_argument("base")
+    compare.add_argument("new")
+    compare.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                         help="piora relativa tolerada (0.10 = 10%%)")
+    swarm = sub.add_parser("swarm", help="plota a vazão de uma ou mais rodadas do swarm_bench.py")
+    swarm.add_argument("results", nargs="+")
+    opts = parser.parse_args(argv)
+
+    if opts.mode == "compare":
+        # código de saída 1 quando há regressão, para uso em scripts
+        sys.exit(1 if compare_runs(opts.base, opts.new, opts.tolerance) else 0)
+    elif opts.mode == "swarm":
+        plot_swarm(opts.results)
+    else:
+        plot_csv()
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,316 @@
+import asyncio
+import lzma
+import select
+import socket
+import struct
+import time
+import zlib
+
+# Quadro de controle: "P2", versão, tipo, id do pedido, tamanho do payload.
+# Conexões que não começam com MAGIC falam o protocolo de texto antigo.
+MAGIC = b"P2"
+VERSION = 1
+HEADER = struct.Struct("!2sBBII")
+MAX_PAYLOAD = 64 * 1024 * 1024
+PEEK_TIMEOUT = 2.0  # segundos esperando um prefixo que chegou pela metade
+POLL_INTERVAL = 0.01  # segundos entre duas espiadas do prefixo
+
+MSG_TEXT = 0  # payload é um comando de texto (ou a resposta dele)
+
+# pedidos
+MSG_REGISTER = 1  # ip, peer_id, porta (u16), nomes
+MSG_WHO_HAS = 2  # nome
+MSG_NEW_FILE = 3  # peer_id, nome
+MSG_DISCONNECT = 4  # peer_id
+MSG_VERIFY_FILES = 5  # versão do catálogo conhecida (u32)
+MSG_GET = 6  # nome, faixas de blocos, codecs aceitos (opcional), holders conhecidos (opcional, PEX)
+MSG_META = 7  # nome
+MSG_MANIFEST = 8  # nome
+MSG_STATS = 9  # vazio: pede um snapshot das métricas
+MSG_SHARD_INDEX = 10  # interno (shard.py): operações no índice de um shard
+MSG_PEX = 11  # nome, holders conhecidos: pergunta a um peer quem mais tem o arquivo
+MSG_HAVE = 12  # peer_id, nome, blocos recebidos (u32), total (u32): download em andamento (tracker)
+MSG_BITFIELD = 13  # nome: pede o bitmap dos blocos que o peer tem
+MSG_WHO_HAS_MANY = 14  # nomes: WHO_HAS de vários arquivos num só pedido
+MSG_SEARCH = 15  # modo (u8), padrão, último nome da página anterior (vazio na primeira), limite (u32; 0 = padrão)
+MSG_SHARD_SEARCH = 16  # interno (shard.py): SEARCH só na fatia do índice de um shard
+
+# respostas
+MSG_OK = 64  # texto
+MSG_ERROR = 65  # texto
+MSG_HOLDERS = 66  # nomes ("ip:porta"), e então os que ainda estão baixando o arquivo (opcional)
+MSG_FILES_OK = 67  # vazio: catálogo não mudou
+MSG_CATALOG = 68  # versão (u32), nomes
+# blocos (u32), tamanho (u64), tamanho do bloco (u32), codec (u8), e então o manifest (MANIFEST)
+# ou os holders conhecidos pelo peer (GET que trouxe holders)
+MSG_FILE_META = 69
+MSG_BUSY = 70  # texto: peer sem slot de upload livre, tente outro (ou tracker no limite de conexões)
+MSG_SNAPSHOT = 71  # JSON com contadores, gauges e histogramas (metrics.py)
+MSG_BITMAP = 72  # blocos (u32), bitmap (blob; vazio = arquivo completo)
+MSG_HOLDERS_MANY = 73  # arquivos (u32), e para cada um: nome, holders, os que ainda estão baixando
+MSG_SEARCH_RESULT = 74  # há mais páginas (u8), nomes em ordem
+MSG_NOT_READY = 75  # texto: o peer ainda calcula o manifest do arquivo, tente de novo em instantes
+
+# nome de cada pedido, para logs e métricas
+REQUEST_NAMES = {
+    MSG_TEXT: "TEXT", MSG_REGISTER: "REGISTER", MSG_WHO_HAS: "WHO_HAS", MSG_NEW_FILE: "NEW_FILE",
+    MSG_DISCONNECT: "DISCONNECT", MSG_VERIFY_FILES: "VERIFY_FILES", MSG_GET: "GET", MSG_META: "META",
+    MSG_MANIFEST: "MANIFEST", MSG_STATS: "STATS", MSG_SHARD_INDEX: "SHARD_INDEX", MSG_PEX: "PEX",
+    MSG_HAVE: "HAVE", MSG_BITFIELD: "BITFIELD", MSG_WHO_HAS_MANY: "WHO_HAS_MANY", MSG_SEARCH: "SEARCH",
+    MSG_SHARD_SEARCH: "SHARD_SEARCH",
+}
+
+# dados de um GET: trechos de blocos contíguos, cada um com seu header
+RUN_HEADER = struct.Struct("!II")  # primeiro bloco, bytes
+COMPRESSED_RUN_HEADER = struct.Struct("!IIIB")  # primeiro bloco, bytes, bytes no fio, codec do trecho
+
+# codecs negociados no GET; um trecho que não encolhe vai como CODEC_NONE
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODECS = {"none": CODEC_NONE, "zlib": CODEC_ZLIB, "lzma": CODEC_LZMA}
+
+# modos do SEARCH
+SEARCH_PREFIX = 0
+SEARCH_SUBSTRING = 1
+SEARCH_GLOB = 2  # *, ? e [abc], como no fnmatch
+SEARCH_MODES = {"prefix": SEARCH_PREFIX, "substring": SEARCH_SUBSTRING, "glob": SEARCH_GLOB}
+
+_U8 = struct.Struct("!B")
+_U16 = struct.Struct("!H")
+_U32 = struct.Struct("!I")
+_U64 = struct.Struct("!Q")
+_RANGE = struct.Struct("!II")
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class PeerBusy(ProtocolError):
+    """O peer respondeu BUSY: está com todos os slots de upload ocupados."""
+
+
+class NotReady(ProtocolError):
+    """O peer respondeu NOT_READY: o manifest pedido ainda está sendo calculado."""
+
+
+def compress(codec: int, data) -> bytes:
+    if codec == CODEC_ZLIB:
+        return zlib.compress(data, 1)
+    if codec == CODEC_LZMA:
+        return lzma.compress(data, preset=1)
+    raise ProtocolError(f"codec {codec} desconhecido")
+
+
+def decompress(codec: int, data, size: int) -> bytes:
+    """Descomprime um trecho que deve ter exatamente size bytes."""
+    try:
+        if codec == CODEC_ZLIB:
+            d = zlib.decompressobj()
+            out = d.decompress(data, size)
+            complete = d.eof and not d.unconsumed_tail
+        elif codec == CODEC_LZMA:
+            d = lzma.LZMADecompressor()
+            out = d.decompress(data, max_length=size)
+            complete = d.eof
+        else:
+            raise ProtocolError(f"codec {codec} desconhecido")
+    except (zlib.error, lzma.LZMAError) as e:
+        raise ProtocolError(f"trecho comprimido inválido: {e}")
+    if not complete or len(out) != size:
+        raise ProtocolError(f"trecho comprimido com tamanho errado ({len(out)} de {size} bytes)")
+    return out
+
+
+def pack_u8(n: int) -> bytes:
+    return _U8.pack(n)
+
+
+def pack_u16(n: int) -> bytes:
+    return _U16.pack(n)
+
+
+def pack_u32(n: int) -> bytes:
+    return _U32.pack(n)
+
+
+def pack_u64(n: int) -> bytes:
+    return _U64.pack(n)
+
+
+def pack_str(text: str) -> bytes:
+    raw = text.encode()
+    return _U16.pack(len(raw)) + raw
+
+
+def pack_blob(data: bytes) -> bytes:
+    """Bytes prefixados pelo tamanho (u32)."""
+    return _U32.pack(len(data)) + data
+
+
+def pack_names(names) -> bytes:
+    """
+    Lista de nomes com front coding: ordenados, cada nome guarda só quantos
+    bytes compartilha com o anterior e o sufixo. Nomes parecidos
+    (video_001.mp4, video_002.mp4, ...) custam poucos bytes cada.
+    """
+    parts = [_U32.pack(len(names))]
+    previous = b""
+    for name in sorted(n.encode() for n in names):
+        shared = 0
+        limit = min(len(previous), len(name), 0xFFFF)
+        while shared < limit and previous[shared] == name[shared]:
+            shared += 1
+        suffix = name[shared:]
+        parts.append(_U16.pack(shared) + _U16.pack(len(suffix)) + suffix)
+        previous = name
+    return b"".join(parts)
+
+
+def pack_codecs(codecs) -> bytes:
+    """Codecs aceitos, em ordem de preferência."""
+    return _U8.pack(len(codecs)) + bytes(codecs)
+
+
+def pack_ranges(runs) -> bytes:
+    """Faixas [(início, fim_exclusivo)] de blocos."""
+    return _U32.pack(len(runs)) + b"".join(_RANGE.pack(start, stop) for start, stop in runs)
+
+
+class Payload:
+    """Leitor sequencial dos campos de um payload binário."""
+    def __init__(self, data: bytes):
+        self._data = memoryview(data)
+        self._pos = 0
+
+    def _take(self, n: int) -> memoryview:
+        if self._pos + n > len(self._data):
+            raise ProtocolError("payload truncado")
+        chunk = self._data[self._pos:self._pos + n]
+        self._pos += n
+        return chunk
+
+    def more(self) -> bool:
+        """Há campos opcionais depois da posição atual."""
+        return self._pos < len(self._data)
+
+    def u8(self) -> int:
+        return self._take(1)[0]
+
+    def u16(self) -> int:
+        return _U16.unpack(self._take(2))[0]
+
+    def u32(self) -> int:
+        return _U32.unpack(self._take(4))[0]
+
+    def u64(self) -> int:
+        return _U64.unpack(self._take(8))[0]
+
+    def str(self) -> str:
+        return bytes(self._take(self.u16())).decode()
+
+    def blob(self) -> bytes:
+        return bytes(self._take(self.u32()))
+
+    def names(self) -> list:
+        names = []
+        previous = b""
+        for _ in range(self.u32()):
+            shared = self.u16()
+            if shared > len(previous):
+                raise ProtocolError("prefixo compartilhado inválido")
+            name = previous[:shared] + bytes(self._take(self.u16()))
+            names.append(name.decode())
+            previous = name
+        return names
+
+    def codecs(self) -> list:
+        return list(self._take(self.u8()))
+
+    def ranges(self) -> list:
+        return [_RANGE.unpack(self._take(_RANGE.size)) for _ in range(self.u32())]
+
+    def rest(self) -> bytes:
+        return bytes(self._take(len(self._data) - self._pos))
+
+
+def pack_frame(msg_type: int, request_id: int, payload: bytes = b"") -> bytes:
+    return HEADER.pack(MAGIC, VERSION, msg_type, request_id, len(payload)) + payload
+
+
+def recv_exact(sock, n: int):
+    """Lê exatamente n bytes, ou None se a conexão fechar antes."""
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        read = sock.recv_into(view[got:], n - got)
+        if not read:
+            return None
+        got += read
+    return bytes(buf)
+
+
+def peek_magic(sock, timeout=PEEK_TIMEOUT) -> bool:
+    """
+    Diz se a conexão usa quadros, sem consumir nada do socket.
+
+    Se só chegou parte do prefixo, espera o resto por até timeout segundos
+    (o byte espiado deixa o socket sempre legível, então não dá para só
+    esperar no select): entre uma espiada e outra dorme até POLL_INTERVAL,
+    acordando antes se o cliente fechar. Prefixo incompleto no fim do prazo
+    ou com a conexão fechada conta como texto; quem ler depois vê o fim.
+    """
+    deadline = time.monotonic() + timeout
+    hangup = getattr(select, "POLLRDHUP", 0) | select.POLLHUP
+    poller = None
+    while True:
+        head = sock.recv(len(MAGIC), socket.MSG_PEEK)
+        if not head:
+            return False
+        if len(head) == len(MAGIC) or not MAGIC.startswith(head):
+            return head == MAGIC
+        # só chegou parte do prefixo; espera o resto sem girar a CPU
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        if poller is None:
+            poller = select.poll()
+            poller.register(sock, hangup)
+        if poller.poll(min(remaining, POLL_INTERVAL) * 1000):
+            return False  # o cliente fechou com o prefixo pela metade
+
+
+def parse_header(raw: bytes):
+    magic, version, msg_type, request_id, length = HEADER.unpack(raw)
+    if magic != MAGIC:
+        raise ProtocolError("quadro sem o prefixo P2")
+    if version != VERSION:
+        raise ProtocolError(f"versão {version} do protocolo não suportada")
+    if length > MAX_PAYLOAD:
+        raise ProtocolError(f"payload de {length} bytes")
+    return msg_type, request_id, length
+
+
+def recv_frame(sock):
+    """Lê um quadro: (tipo, id do pedido, payload), ou None se a conexão fechar."""
+    raw = recv_exact(sock, HEADER.size)
+    if raw is None:
+        return None
+    msg_type, request_id, length = parse_header(raw)
+    payload = recv_exact(sock, length) if length else b""
+    if payload is None:
+        return None
+    return msg_type, request_id, payload
+
+
+async def read_frame(reader, prefix: bytes = b""):
+    """Versão asyncio de recv_frame; prefix são bytes do header já lidos."""
+    try:
+        raw = prefix + await reader.readexactly(HEADER.size - len(prefix))
+        msg_type, request_id, length = parse_header(raw)
+        payload = await reader.readexactly(length) if length else b""
+    except asyncio.IncompleteReadError:
+        return None
+    return msg_type, request_id, payload
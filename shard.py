@@ -0,0 +1,437 @@
+import bisect
+import hashlib
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from catalog import CatalogIndex, take_page
+from protocol import (
+    MSG_BUSY, MSG_DISCONNECT, MSG_ERROR, MSG_HAVE, MSG_HOLDERS, MSG_HOLDERS_MANY, MSG_NEW_FILE, MSG_OK, MSG_REGISTER,
+    MSG_SEARCH_RESULT, MSG_SHARD_INDEX, MSG_SHARD_SEARCH, MSG_WHO_HAS, MSG_WHO_HAS_MANY,
+    Payload, ProtocolError, pack_str, pack_u16, pack_u32, pack_names, pack_u8,
+)
+from tracker import ACKS, REQUEST_TIMEOUT, Tracker, parse_port
+from tracker_client import TrackerBusy, TrackerSession
+
+VIRTUAL_NODES = 64  # pontos de cada shard no anel
+INDEX_BATCH = 10000  # operações de índice por mensagem a um shard
+FLUSH_RETRY = 0.5  # primeira espera antes de reenviar operações a um shard que falhou (dobra a cada falha)
+FLUSH_RETRY_MAX = 30.0  # espera máxima entre dois reenvios
+
+# operações de índice do MSG_SHARD_INDEX
+OP_DISCARD = 0  # o peer não tem mais o arquivo
+OP_ADD = 1  # o peer tem o arquivo
+OP_PARTIAL = 2  # o peer anunciou um download do arquivo em andamento (HAVE)
+OP_PARTIAL_DONE = 3  # o download terminou ou foi abandonado
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Hashing consistente: cada shard ocupa VIRTUAL_NODES pontos de um anel de
+    64 bits e uma chave pertence ao primeiro ponto depois do hash dela.
+    """
+    def __init__(self, shards, virtual_nodes=VIRTUAL_NODES):
+        points = sorted((_hash(f"shard-{shard}-{v}"), shard)
+                        for shard in range(shards) for v in range(virtual_nodes))
+        self._hashes = [h for h, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard(self, key: str) -> int:
+        idx = bisect.bisect(self._hashes, _hash(key))
+        return self._shards[idx % len(self._shards)]
+
+
+def pack_index_ops(ops) -> bytes:
+    """[(operação, peer_id, endereço, arquivo)] para o MSG_SHARD_INDEX."""
+    return pack_u32(len(ops)) + b"".join(
+        pack_u8(op) + pack_str(peer_id) + pack_str(addr) + pack_str(filename)
+        for op, peer_id, addr, filename in ops)
+
+
+class ShardedTracker(Tracker):
+    """
+    Um dos processos de um tracker com shards.
+
+    Cada peer tem um shard "casa" (hash do peer_id), dono do registro dele,
+    das checagens VERIFY_FILES e do journal. Cada nome de arquivo pertence a
+    um shard (hash do nome), que guarda essa fatia do índice WHO_HAS e do
+    catálogo do SEARCH. Pedidos que chegam ao shard errado são repassados,
+    pela porta interna, ao shard certo; mudanças no catálogo de um peer viram
+    operações de índice enviadas em lote só aos shards afetados. Um
+    WHO_HAS_MANY é dividido entre os donos dos nomes, e um SEARCH junta as
+    páginas de todos os shards.
+    """
+    def __init__(self, shard, ring, internal_ports, sock, internal_sock, **options):
+        self.shard = shard
+        self.ring = ring
+        # fatia do índice deste shard: arquivo -> {peer_id: endereço}
+        self.shard_index = {}
+        self._outbox = []  # operações de índice pendentes, na ordem em que aconteceram
+        # operações ainda não confirmadas por cada shard dono; só saem daqui
+        # depois do OK dele, e as novas entram atrás das que falharam
+        self._undelivered = defaultdict(list)
+        self._flush_lock = threading.Lock()
+        self._retry = threading.Event()  # há operações esperando reenvio
+        # pedidos de peers repassados ao shard casa, que estava fora do ar,
+        # esperando reenvio na ordem em que chegaram
+        self._forwards = defaultdict(list)
+        self._forward_locks = defaultdict(threading.Lock)
+        self.internal_socket = internal_sock
+        self.sessions = {i: TrackerSession(("127.0.0.1", p))
+                         for i, p in enumerate(internal_ports) if i != shard}
+        super().__init__(sock=sock, **options)
+
+    def _home(self, peer_id) -> int:
+        return self.ring.shard(f"peer:{peer_id}")
+
+    def _restore(self, state_dir, snapshot_every):
+        # cada shard guarda só os peers de que é casa
+        super()._restore(os.path.join(state_dir, f"shard{self.shard}"), snapshot_every)
+        for filename, holders in self.files.items():
+            for peer_id in holders:
+                self._outbox.append((OP_ADD, peer_id, self.peers[peer_id]["addr"], filename))
+        self.files = {}  # publicado nos shards donos no start()
+        self.catalog = CatalogIndex()
+
+    # o Tracker chama estes dois a cada mudança de catálogo, com self.lock
+    def _index_add(self, peer_id, filename):
+        self._outbox.append((OP_ADD, peer_id, self.peers[peer_id]["addr"], filename))
+
+    def _index_discard(self, peer_id, filename):
+        self._outbox.append((OP_DISCARD, peer_id, "", filename))
+
+    def _partial_update(self, addr, filename, active):
+        self._outbox.append((OP_PARTIAL if active else OP_PARTIAL_DONE, "", addr, filename))
+
+    def _flush(self) -> bool:
+        """
+        Envia as operações de índice pendentes aos shards donos, em lotes de
+        até INDEX_BATCH. Um lote só é descartado depois do OK do shard; se
+        ele falha, o lote e os seguintes ficam para o reenvio (_redeliver),
+        na mesma ordem. Reaplicar uma operação não muda o índice, então um
+        lote reenviado depois de um OK perdido é inofensivo. Devolve True se
+        nada ficou pendente.
+        """
+        with self._flush_lock:
+            with self.lock:
+                ops, self._outbox = self._outbox, []
+            for op in ops:
+                self._undelivered[self.ring.shard(op[3])].append(op)
+
+            for shard in list(self._undelivered):
+                pending = self._undelivered[shard]
+                if shard == self.shard:
+                    self._apply_index(pending)
+                    del self._undelivered[shard]
+                    continue
+                try:
+                    while pending:
+                        batch = pending[:INDEX_BATCH]
+                        msg_type, payload = self.sessions[shard].call(MSG_SHARD_INDEX, pack_index_ops(batch))
+                        if msg_type != MSG_OK:
+                            raise ProtocolError(Payload(payload).str())
+                        del pending[:len(batch)]
+                except Exception as e:
+                    self.metrics.counter("index_retries").inc()
+                    print(f"[WARNING] Shard {shard} não recebeu {len(pending)} operações de índice ({e}); "
+                          f"reenvio agendado")
+                    continue
+                del self._undelivered[shard]
+
+            if self._undelivered:
+                self._retry.set()
+                return False
+            self._retry.clear()
+            return True
+
+    def _forward(self, home, msg_type, payload):
+        """
+        Repassa ao shard casa de um peer um pedido que muda o estado dele e
+        devolve a resposta do shard (erros e BUSY incluídos). Se o shard não
+        responde, o pedido entra na fila de reenvio (_redeliver) e devolve
+        None; os seguintes para o mesmo shard entram atrás dele, para a casa
+        aplicar tudo na ordem. Os quatro pedidos repassados deixam o estado
+        igual se aplicados de novo, então um reenvio depois de uma resposta
+        perdida é inofensivo.
+        """
+        with self._forward_locks[home]:
+            pending = self._forwards[home]
+            if not pending:
+                try:
+                    return self.sessions[home].call(msg_type, payload)
+                except TrackerBusy as e:
+                    return MSG_BUSY, pack_str(str(e))
+                except OSError as e:
+                    print(f"[WARNING] Shard {home} não recebeu um pedido repassado ({e}); reenvio agendado")
+            pending.append((msg_type, payload))
+        self.metrics.counter("forward_retries").inc()
+        self._retry.set()
+        return None
+
+    def _forward_or_raise(self, home, msg_type, payload):
+        response = self._forward(home, msg_type, payload)
+        if response is not None and response[0] != MSG_OK:
+            raise ProtocolError(f"shard {home} recusou o pedido: {Payload(response[1]).str()}")
+
+    def _flush_forwards(self) -> bool:
+        """Reenvia os pedidos repassados que ficaram na fila; devolve True se nada ficou pendente."""
+        done = True
+        for home in list(self._forwards):
+            with self._forward_locks[home]:
+                pending = self._forwards[home]
+                try:
+                    while pending:
+                        msg_type, payload = pending[0]
+                        response_type, response = self.sessions[home].call(msg_type, payload)
+                        if response_type != MSG_OK:
+                            # o peer já recebeu o OK; só resta registrar a recusa
+                            print(f"[WARNING] Shard {home} recusou um pedido reenviado: {Payload(response).str()}")
+                        pending.pop(0)
+                except OSError:
+                    done = False
+        return done
+
+    def _redeliver(self):
+        """Reenvia as operações e os pedidos que um shard não confirmou, com esperas crescentes."""
+        delay = FLUSH_RETRY
+        while True:
+            self._retry.wait()
+            time.sleep(delay)
+            forwarded = self._flush_forwards()
+            if self._flush() and forwarded:
+                delay = FLUSH_RETRY
+            else:
+                delay = min(delay * 2, FLUSH_RETRY_MAX)
+
+    def _apply_index(self, ops):
+        with self.lock:
+            for op, peer_id, addr, filename in ops:
+                if op in (OP_PARTIAL, OP_PARTIAL_DONE):
+                    Tracker._partial_update(self, addr, filename, op == OP_PARTIAL)
+                elif op == OP_ADD:
+                    holders = self.shard_index.get(filename)
+                    if holders is None:
+                        holders = self.shard_index[filename] = {}
+                        self.catalog.add(filename)
+                    holders[peer_id] = addr
+                else:
+                    holders = self.shard_index.get(filename)
+                    if holders is not None:
+                        holders.pop(peer_id, None)
+                        if not holders:
+                            del self.shard_index[filename]
+                            self.catalog.discard(filename)
+
+    # pedidos de um peer vão para o shard casa dele; WHO_HAS, para o dono do nome
+
+    def _register_peer(self, peer_id, peer_ip, peer_port, files):
+        home = self._home(peer_id)
+        if home != self.shard:
+            self._forward_or_raise(home, MSG_REGISTER, pack_str(peer_ip) + pack_str(peer_id)
+                                   + pack_u16(parse_port(peer_port)) + pack_names(files))
+            return
+        super()._register_peer(peer_id, peer_ip, peer_port, files)
+        self._flush()
+
+    def _new_file(self, peer_id, filename):
+        home = self._home(peer_id)
+        if home != self.shard:
+            self._forward_or_raise(home, MSG_NEW_FILE, pack_str(peer_id) + pack_str(filename))
+            return
+        super()._new_file(peer_id, filename)
+        self._flush()
+
+    def _disconnect(self, peer_id):
+        home = self._home(peer_id)
+        if home != self.shard:
+            self._forward_or_raise(home, MSG_DISCONNECT, pack_str(peer_id))
+            return
+        super()._disconnect(peer_id)
+        self._flush()
+
+    def _have(self, peer_id, filename, received, total):
+        home = self._home(peer_id)
+        if home != self.shard:
+            self._forward_or_raise(home, MSG_HAVE, pack_str(peer_id) + pack_str(filename)
+                                   + pack_u32(received) + pack_u32(total))
+            return
+        super()._have(peer_id, filename, received, total)
+        self._flush()
+
+    def _who_has(self, filename):
+        owner = self.ring.shard(filename)
+        if owner != self.shard:
+            msg_type, payload = self.sessions[owner].call(MSG_WHO_HAS, pack_str(filename))
+            if msg_type != MSG_HOLDERS:
+                raise ProtocolError(f"shard {owner} recusou WHO_HAS: {Payload(payload).str()}")
+            return Payload(payload).names()
+        with self.lock:
+            return list(self.shard_index.get(filename, {}).values())
+
+    def _who_has_many(self, filenames):
+        by_shard = defaultdict(list)
+        for filename in filenames:
+            by_shard[self.ring.shard(filename)].append(filename)
+        entries = super()._who_has_many(by_shard.pop(self.shard, []))
+        for shard, names in by_shard.items():
+            msg_type, payload = self.sessions[shard].call(MSG_WHO_HAS_MANY, pack_names(names))
+            p = Payload(payload)
+            if msg_type != MSG_HOLDERS_MANY:
+                raise ProtocolError(f"shard {shard} recusou WHO_HAS_MANY: {p.str()}")
+            entries += [(p.str(), p.names(), p.names()) for _ in range(p.u32())]
+        return entries
+
+    def _search(self, mode, pattern, after, limit):
+        # cada shard devolve a sua primeira página depois de after; a página
+        # pedida são os primeiros nomes da junção delas
+        names, more = super()._search(mode, pattern, after, limit)
+        request = pack_u8(mode) + pack_str(pattern) + pack_str(after) + pack_u32(limit)
+        for shard, session in self.sessions.items():
+            msg_type, payload = session.call(MSG_SHARD_SEARCH, request)
+            p = Payload(payload)
+            if msg_type != MSG_SEARCH_RESULT:
+                raise ProtocolError(f"shard {shard} recusou SEARCH: {p.str()}")
+            more |= bool(p.u8())
+            names += p.names()
+        page, cut = take_page(sorted(names), limit)
+        return page, more or cut
+
+    # checagens mudam catálogos e removem peers: publica o que mudou
+
+    def _verify_peer_files(self, *args):
+        try:
+            return super()._verify_peer_files(*args)
+        finally:
+            self._flush()
+
+    def _record_check(self, *args):
+        super()._record_check(*args)
+        self._flush()
+
+    def _process_message(self, msg_type, payload):
+        if msg_type == MSG_SHARD_INDEX:
+            p = Payload(payload)
+            ops = [(p.u8(), p.str(), p.str(), p.str()) for _ in range(p.u32())]
+            self._apply_index(ops)
+            return MSG_OK, b""
+        if msg_type == MSG_SHARD_SEARCH:
+            try:
+                p = Payload(payload)
+                names, more = Tracker._search(self, p.u8(), p.str(), p.str(), p.u32())
+            except Exception as e:
+                return MSG_ERROR, pack_str(f"pedido inválido: {e}")
+            return MSG_SEARCH_RESULT, pack_u8(more) + pack_names(names)
+        if msg_type in ACKS:
+            # a resposta da casa do peer volta como veio; se ela está fora do
+            # ar, o pedido fica na fila de reenvio e o peer recebe o OK de sempre
+            try:
+                p = Payload(payload)
+                if msg_type == MSG_REGISTER:
+                    _, peer_id = p.str(), p.str()
+                    parse_port(p.u16())  # um OK de pedido na fila tem que ser de um pedido válido
+                else:
+                    peer_id = p.str()
+                home = self._home(peer_id)
+            except Exception as e:
+                return MSG_ERROR, pack_str(f"pedido inválido: {e}")
+            if home != self.shard:
+                return self._forward(home, msg_type, payload) or (MSG_OK, pack_str(ACKS[msg_type]))
+        if msg_type == MSG_WHO_HAS:
+            # a resposta inteira (holders e downloads em andamento) vem do dono do nome
+            try:
+                owner = self.ring.shard(Payload(payload).str())
+                if owner != self.shard:
+                    return self.sessions[owner].call(msg_type, payload)
+            except Exception as e:
+                return MSG_ERROR, pack_str(f"pedido inválido: {e}")
+        return super()._process_message(msg_type, payload)
+
+    def stats(self) -> dict:
+        snap = super().stats()
+        with self.lock:
+            snap["registro"]["shard"] = self.shard
+            snap["registro"]["arquivos"] = len(self.shard_index)
+        return snap
+
+    def _accept_internal(self):
+        while True:
+            connection, address = self.internal_socket.accept()
+            connection.settimeout(REQUEST_TIMEOUT)
+            threading.Thread(target=self.handle_request, args=(connection, address), daemon=True).start()
+
+    def _watch_parent(self, parent):
+        # um processo pai morto (kill -9) não leva os filhos junto
+        while os.getppid() == parent:
+            time.sleep(1)
+        os._exit(0)
+
+    def start(self):
+        threading.Thread(target=self._watch_parent, args=(os.getppid(),), daemon=True).start()
+        threading.Thread(target=self._accept_internal, daemon=True).start()
+        threading.Thread(target=self._redeliver, daemon=True).start()
+        self._flush()  # índice restaurado do disco
+        print(f"Shard {self.shard} (pid {os.getpid()}) atendendo na porta {self.port}")
+        super().start()
+
+
+def _listener(host, port, backlog, reuse_port=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+def _run_shard(shard, ring, internal_ports, sock, internal_sock, options):
+    ShardedTracker(shard, ring, internal_ports, sock, internal_sock, **options).start()
+
+
+def run_sharded(shards, port, backlog, **options):
+    """
+    Sobe o tracker em `shards` processos. Cada processo escuta na mesma porta
+    pública (SO_REUSEPORT: o kernel distribui as conexões entre eles) e numa
+    porta interna em 127.0.0.1, usada para repassar pedidos entre shards.
+    Todos os sockets são abertos antes do fork, então nenhum shard tenta
+    falar com outro que ainda não escuta.
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise SystemExit("--shards precisa de SO_REUSEPORT (Linux ou BSD)")
+    ring = HashRing(shards)
+    public = [_listener("0.0.0.0", port, backlog, reuse_port=True) for _ in range(shards)]
+    internal = [_listener("127.0.0.1", 0, backlog) for _ in range(shards)]
+    internal_ports = [s.getsockname()[1] for s in internal]
+
+    ctx = multiprocessing.get_context("fork")
+    workers = []
+    for shard in range(shards):
+        worker = ctx.Process(target=_run_shard, name=f"tracker-shard-{shard}",
+                             args=(shard, ring, internal_ports, public[shard], internal[shard], options))
+        worker.start()
+        workers.append(worker)
+    for s in public + internal:
+        s.close()  # os processos filhos têm as suas cópias
+    # kill (SIGTERM) no pai também encerra os shards, pelo finally abaixo
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    try:
+        while all(w.is_alive() for w in workers):
+            time.sleep(1)
+        print("[ERROR] Um shard terminou; encerrando o tracker")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for w in workers:
+            w.terminate()
+        for w in workers:
+            w.join()
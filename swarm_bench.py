@@ -0,0 +1,339 @@
+# swarm_bench.py
+"""
+Benchmark automatizado de um enxame em localhost.
+
+Sobe um tracker e vários peers (processos de verdade, cada um na sua porta),
+gera arquivos sintéticos e roda os cenários:
+
+  single      1 peer com o arquivo, 1 downloader
+  multi       --seeders peers com o arquivo, 1 downloader
+  concurrent  --seeders peers com o arquivo, --downloaders baixando ao mesmo tempo
+  churn       como multi, mas metade dos seeders cai no meio da transferência
+
+Para cada cenário e tamanho grava vazão (MB/s), tempo de conclusão
+(p50/p95/p99) e CPU e pico de memória (RSS) de cada processo num JSON, que
+plot_results.py compara com rodadas anteriores.
+
+Uso: python swarm_bench.py [--sizes 4,32] [--scenarios single,multi] [--out swarm_results.json]
+"""
+import argparse
+import json
+import os
+import platform
+import queue
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ("single", "multi", "concurrent", "churn")
+STARTUP_TIMEOUT = 10.0  # espera máxima para um processo subir
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    """Percentil p (0-100) por interpolação linear; None sem valores."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * p / 100
+    low = int(k)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (k - low)
+
+
+def process_usage(pid):
+    """CPU (s) e pico de RSS (KiB) de um processo vivo, lidos de /proc; None fora do Linux."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS  # utime + stime
+        peak = None
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    peak = int(line.split()[1])
+        return {"cpu_s": round(cpu, 3), "peak_rss_kb": peak}
+    except (OSError, IndexError, ValueError):
+        return {"cpu_s": None, "peak_rss_kb": None}
+
+
+class Process:
+    """Um processo do enxame com a saída lida numa thread, linha a linha."""
+    def __init__(self, name, cmd, cwd):
+        self.name = name
+        self.usage = None
+        self.proc = subprocess.Popen(cmd, cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT, text=True, bufsize=1)
+        self.lines = queue.Queue()
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+
+    def _read(self):
+        for line in self.proc.stdout:
+            self.lines.put((time.monotonic(), line.rstrip("\n")))
+        self.lines.put((time.monotonic(), None))
+
+    def send(self, command):
+        self.proc.stdin.write(command + "\n")
+        self.proc.stdin.flush()
+
+    def wait_for(self, predicate, timeout):
+        """Espera uma linha que satisfaça predicate; devolve (instante, linha) ou (None, None)."""
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None, None
+            try:
+                at, line = self.lines.get(timeout=remaining)
+            except queue.Empty:
+                return None, None
+            if line is None:
+                return None, None
+            if predicate(line):
+                return at, line
+
+    def sample(self):
+        """Guarda CPU e RSS enquanto o processo ainda existe."""
+        if self.proc.poll() is None:
+            self.usage = process_usage(self.proc.pid)
+        return self.usage
+
+    def kill(self):
+        self.sample()
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+
+    def stop(self):
+        self.sample()
+        if self.proc.poll() is None:
+            try:
+                self.send("exit")
+                self.proc.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                self.proc.kill()
+                self.proc.wait()
+
+
+class Swarm:
+    """Tracker e peers num diretório temporário; cada cenário usa um enxame novo."""
+    def __init__(self, workdir, peer_args=()):
+        self.workdir = workdir
+        self.peer_args = list(peer_args)
+        self.tracker_port = free_port()
+        self.processes = []
+        self.tracker = self._spawn("tracker", [sys.executable, os.path.join(HERE, "tracker.py"),
+                                               "--port", str(self.tracker_port)])
+        self._wait_port(self.tracker_port)
+
+    def _spawn(self, name, cmd):
+        process = Process(name, cmd, self.workdir)
+        self.processes.append(process)
+        return process
+
+    def _wait_port(self, port):
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError(f"nada escutando na porta {port}")
+
+    def peer(self, peer_id, files=()):
+        """Sobe um peer já com os arquivos dados e espera ele se registrar."""
+        files_dir = os.path.join(self.workdir, peer_id, "files")
+        os.makedirs(files_dir, exist_ok=True)
+        for path in files:
+            target = os.path.join(files_dir, os.path.basename(path))
+            if not os.path.exists(target):
+                try:
+                    os.link(path, target)
+                except OSError:
+                    shutil.copy(path, target)
+
+        port = free_port()
+        process = self._spawn(peer_id, [sys.executable, "-u", os.path.join(HERE, "peer.py"), peer_id,
+                                        str(port), "127.0.0.1", "--tracker-port", str(self.tracker_port),
+                                        *self.peer_args])
+        _, line = process.wait_for(lambda l: "Tracker response" in l, STARTUP_TIMEOUT)
+        if line is None or "REGISTERED" not in line:
+            process.kill()
+            raise RuntimeError(f"peer {peer_id} não se registrou no tracker")
+        self._wait_port(port)
+        process.port = port
+        return process
+
+    def usage(self) -> dict:
+        return {p.name: p.sample() for p in self.processes}
+
+    def close(self):
+        for process in reversed(self.processes):
+            process.stop()
+
+
+def download(process, filename, timeout):
+    """Dispara o download em segundo plano e devolve (ok, segundos)."""
+    started = time.monotonic()
+    process.send(f"bg {filename}")
+    at, line = process.wait_for(lambda l: f"[BG] {filename}:" in l, timeout)
+    if line is None:
+        return False, None
+    return line.endswith("ok"), at - started
+
+
+def synthetic_file(directory, size_mb):
+    path = os.path.join(directory, f"synthetic_{size_mb}MB.bin")
+    if not os.path.exists(path):
+        with open(path, "wb") as f:
+            remaining = size_mb * 1024 * 1024
+            while remaining:
+                chunk = min(remaining, 1024 * 1024)
+                f.write(os.urandom(chunk))
+                remaining -= chunk
+    return path
+
+
+def run_scenario(scenario, path, opts):
+    """Roda um cenário num enxame novo e devolve o dicionário de resultados dele."""
+    workdir = tempfile.mkdtemp(prefix=f"swarm_{scenario}_")
+    filename = os.path.basename(path)
+    size = os.path.getsize(path)
+    seeders = 1 if scenario == "single" else opts.seeders
+    times, failures = [], 0
+    swarm = Swarm(workdir, opts.peer_args)
+    try:
+        holders = [swarm.peer(f"S{i}", [path]) for i in range(seeders)]
+
+        for rep in range(opts.repeat):
+            if scenario == "concurrent":
+                clients = [swarm.peer(f"D{rep}_{i}") for i in range(opts.downloaders)]
+                results = [None] * len(clients)
+
+                def fetch(i, client):
+                    results[i] = download(client, filename, opts.timeout)
+
+                threads = [threading.Thread(target=fetch, args=(i, c)) for i, c in enumerate(clients)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+            else:
+                client = swarm.peer(f"D{rep}")
+                clients = [client]
+                if scenario == "churn":
+                    # derruba metade dos seeders (que ainda estão vivos) logo depois do pedido
+                    alive = [h for h in holders if h.proc.poll() is None]
+                    victims = alive[:len(alive) // 2]
+                    killer = threading.Timer(opts.churn_delay, lambda: [v.kill() for v in victims])
+                    killer.start()
+                    results = [download(client, filename, opts.timeout)]
+                    killer.join()
+                    # o próximo round começa de novo com o enxame completo
+                    for v in victims:
+                        holders[holders.index(v)] = swarm.peer(f"{v.name}r{rep}", [path])
+                else:
+                    results = [download(client, filename, opts.timeout)]
+
+            # downloaders saem do enxame, senão virariam fontes nas rodadas seguintes
+            for client in clients:
+                client.stop()
+            for ok, seconds in results:
+                if ok:
+                    times.append(seconds)
+                else:
+                    failures += 1
+    finally:
+        usage = swarm.usage()
+        swarm.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    mb = size / 1e6
+    return {
+        "scenario": scenario,
+        "size_bytes": size,
+        "seeders": seeders,
+        "downloaders": opts.downloaders if scenario == "concurrent" else 1,
+        "downloads": len(times) + failures,
+        "failures": failures,
+        "times_s": [round(t, 4) for t in times],
+        "p50_s": percentile(times, 50),
+        "p95_s": percentile(times, 95),
+        "p99_s": percentile(times, 99),
+        "throughput_mbps": (mb * len(times) / sum(times)) if times else 0.0,
+        "processes": usage,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark de um enxame de peers em localhost")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"cenários separados por vírgula ({', '.join(SCENARIOS)})")
+    parser.add_argument("--sizes", default="4,32", help="tamanhos dos arquivos sintéticos em MiB")
+    parser.add_argument("--seeders", type=int, default=4, help="peers com o arquivo nos cenários multi/concurrent/churn")
+    parser.add_argument("--downloaders", type=int, default=4, help="downloaders simultâneos no cenário concurrent")
+    parser.add_argument("--repeat", type=int, default=3, help="rodadas de cada cenário")
+    parser.add_argument("--churn-delay", type=float, default=0.1,
+                        help="segundos entre o pedido e a queda dos seeders no cenário churn")
+    parser.add_argument("--timeout", type=float, default=120.0, help="tempo máximo de um download")
+    parser.add_argument("--peer-args", default="", help="opções extras repassadas a todos os peers")
+    parser.add_argument("--out", default="swarm_results.json", help="arquivo JSON de resultados")
+    opts = parser.parse_args(argv)
+
+    scenarios = [s for s in opts.scenarios.split(",") if s]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"cenário desconhecido: {', '.join(sorted(unknown))}")
+    opts.peer_args = opts.peer_args.split()
+
+    datadir = tempfile.mkdtemp(prefix="swarm_data_")
+    results = []
+    try:
+        for size_mb in (int(s) for s in opts.sizes.split(",") if s):
+            path = synthetic_file(datadir, size_mb)
+            for scenario in scenarios:
+                print(f"[BENCH] {scenario} com {size_mb} MiB...", flush=True)
+                result = run_scenario(scenario, path, opts)
+                results.append(result)
+                summary = (f"{result['throughput_mbps']:.1f} MB/s, p50 {result['p50_s']:.2f}s"
+                           if result["times_s"] else "nenhum download completo")
+                print(f"[BENCH] {scenario} {size_mb} MiB: {summary} ({result['failures']} falha(s))", flush=True)
+    finally:
+        shutil.rmtree(datadir, ignore_errors=True)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "options": {k: v for k, v in vars(opts).items() if k != "out"},
+        "results": results,
+    }
+    with open(opts.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"[BENCH] resultados em {opts.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,41 +1,349 @@
+import json
 import time
 import socket
+import argparse
+import asyncio
+import itertools
 import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout, as_completed
+from protocol import (
+    MAGIC, MSG_TEXT, MSG_REGISTER, MSG_WHO_HAS, MSG_NEW_FILE, MSG_DISCONNECT, MSG_HAVE, MSG_WHO_HAS_MANY,
+    MSG_SEARCH, MSG_VERIFY_FILES, MSG_STATS, MSG_OK, MSG_ERROR, MSG_HOLDERS, MSG_HOLDERS_MANY, MSG_FILES_OK,
+    MSG_CATALOG, MSG_BUSY, MSG_SNAPSHOT, MSG_SEARCH_RESULT, REQUEST_NAMES, Payload, ProtocolError, pack_frame,
+    pack_names, pack_str, pack_u8, pack_u32, peek_magic, recv_frame, read_frame,
+)
+from catalog import DEFAULT_PAGE, MAX_PAGE, CatalogIndex
+from journal import DEFAULT_SNAPSHOT_EVERY, TrackerJournal
+from metrics import Metrics
+
+TRACKER_PORT = 8000
+DEFAULT_BACKLOG = socket.SOMAXCONN
+DEFAULT_MAX_CONNECTIONS = 10000
+DEFAULT_CHECK_CONCURRENCY = 64  # VERIFY_FILES simultâneos numa varredura
+DEFAULT_CHECK_TIMEOUT = 2.0  # prazo de cada peer para responder, em segundos
+DEFAULT_MAX_FAILURES = 3  # falhas seguidas até o peer ser removido
+DEFAULT_STATE_DIR = "tracker_state"  # snapshot + journal do estado
+DEFAULT_REVALIDATE_BATCH = 256  # peers restaurados do disco checados por varredura
+PARTIAL_TTL = 30.0  # segundos que um HAVE vale sem ser renovado pelo peer
+MAX_WHO_HAS_BATCH = 1000  # arquivos num WHO_HAS_MANY
+REQUEST_TIMEOUT = 10  # segundos para o primeiro pedido chegar numa conexão aceita
+SESSION_IDLE_TIMEOUT = 300  # segundos sem pedidos até a sessão de um peer ser fechada (ele reconecta no próximo)
+CATALOG_BATCH = 2000  # nomes indexados para o SEARCH de cada vez que a thread de índice pega o lock
+REQUEST_WORKERS = 8  # threads do AsyncTracker que executam os pedidos (pegam o lock e escrevem o journal)
+
+# resposta de cada pedido que muda o estado de um peer
+ACKS = {
+    MSG_REGISTER: "REGISTERED",
+    MSG_HAVE: "HAVE",
+    MSG_NEW_FILE: "NEW FILE ADDED TO PEER FILES DIRECTORY",
+    MSG_DISCONNECT: "DISCONNECTED",
+}
+
+def parse_port(text) -> int:
+    """Porta anunciada por um peer (texto ou número), validada: ValueError fora de 1-65535."""
+    port = int(text)
+    if not 0 < port <= 0xFFFF:
+        raise ValueError(f"porta {text} fora de 1-65535")
+    return port
+
 
 # Rastreador para gerenciar peers em uma rede P2P simples
 class Tracker:
-    def __init__(self):
+    def __init__(self, port=TRACKER_PORT, backlog=DEFAULT_BACKLOG,
+                 check_concurrency=DEFAULT_CHECK_CONCURRENCY, check_timeout=DEFAULT_CHECK_TIMEOUT,
+                 max_failures=DEFAULT_MAX_FAILURES, state_dir=None, snapshot_every=DEFAULT_SNAPSHOT_EVERY,
+                 revalidate_batch=DEFAULT_REVALIDATE_BATCH, sock=None):
+        self.port = port
+        self.check_timeout = check_timeout
+        self.max_failures = max_failures
+        self.revalidate_batch = revalidate_batch
+        self._checks = ThreadPoolExecutor(max_workers=check_concurrency)
+        # checagens ainda rodando (future -> peer_id, endereço); uma varredura
+        # não espera as atrasadas, que são recolhidas pela seguinte
+        self._in_flight = {}
         self.peers = {}
+        # índice invertido: nome do arquivo -> ids dos peers que o têm.
+        # peers e files só são lidos ou alterados com self.lock
+        self.files = {}
+        # downloads em andamento (HAVE): arquivo -> {endereço do peer: vence em}.
+        # Só em memória: um peer baixando renova o anúncio a cada poucos segundos
+        self.partial = {}
+        # nomes de self.files, ordenados e com trigramas, para o SEARCH (catalog.py)
+        self.catalog = CatalogIndex()
         self.lock = threading.Lock()
+        self.metrics = Metrics()
+        self._connections = self.metrics.gauge("connections")
+        # com state_dir o estado sobrevive a um restart (journal.py); peers
+        # restaurados ficam em _unverified até a primeira checagem deles
+        self.journal = None
+        self._unverified = {}  # peer_id -> None, em ordem de restauração
+        if state_dir:
+            self._restore(state_dir, snapshot_every)
+        if sock is not None:
+            # socket já escutando, aberto por quem criou o tracker (shard.py)
+            self.server_socket = sock
+            return
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.bind(("0.0.0.0", 8000))
-        self.server_socket.listen(5)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind(("0.0.0.0", port))
+        self.server_socket.listen(backlog)
+
+    def _restore(self, state_dir, snapshot_every):
+        started = time.perf_counter()
+        self.journal = TrackerJournal(state_dir, snapshot_every)
+        entries = 0
+        index = self.files
+        for peer_id, saved in self.journal.load().items():
+            self.peers[peer_id] = {
+                "ip": saved["ip"],
+                "port": saved["port"],
+                "addr": f"{saved['ip']}:{saved['port']}",
+                "files": saved["files"],
+                "version": saved["version"],
+                "failures": 0
+            }
+            for filename in saved["files"]:
+                # o mesmo que _index_add, sem o custo da chamada
+                index.setdefault(filename, set()).add(peer_id)
+            entries += len(saved["files"])
+            self._unverified[peer_id] = None
+        self.catalog = CatalogIndex(index)
+        # a compactação fica para a varredura periódica, fora do caminho do restart
+        self.journal.open()
+        print(f"Estado restaurado de {state_dir}: {len(self.peers)} peers, {entries} arquivos "
+              f"em {(time.perf_counter() - started) * 1000:.0f} ms")
+
+    def compact_state(self):
+        """Grava um snapshot do estado atual e descarta os journals que ele cobre."""
+        with self.lock:
+            generation, data = self.journal.rotate(self.peers)
+        self.journal.write_snapshot(generation, data)
+
+    def _index_add(self, peer_id, filename):
+        holders = self.files.get(filename)
+        if holders is None:
+            holders = self.files[filename] = set()
+            self.catalog.add(filename)
+        holders.add(peer_id)
+
+    def _index_discard(self, peer_id, filename):
+        holders = self.files.get(filename)
+        if holders is not None:
+            holders.discard(peer_id)
+            if not holders:
+                del self.files[filename]
+                self.catalog.discard(filename)
+
+    def _register_peer(self, peer_id, peer_ip, peer_port, files):
+        # tudo que pode falhar (porta inválida, escrita no journal) vem antes
+        # de mexer no estado: um REGISTER recusado não deixa rastro na memória
+        peer_port = str(parse_port(peer_port))
+        info = {
+            "ip": peer_ip,
+            "port": peer_port,
+            "addr": f"{peer_ip}:{peer_port}",
+            "files": set(),
+            "version": None,
+            "failures": 0
+        }
+        with self.lock:
+            if self.journal:
+                self.journal.peer(peer_id, dict(info, files=set(files)))
+            self._remove_peer(peer_id)
+            self.peers[peer_id] = info
+            self._set_peer_files(peer_id, files)
+            self._unverified.pop(peer_id, None)
+
+    def _set_peer_files(self, peer_id, files):
+        # chamar com self.lock
+        info = self.peers[peer_id]
+        new_files = set(files)
+        for filename in info['files'] - new_files:
+            self._index_discard(peer_id, filename)
+        for filename in new_files - info['files']:
+            self._index_add(peer_id, filename)
+        info['files'] = new_files
+
+    def _add_peer_file(self, peer_id, filename):
+        # chamar com self.lock
+        self.peers[peer_id]['files'].add(filename)
+        self._index_add(peer_id, filename)
+
+    def _remove_peer(self, peer_id):
+        # chamar com self.lock
+        info = self.peers.pop(peer_id, None)
+        self._unverified.pop(peer_id, None)
+        if info is None:
+            return False
+        for filename in info['files']:
+            self._index_discard(peer_id, filename)
+        return True
+
+    def _new_file(self, peer_id, filename):
+        with self.lock:
+            if peer_id in self.peers:
+                self._add_peer_file(peer_id, filename)
+                self._partial_update(self.peers[peer_id]['addr'], filename, False)
+                if self.journal:
+                    self.journal.new_file(peer_id, filename)
+                print(f"Peer {peer_id} added new file: {filename}")
+
+    def _disconnect(self, peer_id):
+        with self.lock:
+            if self._remove_peer(peer_id):
+                if self.journal:
+                    self.journal.remove(peer_id)
+                print(f"Peer {peer_id} disconnected")
+
+    def _who_has(self, filename):
+        with self.lock:
+            return [self.peers[peer_id]['addr'] for peer_id in self.files.get(filename, ())]
+
+    def _who_has_many(self, filenames):
+        """[(arquivo, holders, peers baixando o arquivo)] de cada arquivo pedido."""
+        return [(filename, self._who_has(filename), self._partial_holders(filename)) for filename in filenames]
+
+    def _search(self, mode, pattern, after, limit):
+        """Uma página do SEARCH: (nomes, há mais?)."""
+        with self.lock:
+            return self.catalog.search(mode, pattern, after, limit)
+
+    def _partial_update(self, addr, filename, active):
+        # chamar com self.lock
+        if active:
+            self.partial.setdefault(filename, {})[addr] = time.monotonic() + PARTIAL_TTL
+            return
+        downloading = self.partial.get(filename)
+        if downloading is not None:
+            downloading.pop(addr, None)
+            if not downloading:
+                del self.partial[filename]
+
+    def _have(self, peer_id, filename, received, total):
+        """HAVE: o peer baixou received de total blocos do arquivo (0 ou total encerram o anúncio)."""
+        with self.lock:
+            if peer_id in self.peers:
+                self._partial_update(self.peers[peer_id]['addr'], filename, 0 < received < total)
+
+    def _partial_holders(self, filename):
+        """Peers com um download do arquivo em andamento; anúncios vencidos são descartados."""
+        now = time.monotonic()
+        with self.lock:
+            downloading = self.partial.get(filename)
+            if not downloading:
+                return []
+            for addr in [addr for addr, expires in downloading.items() if expires < now]:
+                del downloading[addr]
+            if not downloading:
+                del self.partial[filename]
+            return list(downloading)
     
-    def _verify_peer_files(self, peer_id, files):
+    def _verify_peer_files(self, peer_id, ip, port, version):
+        """
+        Manda VERIFY_FILES para o peer no endereço registrado. Devolve True se
+        ele respondeu dentro do prazo; o peer só devolve a lista inteira se a
+        versão do catálogo mudou.
+        """
+        deadline = time.monotonic() + self.check_timeout
+
+        def remaining():
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise socket.timeout("prazo esgotado")
+            return left
+
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             try:
-                s.settimeout(5)
-                s.connect(('127.0.0.1', int(self.peers[peer_id]['port'])))
-                s.sendall(f"VERIFY_FILES {','.join(files)}".encode())
-                response = s.recv(4096).decode()
+                s.settimeout(remaining())
+                s.connect((ip, int(port)))
+                s.settimeout(remaining())
+                s.sendall(pack_frame(MSG_VERIFY_FILES, 1, pack_u32(version or 0)))
+                s.settimeout(remaining())
+                frame = recv_frame(s)
+                if frame is None:
+                    raise ProtocolError("conexão fechada sem resposta")
             except Exception as e:
                 print(f"[ERROR] Peer {peer_id} não respondeu ao VERIFY_FILES: {e}")
+                return False
+
+        msg_type, _, payload = frame
+        if msg_type == MSG_CATALOG:
+            p = Payload(payload)
+            new_version, new_files = p.u32(), p.names()
+            with self.lock:
+                if self.peers.get(peer_id, {}).get('addr') == f"{ip}:{port}":
+                    self._set_peer_files(peer_id, new_files)
+                    self.peers[peer_id]['version'] = new_version
+                    if self.journal:
+                        self.journal.peer(peer_id, self.peers[peer_id])
+            print(f"Peer {peer_id} updated files list: {new_files}")
+        elif msg_type not in (MSG_FILES_OK, MSG_BUSY):
+            # BUSY: o peer está vivo, só sem thread livre agora
+            print(f"[ERROR] Resposta inválida de {peer_id} ao VERIFY_FILES: tipo {msg_type}")
+            return False
+        return True
+
+    def _record_check(self, peer_id, addr, ok):
+        with self.lock:
+            info = self.peers.get(peer_id)
+            if info is None or info['addr'] != addr:
+                return  # desconectou ou se registrou de novo durante a checagem
+            self.metrics.counter("checks", "ok" if ok else "falha").inc()
+            # checado uma vez, o peer restaurado entra nas varreduras normais
+            self._unverified.pop(peer_id, None)
+            if ok:
+                info['failures'] = 0
                 return
+            info['failures'] += 1
+            if info['failures'] >= self.max_failures:
+                self._remove_peer(peer_id)
+                if self.journal:
+                    self.journal.remove(peer_id)
+                print(f"Peer {peer_id} removido após {self.max_failures} falhas seguidas")
 
-            if response != "FILES_OK":
-                new_files = response.replace("New files list: ", "").split(",")
-                with self.lock:
-                    self.peers[peer_id]['files'] = new_files
-                print(f"Peer {peer_id} updated files list: {new_files}")
-        
     def _update_list_of_files(self):
-        for peer_id in self.peers:
-            self._verify_peer_files(peer_id, self.peers[peer_id]['files'])
+        # checa todos os peers em paralelo (até check_concurrency por vez) e
+        # registra cada resultado assim que ele chega. A varredura espera no
+        # máximo check_timeout: checagens que ainda estão na fila ou rodando
+        # passam para a próxima, e o peer delas não é checado de novo até lá.
+        # Peers restaurados do disco entram aos poucos, revalidate_batch por
+        # varredura, em vez de todos de uma vez depois de um restart
+        checking = {peer_id for peer_id, _ in self._in_flight.values()}
+        with self.lock:
+            batch = set(itertools.islice(self._unverified, self.revalidate_batch))
+            targets = [(peer_id, info['ip'], info['port'], info['version'])
+                       for peer_id, info in self.peers.items()
+                       if peer_id not in checking and (peer_id not in self._unverified or peer_id in batch)]
+
+        for peer_id, ip, port, version in targets:
+            future = self._checks.submit(self._verify_peer_files, peer_id, ip, port, version)
+            self._in_flight[future] = (peer_id, f"{ip}:{port}")
+        try:
+            for future in as_completed(list(self._in_flight), timeout=self.check_timeout):
+                peer_id, addr = self._in_flight.pop(future)
+                try:
+                    ok = future.result()
+                except Exception as e:
+                    print(f"[ERROR] Falha ao checar peer {peer_id}: {e}")
+                    ok = False
+                self._record_check(peer_id, addr, ok)
+        except FutureTimeout:
+            self.metrics.counter("checks", "adiadas").inc(len(self._in_flight))
+
+    def _index_catalog(self):
+        # trigramas do catálogo (restaurado do disco ou remontado) em lotes
+        # curtos, para não segurar o lock por muito tempo
+        while True:
+            with self.lock:
+                ready = self.catalog.index_pending(CATALOG_BATCH)
+            time.sleep(1 if ready else 0)
 
     def _periodic_update(self):
         while True:
             try:
                 self._update_list_of_files()
+                if self.journal and self.journal.needs_compaction():
+                    self.compact_state()
             except Exception as e:
                 print("Error updating files:", e)
             time.sleep(2)
@@ -54,26 +362,157 @@ class Tracker:
 
     def start(self):
         tracker_ip = self._get_my_ip()
-        print(f"Tracker running at {tracker_ip}:8000")
+        print(f"Tracker running at {tracker_ip}:{self.port}")
 
         threading.Thread(target=self._periodic_update, daemon=True).start()
+        threading.Thread(target=self._index_catalog, daemon=True).start()
         while True:
             connection, address = self.server_socket.accept()
+            connection.settimeout(REQUEST_TIMEOUT)
             threading.Thread(target=self.handle_request, args=(connection, address)).start()
 
+    def stats(self) -> dict:
+        """Snapshot das métricas mais o tamanho do registro."""
+        snap = self.metrics.snapshot()
+        with self.lock:
+            snap["registro"] = {"peers": len(self.peers), "arquivos": len(self.files),
+                                "não verificados": len(self._unverified),
+                                "downloads anunciados": sum(len(d) for d in self.partial.values())}
+        return snap
+
     def handle_request(self, connection, address):
+        self._connections.inc()
+        try:
+            self._handle_request(connection, address)
+        finally:
+            self._connections.dec()
+
+    def _handle_request(self, connection, address):
         try:
+            if peek_magic(connection):
+                self._serve_session(connection, address)
+                return
             raw = connection.recv(4096)
             if not raw:
                 connection.close()
                 return
             data = raw.decode().split()
+        except socket.timeout:
+            self.metrics.counter("idle_closed").inc()
+            connection.close()
+            return
         except Exception as e:
             print(f"[ERROR] Falha ao receber dados de {address}: {e}")
             connection.close()
             return
 
+        response = self.process_command(data)
+        try:
+            if response:
+                connection.sendall(response)
+        except Exception as e:
+            print(f"[ERROR] Falha ao responder {address}: {e}")
+
+        connection.close()
+
+    def _serve_session(self, connection, address):
+        # conexão persistente de um peer: vários comandos em quadros, cada
+        # resposta volta com o id do pedido. Ociosa por SESSION_IDLE_TIMEOUT,
+        # ela é fechada; o TrackerSession do peer reconecta no próximo pedido
+        connection.settimeout(SESSION_IDLE_TIMEOUT)
+        try:
+            while True:
+                frame = recv_frame(connection)
+                if frame is None:
+                    break
+                msg_type, request_id, payload = frame
+                response_type, response = self.process_message(msg_type, payload)
+                connection.sendall(pack_frame(response_type, request_id, response))
+        except socket.timeout:
+            self.metrics.counter("idle_closed").inc()
+        except Exception as e:
+            print(f"[ERROR] Sessão com {address} encerrada: {e}")
+        finally:
+            connection.close()
+
+    def process_message(self, msg_type, payload):
+        """Executa um pedido em quadro e devolve (tipo, payload) da resposta."""
+        name = REQUEST_NAMES.get(msg_type, str(msg_type))
+        started = time.perf_counter()
+        try:
+            return self._process_message(msg_type, payload)
+        finally:
+            self.metrics.counter("requests", name).inc()
+            self.metrics.histogram("latency", name).observe(time.perf_counter() - started)
+
+    def _process_message(self, msg_type, payload):
+        try:
+            p = Payload(payload)
+
+            if msg_type == MSG_REGISTER:
+                peer_ip, peer_id, peer_port, files = p.str(), p.str(), p.u16(), p.names()
+                self._register_peer(peer_id, peer_ip, str(peer_port), files)
+
+                print(f"Peer {peer_id} registered with files: {files}")
+                return MSG_OK, pack_str(ACKS[msg_type])
+
+            elif msg_type == MSG_WHO_HAS:
+                filename = p.str()
+                return MSG_HOLDERS, pack_names(self._who_has(filename)) + pack_names(self._partial_holders(filename))
+
+            elif msg_type == MSG_WHO_HAS_MANY:
+                filenames = p.names()
+                if len(filenames) > MAX_WHO_HAS_BATCH:
+                    return MSG_ERROR, pack_str(f"no máximo {MAX_WHO_HAS_BATCH} arquivos por WHO_HAS_MANY")
+                entries = self._who_has_many(filenames)
+                return MSG_HOLDERS_MANY, pack_u32(len(entries)) + b"".join(
+                    pack_str(filename) + pack_names(holders) + pack_names(partial)
+                    for filename, holders, partial in entries)
+
+            elif msg_type == MSG_SEARCH:
+                mode, pattern, after, limit = p.u8(), p.str(), p.str(), p.u32()
+                names, more = self._search(mode, pattern, after, max(1, min(limit or DEFAULT_PAGE, MAX_PAGE)))
+                return MSG_SEARCH_RESULT, pack_u8(more) + pack_names(names)
+
+            elif msg_type == MSG_HAVE:
+                peer_id, filename, received, total = p.str(), p.str(), p.u32(), p.u32()
+                self._have(peer_id, filename, received, total)
+                return MSG_OK, pack_str(ACKS[msg_type])
+
+            elif msg_type == MSG_NEW_FILE:
+                peer_id, filename = p.str(), p.str()
+                self._new_file(peer_id, filename)
+                return MSG_OK, pack_str(ACKS[msg_type])
+
+            elif msg_type == MSG_DISCONNECT:
+                self._disconnect(p.str())
+                return MSG_OK, pack_str(ACKS[msg_type])
+
+            elif msg_type == MSG_STATS:
+                return MSG_SNAPSHOT, json.dumps(self.stats()).encode()
+
+            elif msg_type == MSG_TEXT:
+                # camada de compatibilidade: comando de texto dentro de um quadro
+                return MSG_TEXT, self._process_command(payload.decode().split())
+        except Exception as e:
+            return MSG_ERROR, pack_str(f"pedido inválido: {e}")
+
+        return MSG_ERROR, pack_str(f"tipo de mensagem {msg_type} desconhecido")
+
+    def process_command(self, data):
+        """
+        Protocolo de texto antigo: executa um comando já separado em palavras
+        e devolve a resposta (ou b"").
+        """
+        name = f"{data[0]} (texto)" if data else "vazio (texto)"
+        started = time.perf_counter()
+        try:
+            return self._process_command(data)
+        finally:
+            self.metrics.counter("requests", name).inc()
+            self.metrics.histogram("latency", name).observe(time.perf_counter() - started)
 
+    def _process_command(self, data):
         try:
             command = data[0]
 
@@ -81,48 +520,155 @@ class Tracker:
                 peer_ip = data[1]
                 peer_id = data[2]
                 peer_port = data[3]
-                files = data[4].split(",")
-                with self.lock:
-                    self.peers[peer_id] = {
-                        "ip": peer_ip,
-                        "port": peer_port,
-                        "files": files
-                    }
-
-                connection.send(b"REGISTERED")
+                files = data[4].split(",") if len(data) > 4 else []
+                self._register_peer(peer_id, peer_ip, peer_port, files)
+
                 print(f"Peer {peer_id} registered with files: {files}")
+                return b"REGISTERED"
             
             elif command == "WHO_HAS":
                 filename = data[1]
-                holders = [
-                    f"{peer_info['ip']}:{peer_info['port']}"
-                    for peer_id, peer_info in self.peers.items()
-                    if filename in peer_info['files']
-                ]
+                holders = self._who_has(filename)
 
-                connection.sendall(",".join(holders).encode())
+                return ",".join(holders).encode()
             
             elif command == "NEW_FILE":
                 peer_id = data[1]
                 filename = data[2]
-                with self.lock:
-                    if peer_id in self.peers:
-                        self.peers[peer_id]['files'].append(filename)
-                        print(f"Peer {peer_id} added new file: {filename}")
-                connection.send(b"NEW FILE ADDED TO PEER FILES DIRECTORY")
+                self._new_file(peer_id, filename)
+                return b"NEW FILE ADDED TO PEER FILES DIRECTORY"
 
             elif command == "DISCONNECT":
                 peer_id = data[1]
-                with self.lock:
-                    if peer_id in self.peers:
-                        del self.peers[peer_id]
-                        print(f"Peer {peer_id} disconnected")
+                self._disconnect(peer_id)
         except Exception as e:
-            connection.send(b"NOT REGISTERED")
+            return b"NOT REGISTERED"
+
+        return b""
+
+
+class AsyncTracker(Tracker):
+    """
+    Mesmo protocolo do Tracker, mas todas as conexões são atendidas por um
+    único event loop do asyncio em vez de uma thread por conexão. Acima de
+    max_connections conexões simultâneas, as novas recebem BUSY (em quadro,
+    para quem fala P2) e são fechadas. Como cada peer mantém uma sessão
+    persistente, max_connections limita os peers conectados ao mesmo tempo,
+    não os pedidos em andamento.
+
+    O event loop só faz E/S: os pedidos pegam self.lock e escrevem o journal,
+    então rodam em REQUEST_WORKERS threads (run_in_executor). Uma varredura
+    ou uma compactação segurando o lock atrasa os pedidos, mas não o accept,
+    o BUSY nem os prazos das outras conexões.
+    """
+    def __init__(self, port=TRACKER_PORT, backlog=DEFAULT_BACKLOG, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 **check_options):
+        super().__init__(port, backlog, **check_options)
+        self.max_connections = max_connections
+        self._requests = ThreadPoolExecutor(max_workers=REQUEST_WORKERS, thread_name_prefix="tracker-request")
+
+    async def _handle_connection(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        self._connections.inc()
+        try:
+            try:
+                head = await asyncio.wait_for(reader.readexactly(len(MAGIC)), REQUEST_TIMEOUT)
+            except asyncio.IncompleteReadError as e:
+                head = e.partial
+
+            if self._connections.value > self.max_connections:
+                # o BUSY vai no formato que o cliente entende; em quadro, com o
+                # id do primeiro pedido para o TrackerSession entregá-lo a quem o fez
+                self.metrics.counter("busy").inc()
+                if head == MAGIC:
+                    frame = await asyncio.wait_for(read_frame(reader, head), REQUEST_TIMEOUT)
+                    if frame is not None:
+                        writer.write(pack_frame(MSG_BUSY, frame[1], pack_str("tracker ocupado")))
+                elif head:
+                    writer.write(b"BUSY")
+                await writer.drain()
+                return
+
+            if head == MAGIC:
+                while True:
+                    frame = await asyncio.wait_for(read_frame(reader, head),
+                                                   REQUEST_TIMEOUT if head else SESSION_IDLE_TIMEOUT)
+                    head = b""
+                    if frame is None:
+                        break
+                    msg_type, request_id, payload = frame
+                    response_type, response = await loop.run_in_executor(
+                        self._requests, self.process_message, msg_type, payload)
+                    writer.write(pack_frame(response_type, request_id, response))
+                    await writer.drain()
+            elif head:
+                raw = head + await asyncio.wait_for(reader.read(4096), REQUEST_TIMEOUT)
+                response = await loop.run_in_executor(self._requests, self.process_command, raw.decode().split())
+                if response:
+                    writer.write(response)
+                    await writer.drain()
+        except asyncio.TimeoutError:
+            self.metrics.counter("idle_closed").inc()
+        except Exception as e:
+            print(f"[ERROR] Falha ao atender {writer.get_extra_info('peername')}: {e}")
+        finally:
+            self._connections.dec()
+            writer.close()
+
+    async def _serve(self):
+        server = await asyncio.start_server(self._handle_connection, sock=self.server_socket)
+        async with server:
+            await server.serve_forever()
+
+    def start(self):
+        tracker_ip = self._get_my_ip()
+        print(f"Tracker (asyncio) running at {tracker_ip}:{self.port}")
+
+        threading.Thread(target=self._periodic_update, daemon=True).start()
+        threading.Thread(target=self._index_catalog, daemon=True).start()
+        asyncio.run(self._serve())
 
-        connection.close()
 
 if __name__ == "__main__":
-    tracker = Tracker()
-    tracker.start() 
-        
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Tracker da rede P2P")
+    parser.add_argument("--port", type=int, default=TRACKER_PORT)
+    parser.add_argument("--backlog", type=int, default=DEFAULT_BACKLOG,
+                        help="fila de conexões pendentes do listen()")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="atende as conexões com asyncio em vez de uma thread por conexão")
+    parser.add_argument("--max-connections", type=int, default=DEFAULT_MAX_CONNECTIONS,
+                        help="conexões simultâneas no modo --async; como cada peer mantém uma sessão "
+                             "aberta, é o máximo de peers conectados ao mesmo tempo")
+    parser.add_argument("--check-concurrency", type=int, default=DEFAULT_CHECK_CONCURRENCY,
+                        help="peers checados em paralelo a cada varredura")
+    parser.add_argument("--check-timeout", type=float, default=DEFAULT_CHECK_TIMEOUT,
+                        help="prazo de cada peer para responder ao VERIFY_FILES (s)")
+    parser.add_argument("--max-failures", type=int, default=DEFAULT_MAX_FAILURES,
+                        help="falhas seguidas até o peer ser removido")
+    parser.add_argument("--state-dir", default=DEFAULT_STATE_DIR,
+                        help="diretório do snapshot e do journal do estado (vazio desliga)")
+    parser.add_argument("--snapshot-every", type=int, default=DEFAULT_SNAPSHOT_EVERY,
+                        help="eventos no journal antes de compactar num snapshot")
+    parser.add_argument("--revalidate-batch", type=int, default=DEFAULT_REVALIDATE_BATCH,
+                        help="peers restaurados do disco checados por varredura")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="processos do tracker, cada um dono de uma fatia dos arquivos (shard.py)")
+    args = parser.parse_args()
+
+    check_options = {
+        "check_concurrency": args.check_concurrency,
+        "check_timeout": args.check_timeout,
+        "max_failures": args.max_failures,
+        "state_dir": args.state_dir,
+        "snapshot_every": args.snapshot_every,
+        "revalidate_batch": args.revalidate_batch,
+    }
+    if args.shards > 1:
+        if args.use_async:
+            parser.error("--shards não funciona junto com --async")
+        from shard import run_sharded
+        run_sharded(args.shards, args.port, args.backlog, **check_options)
+    elif args.use_async:
+        AsyncTracker(args.port, args.backlog, args.max_connections, **check_options).start()
+    else:
+        Tracker(args.port, args.backlog, **check_options).start()
@@ -0,0 +1,136 @@
+import socket
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+from protocol import (
+    MSG_BUSY, MSG_SEARCH, MSG_SHARD_SEARCH, MSG_STATS, MSG_TEXT, MSG_WHO_HAS, MSG_WHO_HAS_MANY, Payload,
+    pack_frame, recv_frame,
+)
+
+# pedidos que só leem o estado do tracker: repetir um deles depois de uma
+# queda não muda nada, mesmo que o tracker já o tenha atendido
+READ_ONLY = {MSG_WHO_HAS, MSG_WHO_HAS_MANY, MSG_SEARCH, MSG_STATS, MSG_SHARD_SEARCH}
+
+
+class TrackerBusy(ConnectionError):
+    """O tracker recusou a conexão: está no limite de conexões (BUSY)."""
+
+
+class TrackerSession:
+    """
+    Conexão persistente com o tracker, compartilhada por todas as threads do
+    peer. Cada pedido leva um id e a resposta é entregue a quem o fez, então
+    vários pedidos podem estar em voo ao mesmo tempo na mesma conexão
+    (pipelining). Se a conexão cair, ela é refeita no próximo pedido.
+    """
+    def __init__(self, address, timeout=10):
+        self.address = address
+        self.timeout = timeout
+        self._sock = None
+        self._lock = threading.Lock()  # protege a conexão e a escrita no socket
+        self._pending = {}  # id do pedido -> (socket, Future)
+        self._last_id = 0
+
+    def _connect(self):
+        # chamar com self._lock
+        sock = socket.create_connection(self.address, timeout=self.timeout)
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._sock = sock
+        threading.Thread(target=self._read_loop, args=(sock,), daemon=True).start()
+
+    def _next_id(self) -> int:
+        # chamar com self._lock; o id ocupa 32 bits no quadro e volta ao
+        # começo depois de 2**32 pedidos, pulando o 0 e os que ainda esperam
+        while True:
+            self._last_id = (self._last_id + 1) & 0xFFFFFFFF
+            if self._last_id and self._last_id not in self._pending:
+                return self._last_id
+
+    def _read_loop(self, sock):
+        try:
+            while True:
+                frame = recv_frame(sock)
+                if frame is None:
+                    break
+                _, request_id, payload = frame
+                pending = self._pending.pop(request_id, None)
+                if pending is not None:
+                    pending[1].set_result((frame[0], payload))
+        except Exception:
+            pass
+        finally:
+            self._drop(sock)
+
+    def _drop(self, sock):
+        """Descarta uma conexão morta e falha os pedidos que esperavam por ela."""
+        with self._lock:
+            if self._sock is sock:
+                self._sock = None
+            lost = [rid for rid, (s, _) in self._pending.items() if s is sock]
+            futures = [self._pending.pop(rid)[1] for rid in lost]
+        try:
+            # o shutdown manda o FIN já: só o close esperaria o recv da _read_loop voltar
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            sock.close()
+        except OSError:
+            pass
+        for future in futures:
+            if not future.done():
+                future.set_exception(ConnectionError("conexão com o tracker caiu"))
+
+    def request(self, message: str) -> str:
+        """Envia um comando no protocolo de texto e devolve a resposta em texto."""
+        _, payload = self.call(MSG_TEXT, message.encode())
+        return payload.decode()
+
+    def call(self, msg_type: int, payload: bytes = b""):
+        """
+        Envia um pedido e espera a resposta (tipo, payload). Se o envio
+        falhar, o pedido é repetido uma vez numa conexão nova; se a conexão
+        cair depois do envio, só os pedidos READ_ONLY são repetidos, porque
+        o tracker pode já ter aplicado os outros (REGISTER, HAVE...), e quem
+        chamou recebe o ConnectionError. Um BUSY do tracker vira TrackerBusy
+        (um ConnectionError, como o tracker fora do ar).
+        """
+        for attempt in range(2):
+            future = Future()
+            with self._lock:
+                if self._sock is None:
+                    self._connect()
+                sock = self._sock
+                request_id = self._next_id()
+                self._pending[request_id] = (sock, future)
+                try:
+                    sock.sendall(pack_frame(msg_type, request_id, payload))
+                    sent = True
+                except OSError:
+                    sent = False
+
+            if not sent:
+                self._drop(sock)
+                if attempt:
+                    raise ConnectionError("não foi possível enviar ao tracker")
+                continue
+
+            try:
+                response = future.result(self.timeout)
+            except FutureTimeout:
+                self._pending.pop(request_id, None)
+                raise TimeoutError(f"tracker não respondeu em {self.timeout}s")
+            except ConnectionError:
+                if attempt or msg_type not in READ_ONLY:
+                    raise
+                continue
+            if response[0] == MSG_BUSY:
+                raise TrackerBusy(Payload(response[1]).str())
+            return response
+
+    def close(self):
+        with self._lock:
+            sock = self._sock
+        if sock is not None:
+            self._drop(sock)